@@ -16,14 +16,25 @@ import os
 import gzip
 import glob
 import time
+import heapq
+import queue
+import ctypes
 import shutil
+import json
+import hashlib
+import tempfile
 import warnings
+import traceback
+import multiprocessing
 import subprocess as sps
 
 import numpy as np
 import pysam
+from numba import njit
 import ipyrad as ip
 from .utils import IPyradError, bcomp, comp
+from .utils import get_ref_bundle, build_ref_cached
+from .rawedit import iter_trimmed_reads
 
 
 class Step3:
@@ -35,6 +46,7 @@ class Step3:
         self.data = data
         # self.noreverse = noreverse
         self.maxindels = 8
+        self.nchunks = {}
         self.force = force
         self.ipyclient = ipyclient
         self.gbs = bool("gbs" in self.data.params.datatype)
@@ -54,9 +66,10 @@ class Step3:
            self.data.params.reference_as_filter):
             self.remote_index_refs()
 
-        # i: sample.files.edits is [(r1,r2),(r1,r2),(...)] for multiple fastq
-        # o: tmpdir/[r1,r2]_concatedit.fastq
-        if any(len(sample.files.edits) > 1 for sample in self.samples):
+        # i: sample.files.edits is [(r1,r2),(r1,r2),(...)] for merged samples
+        #    or [(r1,r2,trims),(...)] for paired reads trimmed as index.
+        # o: tmpdir/[r1,r2]_concatedit.fastq (paired only)
+        if any(needs_concat_edits(self.data, i) for i in self.samples):
             self.remote_run(
                 function=concat_multiple_edits,
                 printstr=("concatenating       ", "s3"),
@@ -231,11 +244,7 @@ class Step3:
 
                 # i: refmapping/{}.bam
                 # o: clustdir/{}.clustS.gz
-                self.remote_run(
-                    function=build_clusters_from_cigars,
-                    printstr=("building clusters   ", "s3"),
-                    args=(),
-                )
+                self.remote_build_ref_clusters()
 
             # DENOVO MINUS
             elif self.data.params.assembly_method == "denovo-reference":
@@ -297,11 +306,7 @@ class Step3:
                     args=(self.nthreads,),
                     threaded=True,
                 )
-                self.remote_run(
-                    function=build_clusters_from_cigars,
-                    printstr=("building clusters   ", "s3"),
-                    args=(),
-                )
+                self.remote_build_ref_clusters()
 
             else:
                 raise NotImplementedError(
@@ -456,6 +461,9 @@ class Step3:
                     'clusters_total': '{:.0f}'.format,
                     'clusters_hidepth': '{:.0f}'.format,
                     'filtered_bad_align': '{:.0f}'.format,
+                    'clusters_singleton': '{:.0f}'.format,
+                    'clusters_identical': '{:.0f}'.format,
+                    'clusters_variable': '{:.0f}'.format,
                     'avg_depth_stat': '{:.2f}'.format,
                     'avg_depth_mj': '{:.2f}'.format,
                     'avg_depth_total': '{:.2f}'.format,
@@ -525,13 +533,17 @@ class Step3:
                     *(self.data, sample, self.maxindels)
                 )
 
-        # submit cluster chunking job
+        # submit cluster chunking job, up to two chunks per engine. Not
+        # needed if clusters are streamed to aligners (see align_queued).
         hasyncs = {}
+        maxchunks = max(10, 2 * len(self.ipyclient.ids))
         for sample in self.samples:
+            if self.data.hackersonly.align_queue:
+                break
             with self.lbview.temp_flags(after=basyncs[sample.name]):
                 hasyncs[sample.name] = self.lbview.apply(
                     muscle_chunker,
-                    *(self.data, sample)
+                    *(self.data, sample, maxchunks)
                 )
 
         # track job progress
@@ -575,16 +587,31 @@ class Step3:
         for job in hasyncs:
             if not hasyncs[job].successful():
                 hasyncs[job].get()
+            self.nchunks[job] = hasyncs[job].get()
 
 
     def remote_run_align_cleanup(self):
 
-        # submit ten aligning jobs for each sample
+        # stream clusters to a pool of aligners on each threaded engine
+        if self.data.hackersonly.align_queue:
+            targets = self.thview.targets or self.ipyclient.ids
+            nworkers = max(1, len(self.ipyclient.ids) // len(targets))
+            counts = self.remote_run(
+                function=align_queued,
+                printstr=("aligning clusters   ", "s3"),
+                args=(nworkers, self.maxindels, self.gbs),
+                threaded=True,
+            )
+            for sample in self.samples:
+                self.store_align_counts(sample, counts[sample.name])
+            return
+
+        # submit an aligning job for each chunk of each sample
         start = time.time()
         aasyncs = {}
         for sample in self.samples:
             aasyncs[sample.name] = []
-            for idx in range(10):
+            for idx in range(self.nchunks[sample.name]):
                 handle = os.path.join(
                     self.data.tmpdir,
                     "{}_chunk_{}.ali".format(sample.name, idx))
@@ -592,7 +619,10 @@ class Step3:
                 rasync = self.lbview.apply(
                     align_and_parse,
                     *(handle, self.maxindels, self.gbs, 
-                        self.data.hackersonly.declone_PCR_duplicates)
+                        self.data.hackersonly.declone_PCR_duplicates,
+                        self.data.hackersonly.align_builtin_max_seqs,
+                        self.data.hackersonly.align_builtin_max_indels,
+                        self.data.hackersonly.align_builtin_validate)
                 )
                 aasyncs[sample.name].append(rasync)
 
@@ -636,17 +666,68 @@ class Step3:
             if not basyncs[job].successful():
                 basyncs[job].get()
 
-        # compile stats on highindel filteres, and duplicates
-        if self.data.hackersonly.declone_PCR_duplicates:
-            for sample in self.samples:
-                # list of 3-tuples
-                res = [i.get() for i in aasyncs[sample.name]]
+        # store the number of clusters by class, and filtered by indels
+        for sample in self.samples:
+            self.store_align_counts(
+                sample, sum(i.get() for i in aasyncs[sample.name]))
+
+
+    def remote_build_ref_clusters(self):
+        """
+        Builds the clusters of each sample from mapped reads in contiguous
+        shards of its regions (see get_ref_shards), each on any engine with 
+        its own pysam handle, and concatenates the shards in order.
+        """
+        start = time.time()
+        printstr = ("building clusters   ", "s3")
+        nshards = 2 * len(self.ipyclient.ids)
+
+        # split the regions of each sample into shards
+        sasyncs = {}
+        for sample in self.samples:
+            sasyncs[sample.name] = self.lbview.apply(
+                get_ref_shards,
+                *(self.data, sample, nshards)
+            )
+
+        # submit the shards of each sample as it is split, then concat
+        samples = {i.name: i for i in self.samples}
+        rasyncs = {}
+        casyncs = {}
+        while 1:
+            for sname in [i for i in sasyncs if sasyncs[i].ready()]:
+                shards = sasyncs.pop(sname).get()
+                rasyncs[sname] = [
+                    self.lbview.apply(
+                        build_clusters_from_cigars,
+                        *(self.data, samples[sname], shard))
+                    for shard in shards
+                ]
+                with self.lbview.temp_flags(after=rasyncs[sname]):
+                    casyncs[sname] = self.lbview.apply(
+                        concat_ref_shards,
+                        *(self.data, samples[sname], len(shards))
+                    )
+            ready = [casyncs[i].ready() for i in casyncs]
+            self.data._progressbar(len(samples), sum(ready), start, printstr)
+            time.sleep(0.1)
+            if not sasyncs and all(ready):
+                break
+
+        # check for errors, will raise ipp.RemoteError
+        self.data._print("")
+        for sname in casyncs:
+            for job in rasyncs[sname]:
+                if not job.successful():
+                    job.get()
+            casyncs[sname].get()
+
 
-                # count proportio of reads that are PCR duplicates
-                nreads = [i[1] for i in res]
-                nwodups = [i[2] for i in res]
-                propdup = float(nwodups) / nreads
-                sample.stats_dfs.s3["prop_pcr_duplicates"] = propdup
+    def store_align_counts(self, sample, counts):
+        "store the number of clusters by class (see align_chunk)"
+        counts = np.zeros(len(ALIGN_CLASSES), dtype=np.int64) + counts
+        for key, count in zip(ALIGN_CLASSES, counts):
+            sample.stats_dfs.s3[key] = int(count)
 
 
     def remote_run_sample_cleanup(self):
@@ -704,11 +785,13 @@ class Step3:
 
         # check for errors, will raise ipp.RemoteError
         self.data._print("")
+        results = {}
         for job in rasyncs:
-            rasyncs[job].get()
+            results[job] = rasyncs[job].get()
 
         # clean up to free any RAM
         self.ipyclient.purge_everything()
+        return results
 
 
 def dereplicate(data, sample, nthreads):
@@ -721,11 +804,8 @@ def dereplicate(data, sample, nthreads):
     dereplication that we need for 3rad (5/29/15 iao).
     """
     # find input file with following precedence:
-    # .trimmed.fastq.gz, .concatedit.fq.gz, ._merged.fastq, ._declone.fastq
+    # ._declone.fastq, ._merged.fastq, .concatedit.fq.gz, sample.files.edits
     infiles = [
-        os.path.join(
-            data.dirs.edits,
-            "{}.trimmed_R1_.fastq.gz".format(sample.name)),
         os.path.join(
             data.tmpdir,
             "{}_R1_concatedit.fq.gz".format(sample.name)),
@@ -737,13 +817,35 @@ def dereplicate(data, sample, nthreads):
             "{}_declone.fastq".format(sample.name)),
     ]
     infiles = [i for i in infiles if os.path.exists(i)]
-    infile = infiles[-1]
+
+    # multiple edit files, and reads trimmed as index (trim_reads_as_index),
+    # are read in turn (and trimmed on the fly) and piped to vsearch.
+    edits = sample.files.edits
+    stream = False
+    if infiles:
+        infile = infiles[-1]
+    elif len(edits) == 1 and not (len(edits[0]) > 2 and edits[0][2]):
+        infile = edits[0][0]
+    else:
+        infile = "-"
+        stream = True
 
     # datatypes options
     strand = "plus"
     if data.params.datatype in ['gbs', '2brad']:
         strand = "both"
 
+    # remove the sequence store of an earlier derep file
+    derepfile = os.path.join(data.tmpdir, sample.name + "_derep.fa")
+    for store in get_seq_store_paths(derepfile):
+        if os.path.exists(store):
+            os.remove(store)
+
+    # dereplicate in this process (derep_mode='builtin')
+    if data.hackersonly.derep_mode == "builtin":
+        dereplicate_builtin(data, sample, infile, strand == "both")
+        return
+
     # do dereplication with vsearch
     cmd = [
         ip.bins.vsearch,
@@ -765,12 +867,358 @@ def dereplicate(data, sample, nthreads):
         cmd.append("--gzip_decompress")
 
     # build PIPEd job   
-    proc = sps.Popen(cmd, stderr=sps.STDOUT, stdout=sps.PIPE, close_fds=True)
+    proc = sps.Popen(
+        cmd, 
+        stdin=(sps.PIPE if stream else None), 
+        stderr=sps.STDOUT, 
+        stdout=sps.PIPE, 
+        close_fds=True,
+    )
+    if stream:
+        try:
+            for edit in edits:
+                for block in iter_trimmed_reads(edit, 0):
+                    proc.stdin.write(block)
+        except IOError:
+            # vsearch exited, its error is reported below
+            pass
     errmsg = proc.communicate()[0]
     if proc.returncode:
         raise IPyradError(errmsg.decode())
 
 
+def dereplicate_builtin(data, sample, infile, both):
+    """
+    In-process alternative to vsearch --derep_fulllength. Reads are counted
+    in an open-addressing table keyed by a 128-bit hash of their sequence
+    (case-insensitive), keeping the first copy of each unique sequence, and
+    matched to revcomps of stored sequences if 'both'. Writes the same 
+    _derep.fa (md5 labels with ;size=, sorted by decreasing size and then 
+    first occurrence) and a binary store of the sequences in that order
+    (see get_seq_store_paths).
+    """
+    # infile '-' streams the (trimmed) edit files
+    if infile == "-":
+        chunks = chain.from_iterable(
+            iter_trimmed_reads(edit, 0) for edit in sample.files.edits)
+    else:
+        chunks = iter_file_chunks(infile)
+
+    # the hash table, grown to stay under half full
+    capacity = 1 << 16
+    hkeys = np.zeros((capacity, 2), dtype=np.uint64)
+    hcounts = np.zeros(capacity, dtype=np.int64)
+    huids = np.zeros(capacity, dtype=np.int64)
+    minlen = max(1, data.params.filter_min_trim_len)
+    nuniq = 0
+    useqs = []
+    ulens = []
+
+    for buf, starts, stops in iter_record_blocks(chunks):
+        if 2 * (nuniq + starts.size) > capacity:
+            while 2 * (nuniq + starts.size) > capacity:
+                capacity *= 2
+            nkeys = np.zeros((capacity, 2), dtype=np.uint64)
+            ncounts = np.zeros(capacity, dtype=np.int64)
+            nuids = np.zeros(capacity, dtype=np.int64)
+            _derep_rehash(hkeys, hcounts, huids, nkeys, ncounts, nuids)
+            hkeys, hcounts, huids = nkeys, ncounts, nuids
+
+        news = np.zeros(starts.size, dtype=np.int64)
+        nnew = _derep_block(
+            buf, starts, stops, minlen, both, 
+            hkeys, hcounts, huids, nuniq, news)
+        if nnew:
+            news = news[:nnew]
+            useqs.append(_gather_seqs(buf, starts[news], stops[news]))
+            ulens.append(stops[news] - starts[news])
+            nuniq += nnew
+
+    # order uniques by decreasing size, ties by first occurrence
+    used = hcounts > 0
+    sizes = np.zeros(nuniq, dtype=np.int64)
+    sizes[huids[used]] = hcounts[used]
+    order = np.argsort(-sizes, kind="mergesort")
+    ulens = np.concatenate(ulens or [np.zeros(0, dtype=np.int64)])
+    ustops = np.cumsum(ulens)
+    useqs = np.concatenate(useqs or [np.zeros(0, dtype=np.uint8)])
+    seqs = _gather_seqs(useqs, (ustops - ulens)[order], ustops[order])
+    del useqs
+
+    # write the fasta and the store of sequences and their index
+    index = np.zeros(nuniq, dtype=SEQ_STORE_DTYPE)
+    index["length"] = ulens[order]
+    index["start"] = np.cumsum(ulens[order]) - ulens[order]
+    index["size"] = sizes[order]
+    derepfile = os.path.join(data.tmpdir, sample.name + "_derep.fa")
+    with open(derepfile, 'w') as out:
+        writing = []
+        for idx in range(nuniq):
+            start = index["start"][idx]
+            seq = seqs[start:start + index["length"][idx]].tobytes()
+            md5 = hashlib.md5(seq.upper())
+            index["key"][idx] = md5.digest()
+            writing.append(">{};size={}\n{}\n".format(
+                md5.hexdigest(), index["size"][idx], seq.decode()))
+            if not (idx + 1) % 10000:
+                out.write("".join(writing))
+                writing = []
+        out.write("".join(writing))
+
+    indexfile, seqsfile = get_seq_store_paths(derepfile)
+    np.save(seqsfile, seqs)
+    np.save(indexfile, index)
+
+
+def get_seq_store_paths(fastafile):
+    """
+    Returns the paths of the binary store of a derep fasta file: an index 
+    array (SEQ_STORE_DTYPE) in the order of the fasta, and a uint8 array 
+    of the sequences concatenated in the same order.
+    """
+    prefix = fastafile.rsplit(".", 1)[0]
+    return prefix + ".index.npy", prefix + ".seqs.npy"
+
+
+def get_seq_key(label):
+    """
+    Returns the 16 byte key of a derep fasta label: the md5 of the 
+    sequence for labels from --relabel_md5, else the md5 of the label.
+    """
+    head = label.split(";size=")[0]
+    if len(head) == 32:
+        try:
+            return bytes(bytearray.fromhex(head))
+        except ValueError:
+            pass
+    return hashlib.md5(label.encode()).digest()
+
+
+def write_seq_store(fastafile):
+    """
+    Writes the binary store of a (single-line) derep fasta file while 
+    streaming it, for derep files that were not written with one.
+    """
+    nseqs = 0
+    nbases = 0
+    with open(fastafile, 'rt') as infile:
+        for line in infile:
+            if line[0] == ">":
+                nseqs += 1
+            else:
+                nbases += len(line.rstrip())
+
+    # npy files of empty arrays cannot be opened as memmaps
+    indexfile, seqsfile = get_seq_store_paths(fastafile)
+    if not nseqs:
+        np.save(indexfile, np.zeros(0, dtype=SEQ_STORE_DTYPE))
+        np.save(seqsfile, np.zeros(0, dtype=np.uint8))
+        return
+    index = np.lib.format.open_memmap(
+        indexfile, mode="w+", dtype=SEQ_STORE_DTYPE, shape=(nseqs,))
+    seqs = np.lib.format.open_memmap(
+        seqsfile, mode="w+", dtype=np.uint8, shape=(max(1, nbases),))
+
+    with open(fastafile, 'rt') as infile:
+        pairs = izip(*[iter(infile)] * 2)
+        start = 0
+        for idx, (label, seq) in enumerate(pairs):
+            label = label.strip()[1:]
+            seq = seq.strip().encode()
+            size = label.split(";size=")[-1].split(";")[0]
+            index[idx] = (
+                get_seq_key(label), 
+                start, 
+                len(seq), 
+                int(size) if size.isdigit() else 1,
+            )
+            seqs[start:start + len(seq)] = np.frombuffer(seq, dtype=np.uint8)
+            start += len(seq)
+    index.flush()
+    seqs.flush()
+    del index, seqs
+
+
+def load_seq_store(fastafile):
+    """
+    Returns the index and sequences of the binary store of a derep fasta
+    file as arrays on memmaps, writing the store first if it does not exist.
+    """
+    indexfile, seqsfile = get_seq_store_paths(fastafile)
+    if not (os.path.exists(indexfile) and os.path.exists(seqsfile)):
+        write_seq_store(fastafile)
+    index = np.load(indexfile, mmap_mode="r")
+    if not index.size:
+        return index, np.zeros(0, dtype=np.uint8)
+    seqs = np.load(seqsfile, mmap_mode="r")
+
+    # plain ndarray views skip the (slow) memmap item access
+    return index.view(np.ndarray), seqs.view(np.ndarray)
+
+
+def get_seq_ids(labels, index, lookup=None):
+    """
+    Returns the row in a seq store index of each derep fasta label. The 
+    lookup (rows sorted by key, and sorted keys) can be passed in from
+    an earlier call, which returns it as second value.
+    """
+    if lookup is None:
+        keyorder = np.argsort(index["key"], kind="mergesort")
+        lookup = (keyorder, index["key"][keyorder])
+    keyorder, sortedkeys = lookup
+    keys = np.array([get_seq_key(i) for i in labels], dtype="S16")
+    if not keys.size:
+        return np.zeros(0, dtype=np.int64), lookup
+    pos = np.searchsorted(sortedkeys, keys).clip(0, max(0, keyorder.size - 1))
+    if not keyorder.size or np.any(sortedkeys[pos] != keys):
+        raise IPyradError("cluster labels not found in derep file")
+    return keyorder[pos], lookup
+
+
+def iter_file_chunks(infile):
+    "yields blocks of bytes from a (gzipped) file"
+    if infile.endswith(".gz"):
+        reader = gzip.open(infile, 'rb')
+    else:
+        reader = open(infile, 'rb')
+    with reader:
+        while 1:
+            chunk = reader.read(DEREP_CHUNKSIZE)
+            if not chunk:
+                break
+            yield chunk
+
+
+def iter_record_blocks(chunks):
+    """
+    Regroups blocks of fastq (or single-line fasta) bytes into whole records
+    and yields them as a uint8 array with the start and stop of each 
+    sequence line.
+    """
+    rest = b""
+    nlines = 0
+    for chunk in chain(chunks, [None]):
+        if chunk is None:
+            if not rest.strip():
+                break
+            block = rest if rest.endswith(b"\n") else rest + b"\n"
+        else:
+            block = rest + chunk
+        if not nlines:
+            nlines = (4 if block.startswith(b"@") else 2)
+        buf = np.frombuffer(block, dtype=np.uint8)
+        ends = np.flatnonzero(buf == 10)
+        nrecs = ends.size // nlines
+        if chunk is None and ends.size % nlines:
+            raise IPyradError("truncated record at end of derep input")
+        if not nrecs:
+            rest = block
+            continue
+        cut = ends[nrecs * nlines - 1] + 1
+        starts = ends[0:nrecs * nlines:nlines] + 1
+        stops = ends[1:nrecs * nlines:nlines]
+        yield buf[:cut], starts, stops
+        rest = block[cut:]
+
+
+@njit
+def _hash_seq(buf, start, stop, lut, reverse):
+    "returns two 64-bit hashes of buf[start:stop] mapped through lut"
+    h1 = np.uint64(14695981039346656037)
+    h2 = np.uint64(stop - start)
+    for pos in range(stop - start):
+        if reverse:
+            base = np.uint64(lut[buf[stop - 1 - pos]])
+        else:
+            base = np.uint64(lut[buf[start + pos]])
+        h1 = (h1 ^ base) * np.uint64(1099511628211)
+        h2 = (h2 ^ base) * np.uint64(0xff51afd7ed558ccd)
+        h2 ^= h2 >> np.uint64(32)
+    return h1, h2
+
+
+@njit
+def _find_slot(hkeys, hcounts, h1, h2):
+    "returns the slot holding (h1, h2), or the empty slot to insert it in"
+    mask = np.uint64(hcounts.size - 1)
+    slot = h1 & mask
+    while hcounts[slot]:
+        if hkeys[slot, 0] == h1 and hkeys[slot, 1] == h2:
+            break
+        slot = (slot + np.uint64(1)) & mask
+    return slot
+
+
+@njit
+def _derep_block(
+    buf, starts, stops, minlen, both, hkeys, hcounts, huids, nuniq, news):
+    """
+    Counts each sequence in the hash table. Sequences shorter than minlen
+    are skipped. Stores the indices of sequences that were new in 'news'
+    and returns how many there were.
+    """
+    nnew = 0
+    for idx in range(starts.size):
+        start = starts[idx]
+        stop = stops[idx]
+        if stop - start < minlen:
+            continue
+        h1, h2 = _hash_seq(buf, start, stop, DEREP_UPPER_LUT, False)
+        slot = _find_slot(hkeys, hcounts, h1, h2)
+        if both and not hcounts[slot]:
+            r1, r2 = _hash_seq(buf, start, stop, DEREP_COMP_LUT, True)
+            rslot = _find_slot(hkeys, hcounts, r1, r2)
+            if hcounts[rslot]:
+                slot = rslot
+        if not hcounts[slot]:
+            hkeys[slot, 0] = h1
+            hkeys[slot, 1] = h2
+            huids[slot] = nuniq + nnew
+            news[nnew] = idx
+            nnew += 1
+        hcounts[slot] += 1
+    return nnew
+
+
+@njit
+def _derep_rehash(hkeys, hcounts, huids, nkeys, ncounts, nuids):
+    "moves the filled slots of a hash table into a larger one"
+    for slot in range(hcounts.size):
+        if hcounts[slot]:
+            nslot = _find_slot(nkeys, ncounts, hkeys[slot, 0], hkeys[slot, 1])
+            nkeys[nslot, 0] = hkeys[slot, 0]
+            nkeys[nslot, 1] = hkeys[slot, 1]
+            ncounts[nslot] = hcounts[slot]
+            nuids[nslot] = huids[slot]
+
+
+@njit
+def _gather_seqs(buf, starts, stops):
+    "returns buf[start:stop] for each start, stop concatenated"
+    out = np.empty((stops - starts).sum(), dtype=np.uint8)
+    pos = 0
+    for idx in range(starts.size):
+        for bidx in range(starts[idx], stops[idx]):
+            out[pos] = buf[bidx]
+            pos += 1
+    return out
+
+
+def needs_concat_edits(data, sample):
+    """
+    Paired reads in multiple edit files, or trimmed as index 
+    (trim_reads_as_index), are concatenated into tmpdir since the tools 
+    that merge and map pairs read them from files. Single reads are 
+    streamed (and trimmed on the fly) to vsearch in dereplicate.
+    """
+    if "pair" not in data.params.datatype:
+        return False
+    edits = sample.files.edits
+    if len(edits) > 1:
+        return True
+    return bool(len(edits[0]) > 2 and edits[0][2])
+
+
 def concat_multiple_edits(data, sample):
 
     # define output files
@@ -781,13 +1229,27 @@ def concat_multiple_edits(data, sample):
         data.tmpdir,
         "{}_R2_concatedit.fq.gz".format(sample.name))
 
+    # apply trims while concatenating if reads were trimmed as index
+    if not needs_concat_edits(data, sample):
+        return
+    if any(len(i) > 2 and i[2] for i in sample.files.edits):
+        with gzip.open(concat1, 'wb') as cout1:
+            for edit in sample.files.edits:
+                for block in iter_trimmed_reads(edit, 0):
+                    cout1.write(block)
+        if os.path.exists(str(sample.files.edits[0][1])):
+            with gzip.open(concat2, 'wb') as cout2:
+                for edit in sample.files.edits:
+                    for block in iter_trimmed_reads(edit, 1):
+                        cout2.write(block)
+
     # check for files to concat
-    if len(sample.files.edits) > 1:
+    elif len(sample.files.edits) > 1:
         # cat all inputs; index 0 b/c files are in tuples for r1, r2
         cmd1 = ["cat"] + [i[0] for i in sample.files.edits]
 
         # write to new concat handle
-        with open(concat1, 'w') as cout1:
+        with open(concat1, 'wb') as cout1:
             proc1 = sps.Popen(
                 cmd1, stderr=sps.STDOUT, stdout=cout1, close_fds=True)
             res1 = proc1.communicate()[0]
@@ -797,7 +1259,7 @@ def concat_multiple_edits(data, sample):
         # Only set conc2 if R2 actually exists
         if os.path.exists(str(sample.files.edits[0][1])):
             cmd2 = ["cat"] + [i[1] for i in sample.files.edits]
-            with gzip.open(concat2, 'w') as cout2:
+            with open(concat2, 'wb') as cout2:
                 proc2 = sps.Popen(
                     cmd2, stderr=sps.STDOUT, stdout=cout2, close_fds=True)
                 res2 = proc2.communicate()[0]
@@ -1095,13 +1557,11 @@ def build_clusters(data, sample, maxindels):
     which contain un-aligned clusters. Hits to seeds are only kept in the
     cluster if the number of internal indels is less than 'maxindels'.
     By default, we set maxindels=6 for this step (within-sample clustering).
-    """
-
-    # If reference assembly then here we're clustering the unmapped reads
-    # if "reference" in data.params.assembly_method:
-    # derepfile = os.path.join(
-    # data.tmpdir, sample.name + "-refmap_derep.fa")
 
+    Sequences are read from a memory-mapped store of the derep file and 
+    the hits are sorted by seed in chunks that are merged while streaming,
+    so memory use does not grow with the depth of the sample.
+    """
     infiles = [
         os.path.join(data.tmpdir, sample.name + "_derep.fa"),
         os.path.join(data.tmpdir, sample.name + "_remerged.fa"),
@@ -1110,7 +1570,6 @@ def build_clusters(data, sample, maxindels):
 
     # i/o vsearch files
     uhandle = os.path.join(data.dirs.clusts, sample.name + ".utemp")
-    usort = os.path.join(data.dirs.clusts, sample.name + ".utemp.sort")
     hhandle = os.path.join(data.dirs.clusts, sample.name + ".htemp")
     clustsout = open(
         os.path.join(
@@ -1118,107 +1577,89 @@ def build_clusters(data, sample, maxindels):
             "{}.clust.txt".format(sample.name)), 
         'w')
 
-    # Sort the uhandle file so we can read through matches efficiently
-    cmd = ["sort", "-k", "2", uhandle, "-o", usort]
-    proc = sps.Popen(cmd, close_fds=True)
-    proc.communicate()[0]
+    # memory-mapped derep sequences, looked up by their row in the index
+    index, seqs = load_seq_store(derepfile)
+    starts = index["start"]
+    lengths = index["length"]
 
-    # load ALL derep reads into a dictionary (this can be a few GB of RAM)
-    # and is larger if names are larger. We are grabbing two lines at a time.
-    alldereps = {}
-    with open(derepfile, 'rt') as ioderep:
-        dereps = izip(*[iter(ioderep)] * 2)
-        for namestr, seq in dereps:
-            nnn, sss = [i.strip() for i in (namestr, seq)]  
-            alldereps[nnn[1:]] = sss
+    def getseq(row):
+        "returns a derep sequence from the store"
+        start = starts[row]
+        return seqs[start:start + lengths[row]].tobytes().decode()
 
     # store observed seeds (this could count up to >million in bad data sets)
-    seedsseen = set()
+    seedsseen = np.zeros(index.size, dtype=np.bool_)
+
+    # sort the hits by seed, and by decreasing hit size, in runs on disk
+    runs, lookup = sort_cluster_hits(data, sample, uhandle, index)
+    handles = [open(i, 'rt') for i in runs]
 
-    # Iterate through the usort file grabbing matches to build clusters
-    with open(usort, 'rt') as insort:
-        # iterator, seed null, seqlist null
-        isort = iter(insort)
-        lastseed = 0
+    # Iterate through the merged runs grabbing matches to build clusters
+    try:
+        lastseed = -1
         fseqs = []
         seqlist = []
-        seqsize = 0
-        while 1:
-
-            # grab the next line and parse the informative columns
-            try:
-                hit, seed, _, ind, ori, _ = next(isort).strip().split()
-            except StopIteration:
-                break
+        for line in heapq.merge(*handles):
+            seedrow = int(line[:12])
+            hitrow = int(line[24:36])
+            hit, seed, _, ind, ori, _ = line[37:].split()
 
             # same seed, append match
-            if seed != lastseed:
-                seedsseen.add(seed)
+            if seedrow != lastseed:
+                seedsseen[seedrow] = True
 
                 # store the last cluster (fseq), count it, and clear fseq
                 if fseqs:
-                    # sort hits by size, which is at the end of the header
-                    fsort = sorted(
-                        fseqs[1:], 
-                        key=(lambda x: int(x.split(";size=")[-1].split("\n")[0][:-2])),
-                        reverse=True,
-                    )
-                    # seed first then sorted hits
-                    fseqs = [fseqs[0]] + fsort
                     seqlist.append("\n".join(fseqs))
-                    seqsize += 1
                     fseqs = []
 
                 # occasionally write/dump stored clusters to file and clear mem
-                if not seqsize % 10000:
-                    if seqlist:
-                        clustsout.write(
-                            "\n//\n//\n".join(seqlist) + "\n//\n//\n")
-                        # reset list and counter
-                        seqlist = []
+                if len(seqlist) >= 10000:
+                    clustsout.write("\n//\n//\n".join(seqlist) + "\n//\n//\n")
+                    seqlist = []
 
                 # store the new seed on top of fseq list
-                fseqs.append(">{};*\n{}".format(seed, alldereps[seed]))
-                lastseed = seed
+                fseqs.append(">{};*\n{}".format(seed, getseq(seedrow)))
+                lastseed = seedrow
 
             # add match to the seed
             # revcomp if orientation is reversed (comp preserves nnnn)
-            if ori == "-":
-                seq = comp(alldereps[hit])[::-1]
-            else:
-                seq = alldereps[hit]
             # only save if not too many indels
             if int(ind) <= maxindels:
+                seq = getseq(hitrow)
+                if ori == "-":
+                    seq = comp(seq)[::-1]
                 fseqs.append(">{};{}\n{}".format(hit, ori, seq))
 
+    finally:
+        for handle in handles:
+            handle.close()
+        for run in runs:
+            os.remove(run)
+
     # write whatever is left over to the clusts file
     if fseqs:
         seqlist.append("\n".join(fseqs))
     if seqlist:
         clustsout.write("\n//\n//\n".join(seqlist) + "\n//\n//\n")
 
-    # now write the seeds that had no hits. Make dict from htemp
+    # now write the seeds that had no hits, read from htemp in chunks
     with open(hhandle, 'rt') as iotemp:
-        nohits = izip(*[iter(iotemp)] * 2)
+        labels = islice(iotemp, 0, None, 2)
         seqlist = []
-        seqsize = 0
         while 1:
-            try:
-                nnn, _ = [i.strip() for i in next(nohits)]
-            except StopIteration:
+            chunk = [i.strip()[1:] for i in islice(labels, 10000)]
+            if not chunk:
                 break
+            rows, lookup = get_seq_ids(chunk, index, lookup)
+            for label, row in zip(chunk, rows):
+                if not seedsseen[row]:
+                    seqlist.append(">{};*\n{}".format(label, getseq(row)))
 
             # occasionally write to file
-            if not seqsize % 10000:
-                if seqlist:
-                    clustsout.write("\n//\n//\n".join(seqlist) + "\n//\n//\n")
-                    # reset list and counter
-                    seqlist = []
-
-            # append to list if new seed
-            if nnn[1:] not in seedsseen:
-                seqlist.append("{};*\n{}".format(nnn, alldereps[nnn[1:]]))
-                seqsize += 1
+            if len(seqlist) >= 10000:
+                clustsout.write("\n//\n//\n".join(seqlist) + "\n//\n//\n")
+                seqlist = []
 
     # write whatever is left over to the clusts file
     if seqlist:
@@ -1226,58 +1667,159 @@ def build_clusters(data, sample, maxindels):
 
     # close the file handle
     clustsout.close()
-    del alldereps
 
 
-def muscle_chunker(data, sample):
+def sort_cluster_hits(data, sample, uhandle, index, lookup=None):
+    """
+    Sorts the hits in a vsearch .utemp file by seed, then by decreasing 
+    hit size, in chunks that are written to tmpdir as runs of lines with 
+    a fixed-width sort key (seed row, maxsize - hit size, hit row) added 
+    to the front, so that the runs can be merged as plain text. Runs are
+    merged in stages to at most CLUST_MAX_RUNS (see merge_cluster_runs) so
+    that all can be opened at once. Returns the run files and the lookup 
+    of get_seq_ids.
+    """
+    runs = []
+    with open(uhandle, 'rt') as inhits:
+        while 1:
+            lines = list(islice(inhits, CLUST_HITS_CHUNK))
+            if not lines:
+                break
+            labels = [i.split(None, 2)[:2] for i in lines]
+            hitrows, lookup = get_seq_ids([i[0] for i in labels], index, lookup)
+            seedrows, lookup = get_seq_ids([i[1] for i in labels], index, lookup)
+            sizes = index["size"][hitrows].astype(np.int64)
+            order = np.lexsort((hitrows, -sizes, seedrows))
+
+            run = os.path.join(
+                data.tmpdir, "{}_hits.{}.txt".format(sample.name, len(runs)))
+            with open(run, 'w') as out:
+                out.writelines(
+                    "{:012d}{:012d}{:012d}\t{}\n".format(
+                        seedrows[i], 
+                        2 ** 32 - sizes[i],
+                        hitrows[i], 
+                        lines[i].rstrip("\n"))
+                    for i in order
+                )
+            runs.append(run)
+    return merge_cluster_runs(data, sample, runs), lookup
+
+
+def merge_cluster_runs(data, sample, runs):
+    """
+    Merges sorted runs of hits in groups of CLUST_MAX_RUNS into longer runs
+    until no more than CLUST_MAX_RUNS are left, so that deep samples do not
+    hit the limit of open files when the runs are merged in build_clusters.
+    """
+    stage = 0
+    while len(runs) > CLUST_MAX_RUNS:
+        merged = []
+        for gidx in range(0, len(runs), CLUST_MAX_RUNS):
+            group = runs[gidx:gidx + CLUST_MAX_RUNS]
+            run = os.path.join(
+                data.tmpdir, "{}_hits.s{}.{}.txt"
+                .format(sample.name, stage, len(merged)))
+            handles = [open(i, 'rt') for i in group]
+            try:
+                with open(run, 'w') as out:
+                    out.writelines(heapq.merge(*handles))
+            finally:
+                for handle in handles:
+                    handle.close()
+            for i in group:
+                os.remove(i)
+            merged.append(run)
+        runs = merged
+        stage += 1
+    return runs
+
+
+def muscle_chunker(data, sample, maxchunks=10):
     """
     Splits the muscle alignment into chunks. Each chunk is run on a separate
-    computing core. Because the largest clusters are at the beginning of the 
-    clusters file, assigning equal clusters to each file would put all of the 
-    large cluster, that take longer to align, near the top. So instead we 
-    randomly distribute the clusters among the files. If assembly method is
+    computing core. Clusters are streamed from the clusters file and the 
+    cost of aligning each is estimated as nseqs x length^2. The clusters
+    are then packed into chunks of roughly equal cost by longest-processing-
+    time assignment (largest first, each to the least loaded chunk). The 
+    number of chunks follows the total cost (ALIGN_CHUNK_COST per chunk) up
+    to maxchunks. Returns the number of chunks. If assembly method is 
     reference then this step is just a placeholder and nothing happens. 
     """
 
     # only chunk up denovo data, refdata has its own chunking method which 
     # makes equal size chunks, instead of uneven chunks like in denovo
-    if data.params.assembly_method != "reference":
-        # get the number of clusters
-        clustfile = os.path.join(data.dirs.clusts, sample.name + ".clust.txt")
-        with iter(open(clustfile, 'rt')) as clustio:
-            nloci = sum(1 for i in clustio if "//" in i) // 2
-            optim = (nloci // 20) + (nloci % 20)
-            #io
-            #optim = int(nloci/10)
-
-        # write optim clusters to each tmp file
-        clustio = open(clustfile, 'rt')
-        inclusts = iter(clustio.read().strip().split("//\n//\n"))
-
-        # splitting loci so first file is smaller and last file is bigger
-        inc = optim // 10
-        for idx in range(10):
-            # how big is this chunk?
-            this = optim + (idx * inc)
-            left = nloci - this
-            ## Distribute all loci equally among chunks
-            ## io
-            ##left = nloci - optim
-            ##this = optim
-            if idx == 9:
-                # grab everything left
-                grabchunk = list(islice(inclusts, int(1e9)))
+    if data.params.assembly_method == "reference":
+        return 0
+
+    # get the alignment cost of each cluster
+    clustfile = os.path.join(data.dirs.clusts, sample.name + ".clust.txt")
+    costs = []
+    with open(clustfile, 'rt') as clustio:
+        nseqs = 0
+        maxlen = 0
+        for line in chain(clustio, ["//\n"]):
+            if line.startswith("//"):
+                if nseqs:
+                    costs.append(get_align_cost(nseqs, maxlen))
+                nseqs = 0
+                maxlen = 0
+            elif line.startswith(">"):
+                nseqs += 1
             else:
-                # grab next chunks-worth of data
-                grabchunk = list(islice(inclusts, this))
-                nloci = left
+                maxlen = max(maxlen, len(line.rstrip()))
+    if not costs:
+        return 0
 
-            # write the chunk to file
-            tmpfile = os.path.join(
-                data.tmpdir, sample.name + "_chunk_{}.ali".format(idx))
-            with open(tmpfile, 'wb') as out:
-                out.write(str.encode("//\n//\n".join(grabchunk)))
-        clustio.close()
+    # pack clusters into nchunks by longest-processing-time assignment
+    costs = np.array(costs)
+    nchunks = int(np.ceil(costs.sum() / ALIGN_CHUNK_COST))
+    nchunks = max(1, min(nchunks, maxchunks, costs.size))
+    chunkof = np.zeros(costs.size, dtype=np.int64)
+    loads = [(0., idx) for idx in range(nchunks)]
+    for cidx in np.argsort(-costs, kind="mergesort"):
+        load, idx = heapq.heappop(loads)
+        chunkof[cidx] = idx
+        heapq.heappush(loads, (load + costs[cidx], idx))
+
+    # write each cluster to its chunk file
+    outs = [
+        open(os.path.join(
+            data.tmpdir, sample.name + "_chunk_{}.ali".format(idx)), 'wt')
+        for idx in range(nchunks)
+    ]
+    try:
+        for cidx, clust in enumerate(iter_clusters(clustfile)):
+            outs[chunkof[cidx]].write(clust + "//\n//\n")
+    finally:
+        for out in outs:
+            out.close()
+    return nchunks
+
+
+def iter_clusters(clustfile):
+    "yields each cluster of a clust.txt file as a string of lines"
+    with open(clustfile, 'rt') as clustio:
+        clust = []
+        for line in chain(clustio, ["//\n"]):
+            if line.startswith("//"):
+                if clust:
+                    yield "".join(clust)
+                clust = []
+            elif line.strip():
+                clust.append(line if line.endswith("\n") else line + "\n")
+
+
+def get_align_cost(nseqs, maxlen):
+    """
+    Returns the estimated cost of aligning a cluster, nseqs x length^2, 
+    where only the first 200 seqs are aligned (see persistent_popen_align3)
+    and single seqs are not aligned at all.
+    """
+    nseqs = min(nseqs, 200)
+    if nseqs == 1:
+        return float(maxlen)
+    return float(nseqs * maxlen ** 2)
 
 
 def declone_clusters(aligned):
@@ -1358,43 +1900,44 @@ def declone_clusters(aligned):
     return decloned, nwdups, nwodups
 
 
-def align_and_parse(handle, max_internal_indels=5, is_gbs=False, declone=False):
-    """ much faster implementation for aligning chunks """
+def align_and_parse(
+    handle, max_internal_indels=5, is_gbs=False, declone=False, 
+    builtin_max_seqs=0, builtin_max_indels=3, validate=0):
+    """ 
+    much faster implementation for aligning chunks. Small clusters can be
+    aligned by the builtin aligner (see persistent_popen_align3), and the
+    validation of a proportion of those against muscle is written to a
+    .validation file next to the chunk. Returns the number of clusters of
+    each class in ALIGN_CLASSES (see align_chunk).
+    """
 
     # CHECK: data are already chunked, read in the whole thing. bail if no data
-    clusts = []
+    counts = np.zeros(len(ALIGN_CLASSES), dtype=np.int64)
     try:
         with open(handle, 'rb') as infile:
-            clusts = infile.read().decode().split("//\n//\n")
-            # remove any empty spots
-            clusts = [i for i in clusts if i]
+            chunk = infile.read()
             # Skip entirely empty chunks; return 0 if no clusters in file
             # Allows some chunks to be empty without raising an error.
-            if not clusts:
-                return 0
+            if not chunk.strip():
+                return counts
 
     # return 0 if file not read for some reason...
     except IOError:
-        return 0
+        return counts
 
     # count discarded clusters for printing to stats later
-    highindels = 0
     nwdups = 0
     nwodups = 0
 
     # iterate over clusters sending each to muscle, splits and aligns pairs
-    aligned = persistent_popen_align3(clusts, 200, is_gbs)
-
-    # store good alignments to be written to file
-    refined = []
-
-    # filter and trim alignments
-    for clust in aligned:
-        # check for too many internal indels
-        if not aligned_indel_filter(clust, max_internal_indels):
-            refined.append(clust)
-        else:
-            highindels += 1
+    validations = []
+    refined, counts = align_chunk(
+        chunk, max_internal_indels, is_gbs, 
+        builtin_max_seqs, builtin_max_indels, validate, validations)
+    if validations:
+        with open(handle.rsplit(".", 1)[0] + ".validation", 'w') as out:
+            out.write("".join(
+                "\t".join(str(i) for i in row) + "\n" for row in validations))
 
     # declone reads based on i5 tags in the header
     if declone:
@@ -1409,16 +1952,120 @@ def align_and_parse(handle, max_internal_indels=5, is_gbs=False, declone=False):
             except TypeError:
                 outfile.write(("\n//\n//\n".join(refined) + "\n").encode())
 
-    # return nfiltered by indels, nreads in clusters, nreads after deduping
-    return highindels
+    # return the number of clusters by class, and filtered by indels
+    return counts
+
+
+def align_chunk(
+    chunk, max_internal_indels=5, is_gbs=False, builtin_max_seqs=0, 
+    builtin_max_indels=3, validate=0, validations=None, proc=None, 
+    seed=None):
+    """
+    Aligns a chunk (bytes) of clusters separated by //. Singletons and 
+    clusters of identical seqs (see classify_clusters) need no alignment 
+    and are returned first as they are, then the variable clusters aligned
+    by persistent_popen_align3 that pass the internal indel filter. Returns
+    the clusters and the number of clusters of each class in ALIGN_CLASSES,
+    where the last is the number filtered for too many indels.
+    """
+    clusts = [i for i in chunk.decode().split("//\n//\n") if i]
+    classes = classify_clusters(chunk, len(clusts))
+    counts = np.zeros(len(ALIGN_CLASSES), dtype=np.int64)
+    counts[:3] = np.bincount(classes, minlength=3)
+
+    # singletons and identical clusters straight to the output
+    refined = [
+        format_unaligned(clusts[i]) for i in np.where(classes < 2)[0]]
+
+    # align the variable clusters and filter for internal indels
+    aligned = persistent_popen_align3(
+        [clusts[i] for i in np.where(classes == 2)[0]], 200, is_gbs, 
+        builtin_max_seqs, builtin_max_indels, validate, validations, 
+        proc, seed)
+    for clust in aligned:
+        if not aligned_indel_filter(clust, max_internal_indels):
+            refined.append(clust)
+        else:
+            counts[3] += 1
+    return refined, counts
+
+
+def classify_clusters(chunk, nclusts):
+    """
+    Returns the class of each cluster in a chunk (bytes) of clusters 
+    separated by //, found in one pass over the chunk: 0 for singletons,
+    1 if every hit matches the seed by length and hash (identical), or 2 
+    for variable clusters. All are variable if the chunk does not parse 
+    to nclusts clusters.
+    """
+    classes = _classify_clusters(
+        np.frombuffer(chunk, dtype=np.uint8), ALIGN_HASH_LUT)
+    if classes.size != nclusts:
+        return np.full(nclusts, 2, dtype=np.int8)
+    return classes
+
+
+def format_unaligned(clust, maxseqs=200):
+    """
+    Returns a cluster that needs no alignment in the format of aligned 
+    clusters (see muscle_align): names without >, the seed on top and the
+    first maxseqs-1 hits sorted by decreasing size.
+    """
+    lines = clust.strip().split("\n")
+    rows = list(zip([i[1:] for i in lines[0::2]], lines[1::2]))[:maxseqs]
+    rows = [rows[0]] + sorted(
+        rows[1:], key=lambda x: get_derep_num(x[0]), reverse=True)
+    return "\n".join("{}\n{}".format(*i) for i in rows)
+
+
+@njit
+def _classify_clusters(buf, lut):
+    "returns the class of each cluster in buf (see classify_clusters)"
+    classes = np.zeros(buf.size // 4 + 1, dtype=np.int8)
+    nclusts = 0
+    nseqs = 0
+    same = True
+    seedlen = 0
+    seedh1 = seedh2 = np.uint64(0)
+    pos = 0
+    while pos <= buf.size:
+        end = pos
+        while end < buf.size and buf[end] != 10:
+            end += 1
+
+        # compare each seq to the seed
+        if end > pos and buf[pos] != 47 and buf[pos] != 62:
+            h1, h2 = _hash_seq(buf, pos, end, lut, False)
+            if not nseqs:
+                seedlen = end - pos
+                seedh1 = h1
+                seedh2 = h2
+            elif end - pos != seedlen or h1 != seedh1 or h2 != seedh2:
+                same = False
+            nseqs += 1
+
+        # a separator line, or the end of the chunk, ends a cluster
+        if end == buf.size or (end > pos and buf[pos] == 47):
+            if nseqs:
+                if nseqs == 1:
+                    classes[nclusts] = 0
+                elif same:
+                    classes[nclusts] = 1
+                else:
+                    classes[nclusts] = 2
+                nclusts += 1
+            nseqs = 0
+            same = True
+        pos = end + 1
+    return classes[:nclusts]
 
 
 def reconcat(data, sample):
-    """ takes aligned chunks (usually 10) and concatenates them """
+    """ takes aligned chunks (see muscle_chunker) and concatenates them """
 
     # get chunks
     chunks = glob.glob(
-        os.path.join(data.tmpdir, sample.name + "_chunk_[0-9].aligned"))       
+        os.path.join(data.tmpdir, sample.name + "_chunk_[0-9]*.aligned"))
 
     # sort by chunk number, cuts off last 8 =(aligned)
     chunks.sort(key=lambda x: int(x.rsplit("_", 1)[-1][:-8]))
@@ -1439,145 +2086,262 @@ def reconcat(data, sample):
                     out.write(dat.encode())
             os.remove(fname)
 
+    # reconcats validations of the builtin aligner (align_builtin_validate)
+    valids = glob.glob(
+        os.path.join(data.tmpdir, sample.name + "_chunk_[0-9]*.validation"))
+    if valids:
+        validfile = os.path.join(
+            data.dirs.clusts, sample.name + ".align_validation.txt")
+        with open(validfile, 'w') as out:
+            out.write("\t".join(ALIGN_VALIDATION_FIELDS) + "\n")
+            for fname in valids:
+                with open(fname) as infile:
+                    out.write(infile.read())
+                os.remove(fname)
+
+
+def align_queued(data, sample, nthreads, max_internal_indels=5, is_gbs=False):
+    """
+    Aligns the clusters of a sample without chunk files. Batches of whole
+    clusters are streamed from the clusters file into a bounded set of 
+    shared memory slots, and a pool of nthreads aligner processes (see 
+    align_queue_worker) takes the next batch as it becomes free. Results
+    are written in order straight into the clustS output, and the slot of
+    a batch is reused only once its result is written, which bounds the
+    memory use no matter how uneven the clusters are. Returns the number
+    of clusters of each class in ALIGN_CLASSES.
+    """
+    # this runs in a multi-threaded ipyparallel engine, where forking can
+    # deadlock, so workers are forked from a forkserver that has imported
+    # this module (or spawned where that is not available). The slots and
+    # queues are passed to the workers when they are started.
+    try:
+        ctx = multiprocessing.get_context("forkserver")
+        ctx.set_forkserver_preload([__name__])
+    except ValueError:
+        ctx = multiprocessing.get_context("spawn")
+
+    # shared memory slots, one batch of up to ALIGN_QUEUE_BATCH bytes each
+    nslots = ALIGN_QUEUE_SLOTS * nthreads
+    slots = ctx.RawArray(ctypes.c_ubyte, nslots * ALIGN_QUEUE_BATCH)
+    buf = np.frombuffer(slots, dtype=np.uint8)
+
+    # start the aligners, each with its own muscle shell
+    args = (
+        ALIGN_QUEUE_BATCH,
+        max_internal_indels, 
+        is_gbs, 
+        data.hackersonly.align_builtin_max_seqs,
+        data.hackersonly.align_builtin_max_indels,
+        data.hackersonly.align_builtin_validate,
+    )
+    tasks = ctx.Queue()
+    results = ctx.Queue()
+    workers = [
+        ctx.Process(
+            target=align_queue_worker, args=(tasks, results, slots, args))
+        for _ in range(nthreads)
+    ]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
 
-def persistent_popen_align3(clusts, maxseqs=200, is_gbs=False):
-    "keeps a persistent bash shell open and feeds it muscle alignments"
-
-    # create a separate shell for running muscle in, this is much faster
-    # than spawning a separate subprocess for each muscle call
+    # feed batches while slots are free, write results in order
+    clustfile = os.path.join(data.dirs.clusts, sample.name + ".clust.txt")
+    sample.files.clusters = os.path.join(
+        data.dirs.clusts, sample.name + ".clustS.gz")
+    batches = iter_cluster_batches(clustfile, ALIGN_QUEUE_BATCH)
+    free = list(range(nslots))
+    inflight = {}
+    written = {}
+    validations = []
+    counts = np.zeros(len(ALIGN_CLASSES), dtype=np.int64)
+    try:
+        with gzip.open(sample.files.clusters, 'wb') as out:
+            bidx = 0
+            nextidx = 0
+            batch = next(batches, None)
+            while batch is not None or inflight:
+
+                # a batch larger than a slot is sent through the queue 
+                while batch is not None and free:
+                    slot = free.pop()
+                    if len(batch) <= ALIGN_QUEUE_BATCH:
+                        start = slot * ALIGN_QUEUE_BATCH
+                        buf[start:start + len(batch)] = np.frombuffer(
+                            batch, dtype=np.uint8)
+                        tasks.put((bidx, slot, len(batch), None))
+                    else:
+                        tasks.put((bidx, slot, len(batch), batch))
+                    inflight[bidx] = slot
+                    bidx += 1
+                    batch = next(batches, None)
+
+                # store the next result and write any that are next in order
+                ridx, text, rcounts, valids = get_queued_result(
+                    results, workers)
+                written[ridx] = text
+                counts += rcounts
+                validations.extend(valids)
+                while nextidx in written:
+                    out.write(written.pop(nextidx))
+                    free.append(inflight.pop(nextidx))
+                    nextidx += 1
+    finally:
+        for worker in workers:
+            tasks.put(None)
+        for worker in workers:
+            worker.join(5)
+            if worker.is_alive():
+                worker.terminate()
+
+    # validations of the builtin aligner (align_builtin_validate)
+    if validations:
+        validfile = os.path.join(
+            data.dirs.clusts, sample.name + ".align_validation.txt")
+        with open(validfile, 'w') as out:
+            out.write("\t".join(ALIGN_VALIDATION_FIELDS) + "\n")
+            for row in validations:
+                out.write("\t".join(str(i) for i in row) + "\n")
+    return counts
+
+
+def align_queue_worker(tasks, results, slots, args):
+    """
+    Aligner process of align_queued(). Takes (index, slot, size, batch) 
+    tasks until None, reads the batch from its shared memory slot (or the
+    task if too large for a slot), aligns and filters it by align_chunk, 
+    and puts (index, aligned bytes, counts, validations) on the results 
+    queue, or (-1, traceback, None, []) on error.
+    """
+    slotsize, max_internal_indels, is_gbs, maxseqs, maxindels, validate = args
+    buf = np.frombuffer(slots, dtype=np.uint8)
     proc = sps.Popen(
         ["bash"],
         stdin=sps.PIPE,
         stdout=sps.PIPE,
         bufsize=0,
     )
+    try:
+        while 1:
+            task = tasks.get()
+            if task is None:
+                break
+            bidx, slot, size, batch = task
+            if batch is None:
+                start = slot * slotsize
+                batch = buf[start:start + size].tobytes()
+
+            # the validation sample is seeded by batch to be reproducible
+            validations = []
+            refined, counts = align_chunk(
+                batch, max_internal_indels, is_gbs, maxseqs, maxindels, 
+                validate, validations, proc, ALIGN_VALIDATE_SEED + bidx)
+            text = ""
+            if refined:
+                text = "\n//\n//\n".join(refined) + "\n//\n//\n"
+            results.put((bidx, text.encode(), counts, validations))
+
+    except Exception:
+        results.put((-1, traceback.format_exc(), None, []))
+
+    finally:
+        proc.stdout.close()
+        proc.stdin.close()
+        proc.wait()
+
+
+def get_queued_result(results, workers):
+    "returns the next result of align_queue_worker, raises worker errors"
+    while 1:
+        try:
+            result = results.get(timeout=1)
+        except queue.Empty:
+            if any(i.exitcode not in (None, 0) for i in workers):
+                raise IPyradError("alignment worker exited unexpectedly")
+            continue
+        if result[0] < 0:
+            raise IPyradError(result[1])
+        return result
+
+
+def iter_cluster_batches(clustfile, batchsize):
+    """
+    yields batches of whole clusters (as in chunk files) of up to batchsize
+    bytes, or of one cluster if it alone is larger.
+    """
+    batch = []
+    size = 0
+    for clust in iter_clusters(clustfile):
+        clust = (clust + "//\n//\n").encode()
+        if batch and size + len(clust) > batchsize:
+            yield b"".join(batch)
+            batch = []
+            size = 0
+        batch.append(clust)
+        size += len(clust)
+    if batch:
+        yield b"".join(batch)
+
+
+def persistent_popen_align3(
+    clusts, maxseqs=200, is_gbs=False, builtin_max_seqs=0, 
+    builtin_max_indels=3, validate=0, validations=None, proc=None,
+    seed=None):
+    """
+    Keeps a persistent bash shell open and feeds it muscle alignments.
+    Clusters of up to builtin_max_seqs seqs (non-gbs) are aligned by the
+    builtin star aligner instead (see builtin_align), unless a hit needs
+    more than builtin_max_indels indels. A 'validate' proportion of those
+    is also aligned by muscle and compared (see compare_alignments), and
+    the comparisons appended to the list 'validations', sampled by 'seed'
+    (default ALIGN_VALIDATE_SEED). An open shell can be passed as 'proc'
+    to be reused, it is then left open.
+    """
+
+    # create a separate shell for running muscle in, this is much faster
+    # than spawning a separate subprocess for each muscle call
+    shared = proc is not None
+    if not shared:
+        proc = sps.Popen(
+            ["bash"],
+            stdin=sps.PIPE,
+            stdout=sps.PIPE,
+            bufsize=0,
+        )
 
     # iterate over clusters in this file until finished
     aligned = []
+    if seed is None:
+        seed = ALIGN_VALIDATE_SEED
+    random = np.random.RandomState(seed)
     for clust in clusts:
 
-        # new alignment string for read1s and read2s
-        align1 = []
-        align2 = []
-
         # don't bother aligning if only one seq
-        if clust.count(">") == 1:
+        nseqs = clust.count(">")
+        if nseqs == 1:
             aligned.append(clust.replace(">", "").strip())
-        else:
+            continue
 
-            # do we need to split the alignment? (is there a PE insert?)
-            try:
-                # make into list (only read maxseqs lines, 2X cuz names)
-                lclust = clust.split()[:maxseqs * 2]
-
-                # try to split cluster list at nnnn separator for each read
-                lclust1 = list(chain(*zip(
-                    lclust[::2], [i.split("nnnn")[0] for i in lclust[1::2]])))
-                lclust2 = list(chain(*zip(
-                    lclust[::2], [i.split("nnnn")[1] for i in lclust[1::2]])))
-
-                # put back into strings
-                clust1 = "\n".join(lclust1)
-                clust2 = "\n".join(lclust2)
-
-                # Align the first reads.
-                # The muscle command with alignment as stdin and // as split
-                cmd1 = ("echo -e '{}' | {} -quiet -in - ; echo {}"
-                        .format(clust1, ip.bins.muscle, "//\n"))
-
-                # send cmd1 to the bash shell
-                proc.stdin.write(cmd1.encode())
-
-                # read the stdout by line until splitter is reached
-                # meaning that the alignment is finished.
-                for line in iter(proc.stdout.readline, b'//\n'):
-                    align1.append(line.decode())
-
-                # Align the second reads.
-                # The muscle command with alignment as stdin and // as split
-                cmd2 = ("echo -e '{}' | {} -quiet -in - ; echo {}"
-                        .format(clust2, ip.bins.muscle, "//\n"))
-
-                # send cmd2 to the bash shell
-                proc.stdin.write(cmd2.encode())
-
-                # read the stdout by line until splitter is reached
-                # meaning that the alignment is finished.
-                for line in iter(proc.stdout.readline, b'//\n'):
-                    align2.append(line.decode())
-
-                # join up aligned read1 and read2 and ensure names order match
-                lines1 = "".join(align1)[1:].split("\n>")
-                lines2 = "".join(align2)[1:].split("\n>")
-                dalign1 = dict([i.split("\n", 1) for i in lines1])
-                dalign2 = dict([i.split("\n", 1) for i in lines2])
-
-                # sort the first reads
-                keys = list(dalign1.keys())
-                seed = [i for i in keys if i[-1] == "*"][0]
-                keys.pop(keys.index(seed))
-                order = [seed] + sorted(
-                    keys, key=get_derep_num, reverse=True)                
-
-                # combine in order
-                alignpe = []                
-                for key in order:
-                    alignpe.append("\n".join([
-                        key, 
-                        dalign1[key].replace("\n", "") + "nnnn" + \
-                        dalign2[key].replace("\n", "")]))
-
-                # append aligned cluster string
-                aligned.append("\n".join(alignpe).strip())
-
-            # Malformed clust. Dictionary creation with only 1 element 
-            except ValueError as inst:
-                print("Bad PE cluster - {}\nla1 - {}\nla2 - {}"
-                      .format(clust, lines1, lines2)
-                      )
-
-            ## Either reads are SE, or at least some pairs are merged.
-            except IndexError:
-
-                # limit the number of input seqs
-                # use lclust already built before checking pairs
-                lclust = "\n".join(clust.split()[:maxseqs * 2])
-
-                # the muscle command with alignment as stdin and // as splitter
-                cmd = ("echo -e '{}' | {} -quiet -in - ; echo {}"
-                       .format(lclust, ip.bins.muscle, "//\n"))
-
-                ## send cmd to the bash shell (TODO: PIPE could overflow here!)
-                proc.stdin.write(cmd.encode())
-
-                ## read the stdout by line until // is reached. This BLOCKS.
-                for line in iter(proc.stdout.readline, b'//\n'):
-                    align1.append(line.decode())
-
-                ## remove '>' from names, and '\n' from inside long seqs                
-                lines = "".join(align1)[1:].split("\n>")
-
-                ## find seed of the cluster and put it on top.
-                #seed = [i for i in lines if i.split(";")[-1][0] == "*"][0]
-                seed = [i for i in lines if i.split('\n')[0][-1] == "*"][0]
-                lines.pop(lines.index(seed))
-                lines = [seed] + sorted(
-                    lines, key=get_derep_num, reverse=True)
-
-                ## format remove extra newlines from muscle
-                aa = [i.split("\n", 1) for i in lines]
-                align1 = [i[0] + '\n' + "".join([j.replace("\n", "")
-                          for j in i[1:]]) for i in aa]
-
-                # trim edges in sloppy gbs/ezrad data.
-                # Maybe relevant to other types too...
-                if is_gbs:
-                    align1 = gbs_trim(align1)
-
-                ## append to aligned
-                aligned.append("\n".join(align1))
+        # small clusters by the builtin aligner, unless too many indels
+        if nseqs <= builtin_max_seqs and not is_gbs:
+            align = builtin_align(clust, builtin_max_indels)
+            if align is not None:
+                aligned.append(align)
+                if validate and random.random_sample() < validate:
+                    check = muscle_align(proc, clust, maxseqs, is_gbs)
+                    if check is not None:
+                        validations.append(compare_alignments(align, check))
+                continue
+
+        # muscle alignment, skipping malformed clusters
+        align = muscle_align(proc, clust, maxseqs, is_gbs)
+        if align is not None:
+            aligned.append(align)
 
     # cleanup
+    if shared:
+        return aligned
     proc.stdout.close()
     if proc.stderr:
         proc.stderr.close()
@@ -1588,6 +2352,355 @@ def persistent_popen_align3(clusts, maxseqs=200, is_gbs=False):
     return aligned
 
 
+def builtin_align(clust, maxindels=3):
+    """
+    Star alignment of a (small) cluster: each hit is aligned to the seed by
+    a banded global alignment with free end gaps (see _band_align) and the
+    pairwise alignments are merged by padding the insertions of each hit 
+    to the longest at that position of the seed. PE reads are split at the
+    nnnn separator and each read aligned, as in muscle_align. Returns the 
+    aligned cluster in the same format, or None if a hit needs more than 
+    maxindels internal indels, so it can be aligned by muscle instead.
+    """
+    lines = clust.strip().split("\n")
+    names = [i[1:] for i in lines[0::2]]
+    seqs = lines[1::2]
+
+    # align each read of PE data, or SE and merged reads as is
+    if all("nnnn" in i for i in seqs):
+        reads = [
+            [i.split("nnnn")[0] for i in seqs], 
+            [i.split("nnnn")[1] for i in seqs],
+        ]
+    else:
+        reads = [seqs]
+
+    aligns = []
+    for rseqs in reads:
+        align = star_align(rseqs, maxindels)
+        if align is None:
+            return None
+        aligns.append(align)
+    rows = list(zip(names, ["nnnn".join(i) for i in zip(*aligns)]))
+
+    # seed on top and hits by decreasing size
+    rows = [rows[0]] + sorted(
+        rows[1:], key=lambda x: get_derep_num(x[0]), reverse=True)
+    return "\n".join("{}\n{}".format(*i) for i in rows)
+
+
+def star_align(seqs, maxindels):
+    """
+    Returns the seqs aligned to the first seq (the seed) by builtin_align,
+    or None if a seq needs more than maxindels internal indels.
+    """
+    seed = np.frombuffer(seqs[0].encode(), dtype=np.uint8)
+    inserts = np.zeros(seed.size + 1, dtype=np.int64)
+    pairs = []
+    for seq in seqs[1:]:
+        hit = np.frombuffer(seq.encode(), dtype=np.uint8)
+        aseed, ahit, nindels = _band_align(seed, hit, 2 * maxindels + 1)
+        if nindels < 0 or nindels > maxindels:
+            return None
+        _max_inserts(aseed, inserts)
+        pairs.append((aseed, ahit))
+
+    # the seed padded for all insertions, then each hit
+    width = seed.size + inserts.sum()
+    aligned = [_star_row(seed, seed, inserts, width).tobytes().decode()]
+    for aseed, ahit in pairs:
+        aligned.append(
+            _star_row(aseed, ahit, inserts, width).tobytes().decode())
+    return aligned
+
+
+def compare_alignments(builtin, muscle):
+    """
+    Compares the builtin and muscle alignments of a cluster. Returns the
+    seed name, the number of seqs, whether the alignments are identical, 
+    and for each the number of columns, of variable columns, and of 
+    internal indels (see ALIGN_VALIDATION_FIELDS).
+    """
+    stats = []
+    for align in (builtin, muscle):
+        lines = align.split("\n")
+        seqs = [i.upper() for i in lines[1::2]]
+        ncols = max(len(i) for i in seqs)
+        nvar = 0
+        for col in range(ncols):
+            bases = set(i[col] for i in seqs if col < len(i)) - set("-N")
+            nvar += len(bases) > 1
+        nindels = sum(
+            i.replace("nnnn", "").strip("-").count("-") for i in lines[1::2])
+        stats.extend([ncols, nvar, nindels])
+    lines = builtin.split("\n")
+    return [lines[0], len(lines) // 2, int(builtin == muscle)] + stats
+
+
+@njit
+def _band_align(seed, hit, band):
+    """
+    Global alignment of hit to seed within a band around the diagonal, 
+    with free end gaps at the 3' ends. Costs are 1 for mismatches (Ns 
+    match anything) and 2 for gaps. Returns the aligned seed and hit 
+    (uint8, gaps are '-') and the number of internal indels, or -1 if 
+    the alignment does not fit in the band.
+    """
+    nrow = hit.size
+    ncol = seed.size
+    width = 2 * band + 1
+    big = 1 << 30
+    score = np.full((nrow + 1, width), big, dtype=np.int64)
+    trace = np.zeros((nrow + 1, width), dtype=np.uint8)
+
+    # cell (i, j) is stored at [i, j - i + band]
+    for i in range(nrow + 1):
+        for j in range(max(0, i - band), min(ncol, i + band) + 1):
+            col = j - i + band
+            if i == 0 and j == 0:
+                score[0, col] = 0
+                continue
+            best = big
+            move = 0
+            if i and j:
+                base1 = hit[i - 1] & 0xDF
+                base2 = seed[j - 1] & 0xDF
+                cost = 0
+                if base1 != base2 and base1 != 78 and base2 != 78:
+                    cost = 1
+                best = score[i - 1, col] + cost
+            if i and col + 1 < width and score[i - 1, col + 1] + 2 < best:
+                best = score[i - 1, col + 1] + 2
+                move = 1
+            if j and col and score[i, col - 1] + 2 < best:
+                best = score[i, col - 1] + 2
+                move = 2
+            score[i, col] = best
+            trace[i, col] = move
+
+    # best end cell in the last row or column
+    endi = -1
+    endj = -1
+    best = big
+    for j in range(max(0, nrow - band), min(ncol, nrow + band) + 1):
+        if score[nrow, j - nrow + band] < best:
+            best = score[nrow, j - nrow + band]
+            endi, endj = nrow, j
+    for i in range(max(0, ncol - band), min(nrow, ncol + band) + 1):
+        if score[i, ncol - i + band] < best:
+            best = score[i, ncol - i + band]
+            endi, endj = i, ncol
+    if endi < 0:
+        return np.zeros(0, np.uint8), np.zeros(0, np.uint8), -1
+
+    # the free end gaps, then trace back (the alignment is built reversed)
+    aseed = np.empty(nrow + ncol, dtype=np.uint8)
+    ahit = np.empty(nrow + ncol, dtype=np.uint8)
+    pos = 0
+    for j in range(ncol - 1, endj - 1, -1):
+        aseed[pos] = seed[j]
+        ahit[pos] = 45
+        pos += 1
+    for i in range(nrow - 1, endi - 1, -1):
+        aseed[pos] = 45
+        ahit[pos] = hit[i]
+        pos += 1
+    i = endi
+    j = endj
+    while i or j:
+        move = trace[i, j - i + band]
+        if i and j and move == 0:
+            i -= 1
+            j -= 1
+            aseed[pos] = seed[j]
+            ahit[pos] = hit[i]
+        elif i and (move == 1 or not j):
+            i -= 1
+            aseed[pos] = 45
+            ahit[pos] = hit[i]
+        else:
+            j -= 1
+            aseed[pos] = seed[j]
+            ahit[pos] = 45
+        pos += 1
+    aseed = aseed[:pos][::-1].copy()
+    ahit = ahit[:pos][::-1].copy()
+
+    # count the indels inside of both aligned seqs
+    nindels = 0
+    for aseq in (aseed, ahit):
+        start = 0
+        while start < pos and aseq[start] == 45:
+            start += 1
+        stop = pos
+        while stop > start and aseq[stop - 1] == 45:
+            stop -= 1
+        for idx in range(start, stop):
+            nindels += aseq[idx] == 45
+    return aseed, ahit, nindels
+
+
+@njit
+def _max_inserts(aseed, inserts):
+    "updates the max number of insertions before each position of the seed"
+    pos = 0
+    count = 0
+    for idx in range(aseed.size):
+        if aseed[idx] == 45:
+            count += 1
+        else:
+            inserts[pos] = max(inserts[pos], count)
+            pos += 1
+            count = 0
+    inserts[pos] = max(inserts[pos], count)
+
+
+@njit
+def _star_row(aseed, ahit, inserts, width):
+    """
+    Returns the row of a hit in the star alignment from its alignment to
+    the seed, padding its insertions before each seed position with gaps.
+    """
+    row = np.full(width, 45, dtype=np.uint8)
+    out = 0
+    pos = 0
+    count = 0
+    for idx in range(aseed.size):
+        if aseed[idx] == 45:
+            row[out + count] = ahit[idx]
+            count += 1
+        else:
+            row[out + inserts[pos]] = ahit[idx]
+            out += inserts[pos] + 1
+            pos += 1
+            count = 0
+    return row
+
+
+def muscle_align(proc, clust, maxseqs=200, is_gbs=False):
+    """
+    Aligns a cluster with muscle in the persistent bash shell 'proc', 
+    splitting PE reads at the nnnn separator and aligning each read. 
+    Returns the aligned cluster, or None if it is a malformed PE cluster.
+    """
+    # new alignment string for read1s and read2s
+    align1 = []
+    align2 = []
+
+    # do we need to split the alignment? (is there a PE insert?)
+    try:
+        # make into list (only read maxseqs lines, 2X cuz names)
+        lclust = clust.split()[:maxseqs * 2]
+
+        # try to split cluster list at nnnn separator for each read
+        lclust1 = list(chain(*zip(
+            lclust[::2], [i.split("nnnn")[0] for i in lclust[1::2]])))
+        lclust2 = list(chain(*zip(
+            lclust[::2], [i.split("nnnn")[1] for i in lclust[1::2]])))
+
+        # put back into strings
+        clust1 = "\n".join(lclust1)
+        clust2 = "\n".join(lclust2)
+
+        # Align the first reads.
+        # The muscle command with alignment as stdin and // as split
+        cmd1 = ("echo -e '{}' | {} -quiet -in - ; echo {}"
+                .format(clust1, ip.bins.muscle, "//\n"))
+
+        # send cmd1 to the bash shell
+        proc.stdin.write(cmd1.encode())
+
+        # read the stdout by line until splitter is reached
+        # meaning that the alignment is finished.
+        for line in iter(proc.stdout.readline, b'//\n'):
+            align1.append(line.decode())
+
+        # Align the second reads.
+        # The muscle command with alignment as stdin and // as split
+        cmd2 = ("echo -e '{}' | {} -quiet -in - ; echo {}"
+                .format(clust2, ip.bins.muscle, "//\n"))
+
+        # send cmd2 to the bash shell
+        proc.stdin.write(cmd2.encode())
+
+        # read the stdout by line until splitter is reached
+        # meaning that the alignment is finished.
+        for line in iter(proc.stdout.readline, b'//\n'):
+            align2.append(line.decode())
+
+        # join up aligned read1 and read2 and ensure names order match
+        lines1 = "".join(align1)[1:].split("\n>")
+        lines2 = "".join(align2)[1:].split("\n>")
+        dalign1 = dict([i.split("\n", 1) for i in lines1])
+        dalign2 = dict([i.split("\n", 1) for i in lines2])
+
+        # sort the first reads
+        keys = list(dalign1.keys())
+        seed = [i for i in keys if i[-1] == "*"][0]
+        keys.pop(keys.index(seed))
+        order = [seed] + sorted(
+            keys, key=get_derep_num, reverse=True)                
+
+        # combine in order
+        alignpe = []                
+        for key in order:
+            alignpe.append("\n".join([
+                key, 
+                dalign1[key].replace("\n", "") + "nnnn" + \
+                dalign2[key].replace("\n", "")]))
+
+        # return aligned cluster string
+        return "\n".join(alignpe).strip()
+
+    # Malformed clust. Dictionary creation with only 1 element 
+    except ValueError as inst:
+        print("Bad PE cluster - {}\nla1 - {}\nla2 - {}"
+              .format(clust, lines1, lines2)
+              )
+        return None
+
+    ## Either reads are SE, or at least some pairs are merged.
+    except IndexError:
+
+        # limit the number of input seqs
+        # use lclust already built before checking pairs
+        lclust = "\n".join(clust.split()[:maxseqs * 2])
+
+        # the muscle command with alignment as stdin and // as splitter
+        cmd = ("echo -e '{}' | {} -quiet -in - ; echo {}"
+               .format(lclust, ip.bins.muscle, "//\n"))
+
+        ## send cmd to the bash shell (TODO: PIPE could overflow here!)
+        proc.stdin.write(cmd.encode())
+
+        ## read the stdout by line until // is reached. This BLOCKS.
+        for line in iter(proc.stdout.readline, b'//\n'):
+            align1.append(line.decode())
+
+        ## remove '>' from names, and '\n' from inside long seqs                
+        lines = "".join(align1)[1:].split("\n>")
+
+        ## find seed of the cluster and put it on top.
+        #seed = [i for i in lines if i.split(";")[-1][0] == "*"][0]
+        seed = [i for i in lines if i.split('\n')[0][-1] == "*"][0]
+        lines.pop(lines.index(seed))
+        lines = [seed] + sorted(
+            lines, key=get_derep_num, reverse=True)
+
+        ## format remove extra newlines from muscle
+        aa = [i.split("\n", 1) for i in lines]
+        align1 = [i[0] + '\n' + "".join([j.replace("\n", "")
+                  for j in i[1:]]) for i in aa]
+
+        # trim edges in sloppy gbs/ezrad data.
+        # Maybe relevant to other types too...
+        if is_gbs:
+            align1 = gbs_trim(align1)
+
+        ## return aligned cluster string
+        return "\n".join(align1)
+
+
 def aligned_indel_filter(clust, max_internal_indels):
     """ checks for too many internal indels in muscle aligned clusters """
 
@@ -1687,13 +2800,28 @@ def index_ref_with_bwa(data, alt=False):
                 "fasta file. The path you entered was not found: \n{}")
                 .format(data.params.assembly_method))
 
+    # index into the reference cache, once for all assemblies using it
+    bundle = get_ref_bundle(data, alt)
+    if bundle:
+        prefix = os.path.join(bundle, "reference.fa")
+        build_ref_cached(
+            bundle, "bwa", lambda: run_bwa_index(refseq_file, prefix))
+        return
+
     # If reference sequence already exists then bail out of this func
     index_files = [".amb", ".ann", ".bwt", ".pac", ".sa"]
     if all([os.path.isfile(refseq_file + i) for i in index_files]):
         return
+    run_bwa_index(refseq_file)
+
 
-    # bwa index <reference_file>
+def run_bwa_index(refseq_file, prefix=None):
+    "bwa index the reference, into files named by prefix if not next to it"
+
+    # bwa index [-p prefix] <reference_file>
     cmd = [ip.bins.bwa, "index", refseq_file]
+    if prefix:
+        cmd[2:2] = ["-p", prefix]
     proc = sps.Popen(cmd, stderr=sps.PIPE, stdout=None)
     error = proc.communicate()[1].decode()
 
@@ -1728,16 +2856,64 @@ def index_ref_with_sam(data, alt=False):
                 "fasta file. The path you entered was not found: \n{}")
                 .format(data.params.assembly_method))
 
+    # index into the reference cache, once for all assemblies using it,
+    # and put the cached .fai next to the reference where later steps read
+    # it, replacing any stale one.
+    bundle = get_ref_bundle(data, alt)
+    if bundle:
+        cached = os.path.join(bundle, "reference.fa.fai")
+        build_ref_cached(
+            bundle, "faidx", lambda: run_faidx(refseq_file, bundle))
+        with open(cached, 'rb') as infile:
+            fai = infile.read()
+        current = b""
+        if os.path.exists(refseq_file + ".fai"):
+            with open(refseq_file + ".fai", 'rb') as infile:
+                current = infile.read()
+        # a unique temp file so assemblies sharing the reference do not
+        # write to the same one, os.replace is atomic.
+        if current != fai:
+            fd, tmpfile = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(refseq_file)),
+                prefix=os.path.basename(refseq_file) + ".fai.")
+            try:
+                with os.fdopen(fd, 'wb') as out:
+                    out.write(fai)
+                os.chmod(tmpfile, 0o644)
+                os.replace(tmpfile, refseq_file + ".fai")
+            except BaseException:
+                if os.path.exists(tmpfile):
+                    os.remove(tmpfile)
+                raise
+        return
+
     # If reference index exists then bail out unless force
     if os.path.exists(refseq_file + ".fai"):
         return
+    run_faidx(refseq_file)
+
 
+def run_faidx(refseq_file, bundle=None):
+    """
+    samtools faidx the reference, and store the .fai and the chrom names 
+    and lengths (chroms.json, see chroms2ints) in a reference cache bundle.
+    """
     # complain if file is bzipped
     if refseq_file.endswith(".gz"):
         raise IPyradError("You must decompress your genome file.") 
 
     # index the file
     pysam.faidx(refseq_file)
+    if bundle:
+        shutil.copyfile(
+            refseq_file + ".fai", os.path.join(bundle, "reference.fa.fai"))
+        with open(refseq_file + ".fai") as infile:
+            rows = [i.split("\t") for i in infile if i.strip()]
+        with open(os.path.join(bundle, "chroms.json"), 'w') as out:
+            json.dump({
+                "chroms": [i[0] for i in rows],
+                "lengths": [int(i[1]) for i in rows],
+            }, out)
 
 
 def mapping_reads(data, sample, nthreads, altref=False):
@@ -1894,12 +3070,18 @@ def mapping_reads(data, sample, nthreads, altref=False):
     if not infiles:
         raise IPyradError("derep files not found")
 
+    # the bwa index is in the reference cache if one is used
+    bundle = get_ref_bundle(data, altref)
+    refindex = reference
+    if bundle:
+        refindex = os.path.join(bundle, "reference.fa")
+
     # command string for mapping
     cmd1 = [
         ip.bins.bwa, "mem",
         "-t", str(max(1, nthreads)),
         "-M",
-        reference,
+        refindex,
     ]
     cmd1 += infiles
 
@@ -1909,12 +3091,6 @@ def mapping_reads(data, sample, nthreads, altref=False):
     for arg in bwa_args:
         cmd1.insert(2, arg)
 
-    with open(samout, 'wb') as outfile:
-        proc1 = sps.Popen(cmd1, stderr=None, stdout=outfile)
-        error1 = proc1.communicate()[0]
-        if proc1.returncode:
-            raise IPyradError("bwa error: {}".format(error1))
-
     # sends unmapped reads to a files and will PIPE mapped reads to cmd3
     cmd2 = [
         ip.bins.samtools, "view",
@@ -1965,16 +3141,37 @@ def mapping_reads(data, sample, nthreads, altref=False):
         cmd5.insert(2, ufastqout)
         cmd5.insert(2, "-0")
 
-    # cmd2 writes to sname.unmapped.bam and fills pipe with mapped BAM data
-    proc2 = sps.Popen(cmd2, stderr=sps.STDOUT, stdout=sps.PIPE)
+    # piped mode: bwa | view | sort (uncompressed between them) with sort
+    # using nthreads and the sort memory per thread, while view sends the
+    # unmapped reads through a fifo to bam2fq, all in one pass. 
+    if data.hackersonly.mapping_piped:
+        cmd2[-1] = "-"
+        cmd2.insert(2, "-u")
+        cmd2[cmd2.index(ubamout)] = ubamout + ".fifo"
+        cmd3[2:2] = [
+            "-@", str(max(1, nthreads)),
+            "-m", data.hackersonly.samtools_sort_memory,
+        ]
+        cmd5[-1] = ubamout + ".fifo"
+        run_mapping_pipe(cmd1, cmd2, cmd3, cmd5, ubamout + ".fifo")
 
-    # cmd3 pulls mapped BAM from pipe and writes to sname.mapped-sorted.bam
-    proc3 = sps.Popen(
-        cmd3, stderr=sps.STDOUT, stdout=sps.PIPE, stdin=proc2.stdout)
-    error3 = proc3.communicate()[0]
-    if proc3.returncode:
-        raise IPyradError(error3)
-    proc2.stdout.close()
+    else:
+        with open(samout, 'wb') as outfile:
+            proc1 = sps.Popen(cmd1, stderr=None, stdout=outfile)
+            error1 = proc1.communicate()[0]
+            if proc1.returncode:
+                raise IPyradError("bwa error: {}".format(error1))
+
+        # cmd2 writes to sname.unmapped.bam and fills pipe with mapped BAM
+        proc2 = sps.Popen(cmd2, stderr=sps.STDOUT, stdout=sps.PIPE)
+
+        # cmd3 pulls mapped BAM from pipe and writes to mapped-sorted.bam
+        proc3 = sps.Popen(
+            cmd3, stderr=sps.STDOUT, stdout=sps.PIPE, stdin=proc2.stdout)
+        error3 = proc3.communicate()[0]
+        if proc3.returncode:
+            raise IPyradError(error3)
+        proc2.stdout.close()
 
     # cmd4 indexes the bam file
     proc4 = sps.Popen(cmd4, stderr=sps.STDOUT, stdout=sps.PIPE)
@@ -1984,20 +3181,70 @@ def mapping_reads(data, sample, nthreads, altref=False):
 
     # Running cmd5 writes to either edits/sname-refmap_derep.fa for SE
     # or it makes edits/sname-tmp-umap{12}.fastq for paired data, which
-    # will then need to be merged.
-    proc5 = sps.Popen(cmd5, stderr=sps.STDOUT, stdout=sps.PIPE)
-    error5 = proc5.communicate()[0]
-    if proc5.returncode:
-        raise IPyradError(error5)
+    # will then need to be merged. (Already done if piped.)
+    if not data.hackersonly.mapping_piped:
+        proc5 = sps.Popen(cmd5, stderr=sps.STDOUT, stdout=sps.PIPE)
+        error5 = proc5.communicate()[0]
+        if proc5.returncode:
+            raise IPyradError(error5)
+
 
+def run_mapping_pipe(cmd1, cmd2, cmd3, cmd5, fifo):
+    """
+    Runs the mapping commands of mapping_reads() as one pipeline, bwa (cmd1)
+    | samtools view (cmd2) | samtools sort (cmd3), where view writes the 
+    unmapped reads (-U) to a fifo read by samtools bam2fq (cmd5) at the 
+    same time, so no sam or unmapped bam file is written.
+    """
+    if os.path.exists(fifo):
+        os.remove(fifo)
+    os.mkfifo(fifo)
+
+    # logs are files, not pipes, so no process blocks on a full pipe
+    logs = [tempfile.TemporaryFile() for i in range(3)]
+    procs = []
+    try:
+        procs.append(sps.Popen(cmd5, stderr=sps.STDOUT, stdout=logs[0]))
+        procs.append(sps.Popen(cmd1, stderr=None, stdout=sps.PIPE))
+        procs.append(sps.Popen(
+            cmd2, stderr=logs[1], stdout=sps.PIPE, stdin=procs[1].stdout))
+        procs[1].stdout.close()
+        procs.append(sps.Popen(
+            cmd3, stderr=sps.STDOUT, stdout=logs[2], stdin=procs[2].stdout))
+        procs[2].stdout.close()
+        for proc in procs[1:]:
+            proc.wait()
+
+        # bam2fq never gets the fifo if view failed before opening it
+        if procs[2].returncode:
+            procs[0].kill()
+        procs[0].wait()
+
+    except BaseException:
+        for proc in procs:
+            proc.kill()
+        raise
+    finally:
+        os.remove(fifo)
+
+    # check for errors in pipeline order
+    bam2fq, bwa, view, sort = procs
+    if bwa.returncode:
+        raise IPyradError("bwa error: {}".format(bwa.returncode))
+    for proc, log in [(view, logs[1]), (sort, logs[2]), (bam2fq, logs[0])]:
+        if proc.returncode:
+            log.seek(0)
+            raise IPyradError(log.read().decode())
+    for log in logs:
+        log.close()
 
 
 def check_insert_size(data, sample):
     """
     check mean insert size for this sample and update 
     hackersonly.max_inner_mate_distance if need be. This value controls how 
-    far apart mate pairs can be to still be considered for bedtools merging 
-    downstream.
+    far apart mate pairs can be to still be considered for merging into
+    regions downstream (see get_ref_regions).
     """
 
     # read in the sorted bam file and extract SN stats
@@ -2054,80 +3301,161 @@ def check_insert_size(data, sample):
         data.hackersonly.max_inner_mate_distance = 300
 
 
-def bedtools_merge(data, sample):
+def get_ref_regions(data, sample):
     """
-    Get all contiguous genomic regions with one or more overlapping
-    reads. This is the shell command we'll eventually run
-
-    bedtools bamtobed -i 1A_0.sorted.bam | bedtools merge [-d 100]
-        -i <input_bam>  :   specifies the input file to bed'ize
-        -d <int>        :   For PE set max distance between reads
+    Get all contiguous genomic regions with one or more overlapping reads,
+    the same as `bedtools bamtobed | bedtools merge [-d]`. The alignment 
+    starts and ends are streamed from the sorted bam by pysam and merged 
+    in one pass. For PE data reads up to max_inner_mate_distance apart 
+    (see check_insert_size) are merged. Returns {chrom: int64 array of 
+    0-based (start, end) rows} in bam order. Regions are cached next to 
+    the bam (see load_ref_regions) so re-runs and shards reuse them.
     """
     mappedreads = os.path.join(
         data.dirs.refmapping,
         "{}-mapped-sorted.bam".format(sample.name))
+    cache = mappedreads.rsplit(".", 1)[0] + ".regions.npz"
 
-    # command to call `bedtools bamtobed`, and pipe output to stdout
-    # Usage:   bedtools bamtobed [OPTIONS] -i <bam>
-    # Usage:   bedtools merge [OPTIONS] -i <bam>
-    cmd1 = [ip.bins.bedtools, "bamtobed", "-i", mappedreads]
-    cmd2 = [ip.bins.bedtools, "merge", "-i", "-"]
-
-    # If PE the -d flag to tell bedtools how far apart to allow mate pairs.
-    # If SE the -d flag is negative, specifying that SE reads need to
-    # overlap by at least a specific number of bp. This prevents the
-    # stairstep syndrome when a + and - read are both extending from
-    # the same cutsite. Passing a negative number to `merge -d` gets this done.
-    # +++ scrath the above, we now deal with step ladder data
+    # SE reads must overlap (or be book-ended) to be merged. PE reads can 
+    # be the max inner mate distance apart, which is estimated if None.
+    distance = 0
     if 'pair' in data.params.datatype:
+        distance = data.hackersonly.max_inner_mate_distance
+
+    # reuse cached regions of this bam if merged with the same distance
+    estimated = distance is None
+    cached = load_ref_regions(cache, mappedreads, distance)
+    if cached is not None:
+        regions, distance = cached
+        if estimated:
+            data.hackersonly.max_inner_mate_distance = distance
+        return regions
+    if estimated:
+        check_insert_size(data, sample)
+        distance = data.hackersonly.max_inner_mate_distance
+    distance = int(distance)
+
+    # merge reads by their alignment starts and ends
+    regions = {}
+    with pysam.AlignmentFile(mappedreads, 'rb') as bamfile:
+        for chrom in bamfile.references:
+            merged = []
+            rstart = rend = -1
+            for read in bamfile.fetch(chrom):
+                if read.is_unmapped or read.reference_end is None:
+                    continue
+                if rend < 0 or read.reference_start > rend + distance:
+                    if rend >= 0:
+                        merged.append((rstart, rend))
+                    rstart = read.reference_start
+                    rend = read.reference_end
+                else:
+                    rend = max(rend, read.reference_end)
+            if rend >= 0:
+                merged.append((rstart, rend))
+            if merged:
+                regions[chrom] = np.array(merged, dtype=np.int64)
+
+    # cache regions, keyed by the bam size and mtime, and the distance
+    stat = os.stat(mappedreads)
+    with open(cache + ".tmp", 'wb') as out:
+        np.savez(
+            out,
+            key=np.array(
+                [stat.st_size, stat.st_mtime_ns, distance, estimated], 
+                dtype=np.int64),
+            chroms=np.array(list(regions), dtype=str),
+            counts=np.array([len(i) for i in regions.values()], dtype=np.int64),
+            regions=np.concatenate(
+                list(regions.values()) or [np.zeros((0, 2), dtype=np.int64)]),
+        )
+    os.replace(cache + ".tmp", cache)
+    return regions
 
-        # default is to use a reasonable value based on Illumina
-        # so the hackersonly default is 500bp. The user can either override
-        # this setting by changing the hacker setting, OR, if they want, 
-        # they can set it to None and have it estimated and updated here.
-        if data.hackersonly.max_inner_mate_distance is None:
-            check_insert_size(data, sample)
-
-        # tell bedtools to use the stored value.
-        cmd2.insert(2, str(data.hackersonly.max_inner_mate_distance))
-        cmd2.insert(2, "-d")
-    #else:
-    #    cmd2.insert(2, str(-1 * data._hackersonly["min_SE_refmap_overlap"]))
-    #    cmd2.insert(2, "-d")
 
-    # pipe output from bamtobed into merge
-    proc1 = sps.Popen(cmd1, stderr=sps.STDOUT, stdout=sps.PIPE)
-    proc2 = sps.Popen(cmd2, stderr=sps.STDOUT, stdout=sps.PIPE, stdin=proc1.stdout)
-    result = proc2.communicate()[0].decode()
-    proc1.stdout.close()
+def load_ref_regions(cache, mappedreads, distance):
+    """
+    Returns (regions, distance) from the regions cache of get_ref_regions 
+    if it is from this bam and was merged with this distance, or with an 
+    estimated distance if distance is None. Else returns None.
+    """
+    if not os.path.exists(cache):
+        return None
+    stat = os.stat(mappedreads)
+    with np.load(cache) as cached:
+        size, mtime, cdistance, estimated = cached["key"]
+        if (size, mtime) != (stat.st_size, stat.st_mtime_ns):
+            return None
+        if distance != cdistance and not (distance is None and estimated):
+            return None
+        rows = np.split(cached["regions"], np.cumsum(cached["counts"])[:-1])
+        regions = dict(zip(cached["chroms"].tolist(), rows))
+    return regions, int(cdistance)
+
+
+def iter_ref_regions(regions):
+    "yields (chrom, start, end) of regions from get_ref_regions()"
+    return chain.from_iterable(
+        ((chrom, int(i), int(j)) for (i, j) in rows) 
+        for chrom, rows in regions.items()
+    )
 
-    # check for errors and do cleanup
-    if proc2.returncode:
-        raise IPyradError("error in %s: %s", cmd2, result)
 
-    # Report the number of regions we're returning
-    # nregions = len(result.strip().split("\n"))
-    return result
+def slice_ref_regions(regions, start, stop):
+    """
+    Returns the regions (as from get_ref_regions) from the region index 
+    start to stop across chroms, as views of the rows of each chrom.
+    """
+    sliced = {}
+    offset = 0
+    for chrom, rows in regions.items():
+        first = max(start - offset, 0)
+        last = min(stop - offset, len(rows))
+        if first < last:
+            sliced[chrom] = rows[first:last]
+        offset += len(rows)
+    return sliced
+
+
+def get_ref_shards(data, sample, nshards):
+    """
+    Gets all regions with mapped reads (see get_ref_regions) and splits 
+    them into up to nshards contiguous shards of about equal numbers of 
+    regions. Returns a list of (idx, regions) shards, with the region rows
+    of each, for build_clusters_from_cigars().
+    """
+    regions = get_ref_regions(data, sample)
+
+    # no shards if no reads mapped to the reference
+    nregions = sum(len(i) for i in regions.values())
+    nshards = min(nshards, nregions)
+    if not nshards:
+        return []
+    bounds = np.linspace(0, nregions, nshards + 1).astype(int)
+    return [
+        (idx, slice_ref_regions(regions, bounds[idx], bounds[idx + 1]))
+        for idx in range(nshards)
+    ]
 
 
-def build_clusters_from_cigars(data, sample):
+def build_clusters_from_cigars(data, sample, shard=None):
     """
     Directly building clusters relative to reference. Uses the function 
-    cigared() to impute indels relative to reference. This means add - for 
-    insertion and skip* deletions. Skipping is not a good final solution.
-    """
-    # get all regions with reads. Generator to yield (str, int, int)
-    fullregions = bedtools_merge(data, sample).strip().split("\n")
-    # If no reads map to reference the fullregions will be [''], so
-    # we test for it and handle it properly. If you don't do this the regions
-    # genrator will be empty and this will raise a ValueError. This will just
-    # pass through samples without any mapped reads with a 0 length clustS file
-    if len(fullregions[0]):
-        regions_split = (i.split("\t") for i in fullregions)
-        # bedtools is 0-based. sam is 1-based, so increment the positions here
-        regions = ((i, int(j) + 1, int(k) + 1) for (i, j, k) in regions_split)
+    build_ref_cluster() to impute indels relative to reference. This means
+    add - for deletions and skip* insertions. Skipping is not a good final
+    solution. If shard is an (idx, regions) shard from get_ref_shards()
+    only its regions are built, into tmpdir/{}_clustS_{idx}.gz, to be 
+    joined by concat_ref_shards().
+    """
+    # get all regions with reads. Generator to yield (str, int, int). If 
+    # no reads map to reference this passes through samples without any 
+    # mapped reads with a 0 length clustS file.
+    if shard is None:
+        fullregions = iter_ref_regions(get_ref_regions(data, sample))
     else:
-        regions = []
+        fullregions = iter_ref_regions(shard[1])
+    # regions are 0-based. sam is 1-based, so increment the positions here
+    regions = ((i, j + 1, k + 1) for (i, j, k) in fullregions)
 
     # access reads from bam file using pysam
     bamfile = pysam.AlignmentFile(
@@ -2137,120 +3465,24 @@ def build_clusters_from_cigars(data, sample):
         'rb')
 
     # output path 
-    opath = os.path.join(
-        data.dirs.clusts, "{}.clustS.gz".format(sample.name))
+    if shard is None:
+        opath = os.path.join(
+            data.dirs.clusts, "{}.clustS.gz".format(sample.name))
+    else:
+        opath = os.path.join(
+            data.tmpdir, "{}_clustS_{}.gz".format(sample.name, shard[0]))
     out = gzip.open(opath, 'wt')
     idx = 0
 
     # iterate over all regions to build clusters
+    paired = "pair" in data.params.datatype
+    declone = data.hackersonly.declone_PCR_duplicates
     clusters = []
     for reg in regions:
         # uncomment and compare against ref sequence when testing
         # ref = get_ref_region(data.paramsdict["reference_sequence"], *reg)
         reads = bamfile.fetch(*reg)
-
-        # store reads in a dict
-        rdict = {}
-
-        # paired-end data cluster building
-        if "pair" in data.params.datatype:
-
-            # match paired reads together in a dictionary
-            for read in reads:
-                if read.qname not in rdict:
-                    rdict[read.qname] = [read, None]
-                else:
-                    rdict[read.qname][1] = read
-
-            # sort keys by derep number
-            keys = sorted(
-                rdict.keys(),
-                key=lambda x: int(x.split("=")[-1]), reverse=True)
-
-            # build the cluster based on map positions, orientation, cigar
-            clust = []
-            for key in keys:
-                r1, r2 = rdict[key]
-                if r1 and r2:
-
-                    #lref = len(ref[1])
-                    lref = reg[2] - reg[1]
-                    arr1 = np.zeros(lref, dtype="U1")
-                    arr2 = np.zeros(lref, dtype="U1")
-                    arr1.fill("-")
-                    arr2.fill("-")
-
-                    # how far ahead of the start does this read begin
-                    seq = cigared(r1.seq, r1.cigar)
-                    start = r1.reference_start - (reg[1] - 1) 
-                    arr1[start:start + len(seq)] = list(seq)
-                    seq = cigared(r2.seq, r2.cigar)
-                    start = r2.reference_start - (reg[1] - 1)
-                    arr2[start:start + len(seq)] = list(seq)
-
-                    arr3 = join_arrays(arr1, arr2)
-                    pairseq = "".join(arr3)
-
-                    ori = "+"
-                    if r1.is_reverse:
-                        ori = "-"
-                    derep = r1.qname.split("=")[-1]
-
-                    if data.hackersonly.declone_PCR_duplicates:
-                        tag = r1.qname.split(";")[-2]
-                        rname = "{}:{}-{};{};size={};{}".format(
-                            reg[0], reg[1], reg[2], tag, derep, ori,
-                        )
-                    else:
-                        rname = "{}:{}-{};size={};{}".format(
-                            reg[0], reg[1], reg[2], derep, ori,
-                        )
-                    # *reg, derep, ori)
-                    clust.append("{}\n{}".format(rname, pairseq))
-
-
-        # single-end data cluster building
-        else:   
-            mstart = int(9e12)
-            mend = 0
-
-            for read in reads:
-                rdict[read.qname] = read
-                mstart = min(mstart, read.aend - read.alen)
-                mend = max(mend, read.aend)
-
-            # sort keys by derep number
-            keys = sorted(
-                rdict.keys(),
-                key=lambda x: int(x.split("=")[-1]), reverse=True)
-
-            # build the cluster based on map positions, orientation, cigar
-            clust = []
-            for key in keys:
-                r1 = rdict[key]
-
-                #aref = np.array(list(ref[1]))
-                lref = mend - mstart
-                arr1 = np.zeros(lref, dtype="U1")
-                arr1.fill("-")
-
-                # how far ahead of the start does this read begin
-                seq = cigared(r1.seq, r1.cigar)
-                rstart = (r1.aend - r1.alen) - mstart
-                arr1[rstart:rstart + len(seq)] = list(seq)
-                aseq = "".join(arr1)
-
-                ori = "+"
-                if r1.is_reverse:
-                    ori = "-"
-                derep = r1.qname.split("=")[-1]
-                # Pysam coords are 0 based, but sam files are 1 based, and
-                # since we we build sam in step 5, we need to account for the
-                # diffrent indexing strategies here by incrementing mstart
-                # and mend
-                rname = "{}:{}-{};size={};{}".format(
-                    reg[0], mstart+1, mend+1, derep, ori)
-                clust.append("{}\n{}".format(rname, aseq))
+        clust = build_ref_cluster(reads, reg, paired, declone)
 
         # store this cluster
         if clust:
@@ -2267,6 +3499,25 @@ def build_clusters_from_cigars(data, sample):
     if clusters:
         out.write("\n//\n//\n".join(clusters) + "\n//\n//\n")
     out.close()
+    bamfile.close()
+
+
+def concat_ref_shards(data, sample, nshards):
+    """
+    Concatenates the gzip outputs of the shards of build_clusters_from_cigars
+    in order into the clustS file, a valid multi-member gzip file.
+    """
+    opath = os.path.join(
+        data.dirs.clusts, "{}.clustS.gz".format(sample.name))
+    with open(opath, 'wb') as out:
+        if not nshards:
+            out.write(gzip.compress(b""))
+        for idx in range(nshards):
+            part = os.path.join(
+                data.tmpdir, "{}_clustS_{}.gz".format(sample.name, idx))
+            with open(part, 'rb') as infile:
+                shutil.copyfileobj(infile, out)
+            os.remove(part)
 
 
 def split_endtoend_reads(data, sample):
@@ -2353,60 +3604,129 @@ def split_endtoend_reads(data, sample):
 #     return listseq
 
 
-def join_arrays(arr1, arr2):
-    "join read1 and read2 arrays and resolve overlaps"
-    arr3 = np.zeros(arr1.size, dtype="U1")
-    for i in range(arr1.size):
-
-        if arr1[i] == arr2[i]:
-            arr3[i] = arr1[i]
-
-        elif arr1[i] == "N":
-            if arr2[i] == "-":
-                arr3[i] = "N"
-            else:
-                arr3[i] = arr2[i]
-
-        elif arr2[i] == "N":
-            if arr1[i] == "-":
-                arr3[i] = "N"
-            else:
-                arr3[i] = arr1[i]
+def build_ref_cluster(reads, reg, paired, declone=False):
+    """
+    Builds the cluster of reads mapped to a region as a list of 
+    'name\nseq' strings, sorted by derep size. The reads of the region are
+    collected from pysam in one pass and placed by their cigars into a 
+    single uint8 matrix with a row per read (pair) by _fill_ref_cluster(),
+    where deletions are '-' and insertions are skipped. Read2s are joined
+    onto read1s, and bases where they disagree are N. Only reads with
+    both mates in the region are kept for paired data.
+    """
+    # match paired reads by name, else keep the last read of each name
+    rdict = {}
+    mstart = int(9e12)
+    mend = 0
+    for read in reads:
+        if not paired:
+            rdict[read.qname] = [read]
+            mstart = min(mstart, read.reference_start)
+            mend = max(mend, read.reference_end)
+        elif read.qname not in rdict:
+            rdict[read.qname] = [read, None]
+        else:
+            rdict[read.qname][1] = read
+
+    # sort keys by derep number
+    keys = sorted(
+        (i for i in rdict if all(rdict[i])),
+        key=lambda x: int(x.split("=")[-1]), reverse=True)
+    if not keys:
+        return []
+
+    # region of the matrix in reference coordinates (0-based)
+    if paired:
+        first = reg[1] - 1
+        width = reg[2] - reg[1]
+    else:
+        first = mstart
+        width = mend - mstart
+
+    # batch the seqs and cigars of all reads (read2s after read1s)
+    mates = [[rdict[i][0] for i in keys]]
+    if paired:
+        mates.append([rdict[i][1] for i in keys])
+    nreads = len(keys) * len(mates)
+    seqs = []
+    ops = []
+    seqstarts = np.zeros(nreads + 1, dtype=np.int64)
+    opstarts = np.zeros(nreads + 1, dtype=np.int64)
+    cols = np.zeros(nreads, dtype=np.int64)
+    idx = 0
+    for mate in mates:
+        for read in mate:
+            seqs.append(read.seq)
+            ops.extend(read.cigartuples or [])
+            seqstarts[idx + 1] = seqstarts[idx] + len(read.seq)
+            opstarts[idx + 1] = len(ops)
+            cols[idx] = read.reference_start - first
+            idx += 1
+    seqbuf = np.frombuffer("".join(seqs).encode(), dtype=np.uint8)
+    ops = np.array(ops, dtype=np.int64).reshape(-1, 2)
+
+    # fill the region matrix and join each row with its name
+    mat = np.full((len(keys), width), 45, dtype=np.uint8)
+    _fill_ref_cluster(mat, seqbuf, seqstarts, ops, opstarts, cols)
+    clust = []
+    for row, key in enumerate(keys):
+        ori = "+"
+        if rdict[key][0].is_reverse:
+            ori = "-"
+        derep = key.split("=")[-1]
+        if not paired:
+            # Pysam coords are 0 based, but sam files are 1 based, and
+            # since we we build sam in step 5, we need to account for the
+            # diffrent indexing strategies here by incrementing mstart
+            # and mend
+            rname = "{}:{}-{};size={};{}".format(
+                reg[0], mstart + 1, mend + 1, derep, ori)
+        elif declone:
+            tag = key.split(";")[-2]
+            rname = "{}:{}-{};{};size={};{}".format(
+                reg[0], reg[1], reg[2], tag, derep, ori,
+            )
+        else:
+            rname = "{}:{}-{};size={};{}".format(
+                reg[0], reg[1], reg[2], derep, ori,
+            )
+        clust.append("{}\n{}".format(rname, mat[row].tobytes().decode()))
+    return clust
 
-        elif arr1[i] == "-":
-            if arr2[i] == "N":
-                arr3[i] = "N"
-            else:
-                arr3[i] = arr2[i]
 
-        elif arr2[i] == "-":
-            if arr1[i] == "N":
-                arr3[i] = "N"
+@njit
+def _fill_ref_cluster(mat, seqbuf, seqstarts, ops, opstarts, cols):
+    """
+    Places each read into row (read index % nrows) of mat from its cigar:
+    M copies bases, D skips (leaving -), and I, S and others skip bases of
+    the read. Reads of the second half (read2s) are joined onto the row: 
+    a base replaces - or N, N replaces - and other mismatches become N.
+    """
+    nrows, width = mat.shape
+    for read in range(seqstarts.size - 1):
+        row = read % nrows
+        joined = read >= nrows
+        pos = cols[read]
+        qpos = seqstarts[read]
+        qend = seqstarts[read + 1]
+        for opidx in range(opstarts[read], opstarts[read + 1]):
+            flag = ops[opidx, 0]
+            add = ops[opidx, 1]
+            if flag == 0:
+                for qidx in range(qpos, min(qpos + add, qend)):
+                    if 0 <= pos < width:
+                        base = seqbuf[qidx]
+                        old = mat[row, pos]
+                        if not joined or old == 45 or old == 78:
+                            mat[row, pos] = base
+                        elif base != 78 and base != old:
+                            mat[row, pos] = 78
+                    pos += 1
+                qpos += add
+            elif flag == 2:
+                pos += add
             else:
-                arr3[i] = arr1[i]
-
-        else:
-            arr3[i] = "N"
-    return arr3
-
-
-def cigared(sequence, cigartups):
-    "modify sequence based on its cigar string"
-    start = 0
-    seq = ""
-    for tup in cigartups:
-        flag, add = tup
-        if flag == 0:
-            seq += sequence[start:start + add]
-        if flag == 1:
-            pass
-        if flag == 2:
-            seq += "-" * add
-            start -= add
-        if flag == 4:
-            pass
-        start += add
-    return seq
+                qpos += add
 
 
 def get_quick_depths(data, sample):
@@ -2708,6 +4028,50 @@ def tag_for_decloning(data, sample):
 
 
 # globals
+DEREP_CHUNKSIZE = 50000000
+CLUST_HITS_CHUNK = 100000
+
+# max number of sorted runs of hits that are open at once
+CLUST_MAX_RUNS = 256
+
+# estimated cost (nseqs x length^2) of the clusters in an alignment chunk
+ALIGN_CHUNK_COST = 1e9
+
+# bytes of clusters per batch, and slots per aligner, in align_queued()
+ALIGN_QUEUE_BATCH = 2 ** 19
+ALIGN_QUEUE_SLOTS = 3
+
+# classes of clusters in align_chunk(), stored as s3 stats
+ALIGN_CLASSES = [
+    "clusters_singleton", "clusters_identical", "clusters_variable",
+    "filtered_bad_align",
+]
+ALIGN_HASH_LUT = np.arange(256, dtype=np.uint8)
+
+# validation of the builtin aligner against muscle (align_builtin_validate)
+ALIGN_VALIDATE_SEED = 12345
+ALIGN_VALIDATION_FIELDS = [
+    "seed", "nseqs", "identical",
+    "builtin_ncols", "builtin_nvariable", "builtin_nindels", 
+    "muscle_ncols", "muscle_nvariable", "muscle_nindels",
+]
+
+# the index of binary sequence stores of derep files (see get_seq_key)
+SEQ_STORE_DTYPE = np.dtype([
+    ("key", "S16"),
+    ("start", np.int64),
+    ("length", np.uint32),
+    ("size", np.uint32),
+])
+
+# bases compared by dereplicate_builtin: uppercase and U=T, and complements
+DEREP_UPPER_LUT = np.arange(256, dtype=np.uint8)
+DEREP_UPPER_LUT[97:123] -= 32
+DEREP_UPPER_LUT[[85, 117]] = 84
+DEREP_COMP_LUT = DEREP_UPPER_LUT.copy()
+for _base, _comp in zip(b"ACGTURYKMBVDH", b"TGCAAYRMKVBHD"):
+    DEREP_COMP_LUT[[_base, _base + 32]] = _comp
+
 NO_ZIP_BINS = """
   Reference sequence must be de-compressed fasta or bgzip compressed,
   your file is probably gzip compressed. The simplest fix is to gunzip
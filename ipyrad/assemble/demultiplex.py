@@ -16,12 +16,24 @@ import os
 import io
 import gzip
 import glob
+import json
 import time
+import zlib
+import struct
+import fcntl
+import socket
 import shutil
-import pickle
 import numpy as np
 import subprocess as sps
+from numba import njit
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+# shared memory blocks for streaming demultiplexing (py3.8+)
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
 
 # ipyrad imports
 from ipyrad.core.sample import Sample
@@ -36,6 +48,7 @@ class Step1:
         self.force = force
         self.ipyclient = ipyclient
         self.skip = False
+        self.resume = False
 
         # check input data files
         self.sfiles = self.data.params.sorted_fastq_path
@@ -71,6 +84,11 @@ class Step1:
             if os.path.exists(self.data.dirs.fastqs):
                 shutil.rmtree(self.data.dirs.fastqs)
 
+        # resume an interrupted demultiplexing run (checked by Demultiplexer)
+        elif os.path.exists(os.path.join(
+                self.data.dirs.fastqs, "tmpdir", RESUME_FILE)):
+            self.resume = True
+
         # bail out if overwrite necessary but no force flag.
         else:
             if os.path.exists(self.data.dirs.fastqs):
@@ -221,19 +239,23 @@ class FileLinker:
                 self.data.samples[sname] = newsamp
                 createdinc += 1
 
-        # send jobs to engines for counting with cat/zcat | wc
+        # send jobs to engines for counting lines of files that are not in
+        # the cache of read counts or that have changed since.
         rasyncs = {}
+        counts = {}
+        cache = load_read_counts(self.data.params.project_dir)
         if createdinc:
             for sample in self.data.samples.values():
-
-                # get zip var
-                gzipped = bool(sample.files.fastqs[0][0].endswith(".gz"))
+                fname = os.path.realpath(sample.files.fastqs[0][0])
+                fstat = os.stat(fname)
+                cached = cache.get(fname)
+                if cached and cached[:2] == [fstat.st_size, fstat.st_mtime_ns]:
+                    counts[sample.name] = cached[2]
+                    continue
 
                 # submit job to count lines and store async
-                rasyncs[sample.name] = self.lbview.apply(
-                    zbufcountlines, 
-                    *(sample.files.fastqs[0][0], gzipped)
-                )
+                rasyncs[sample.name] = self.lbview.apply(countlines, fname)
+                cache[fname] = [fstat.st_size, fstat.st_mtime_ns, None]
 
         # wait for link jobs to finish if parallel
         start = time.time()
@@ -246,9 +268,18 @@ class FileLinker:
                 self.data._print("")
                 break
 
-        # collect link job results           
+        # collect link job results and update the cache
         for sname in rasyncs:
-            res = rasyncs[sname].get() / 4
+            counts[sname] = rasyncs[sname].get()
+            fname = os.path.realpath(
+                self.data.samples[sname].files.fastqs[0][0])
+            cache[fname][2] = counts[sname]
+        if rasyncs:
+            save_read_counts(self.data.params.project_dir, cache)
+
+        # store results
+        for sname in counts:
+            res = counts[sname] / 4
             self.data.samples[sname].stats.reads_raw = res
             self.data.samples[sname].stats_dfs.s1["reads_raw"] = res
             self.data.samples[sname].state = 1
@@ -285,7 +316,11 @@ class Demultiplexer:
     def __init__(self, step):
         self.data = step.data
         self.input = step.rfiles
-        self.fastqs = glob.glob(self.input)
+        self.resume = step.resume
+        self.fastqs = [
+            i for i in glob.glob(self.input) 
+            if not i.endswith(read_index_path(""))
+        ]
         self.ipyclient = step.ipyclient
         # single engine jobs
         self.iview = self.ipyclient.load_balanced_view(targets=[0])
@@ -310,23 +345,47 @@ class Demultiplexer:
         # attrs filled by get_barcode_dict
         self.cutters = None
         self.matchdict = {}       
+        self.ambigs = set()
         self.get_barcode_dict()        
 
         # store stats for each file handle (grouped results of chunks)
-        self.stats = Stats()
+        self.stats = Stats(get_sample_names(self.data), self.is3rad)
+
+        # chunks finished by an interrupted run {chunk: statsname} and the
+        # manifests of the groups of chunks they were committed in.
+        self.finished = {}
+        self.manifests = {}
+
+        # number of reads per block in streaming mode
+        self.blocksize = int(2.5e5)
+
+        # whether blocks are streamed (set in setup_for_splitting)
+        self.streaming = False
 
     def run(self):
         # Estimate size of files to plan parallelization. 
         self.setup_for_splitting()
 
-        # work load; i.e., is there one giant file or many small files?
-        self.splitfiles()
+        # drop reads left buffered on engines by an interrupted run
+        self.ipyclient[self.lbview.targets].apply_sync(reset_writer)
+
+        # stream decompressed blocks to engines w/o writing chunk files
+        if self.streaming:
+            self.remote_run_barmatch_streaming()
+
+        else:
+            # work load; i.e., is there one giant file or many small files?
+            self.splitfiles()
+
+            # process the files or chunked file bits        
+            self.remote_run_barmatch()
 
-        # process the files or chunked file bits        
-        self.remote_run_barmatch()
+        # write reads still buffered on engines and commit their chunks
+        self.ipyclient[self.lbview.targets].apply_sync(commit_writer)
 
-        # concatenate chunks
-        self.concatenate_chunks()
+        # save exact read counts next to raw files for reruns/branches
+        if self.data.hackersonly.index_raw_fastqs:
+            self.save_read_indexes()
 
         # store stats and create Sample objects in Assembly
         self.store_stats()
@@ -393,8 +452,47 @@ class Demultiplexer:
         ]
         assert self.cutters, "Must enter a restriction_overhang for demultiplexing."
 
-        # get matchdict
-        self.matchdict = inverse_barcodes(self.data)
+        # barcodes of each sample's technical replicates {sname: [(rname,
+        # barcode), ...]}, observed barcodes are mapped to the closest.
+        self.replicates = {}
+        for rname, barc in self.data.barcodes.items():
+            self.replicates.setdefault(
+                get_sample_name(self.data, rname), []).append((rname, barc))
+
+        # get matchdict and pack it into a compact index when possible
+        matchdict = inverse_barcodes(self.data, self.ambigs)
+        self.is3rad = (
+            '3rad' in self.data.params.datatype and 
+            not self.data.hackersonly.demultiplex_on_i7_tags
+        )
+        try:
+            self.matchdict = BarcodeIndex(matchdict, self.is3rad, self.ambigs)
+        except ValueError:
+            self.matchdict = matchdict
+
+
+    def get_replicate_name(self, barcode, sname):
+        """
+        Returns the barcodes name (technical replicate) of sample 'sname'
+        that an observed barcode was matched to: the one whose barcode is
+        the fewest mismatches away, the first in the barcodes file on ties.
+        """
+        best = (None, None)
+        for rname, barc in self.replicates.get(sname, []):
+            if len(barc) != len(barcode):
+                dist = len(barcode) + 1
+            else:
+                dist = sum(i != j for (i, j) in zip(barc, barcode))
+            if best[0] is None or dist < best[1]:
+                best = (rname, dist)
+        return best[0]
+
+
+    def is_ambiguous(self, barcode):
+        "whether a barcode is within max_barcode_mismatch of >1 sample"
+        if isinstance(self.matchdict, BarcodeIndex):
+            return self.matchdict.lookup(barcode)[1]
+        return barcode in self.ambigs
 
 
     def setup_for_splitting(self, omin=int(8e6)):
@@ -406,11 +504,14 @@ class Demultiplexer:
         self.tmpdir = os.path.realpath(
             os.path.join(self.data.dirs.fastqs, "tmpdir")
         )
-        if os.path.exists(self.tmpdir):
-            shutil.rmtree(self.tmpdir)
-        os.makedirs(self.tmpdir)
 
-        # chunk into 16 pieces
+        # keep the tmpdir of an interrupted run with the same params
+        if not self.resume:
+            if os.path.exists(self.tmpdir):
+                shutil.rmtree(self.tmpdir)
+            os.makedirs(self.tmpdir)
+
+        # chunk into 16 pieces (exact nreads if raw file was indexed)
         self.nreads = estimate_nreads(self.data, self.ftuples[0][0])
         self.optim = int(self.nreads / 16)
 
@@ -419,6 +520,96 @@ class Demultiplexer:
         if (len(self.ftuples) > len(self.ipyclient)) or (self.optim > omin):
             self.do_file_split = 1
 
+        # the mode that will actually run, streaming falls back to splitting
+        self.streaming = bool(
+            self.data.hackersonly.demultiplex_streaming and self.can_stream())
+
+        # resume with the same chunks, or record the params and chunking
+        # plan of this run to allow resuming it.
+        if self.resume:
+            self.load_finished_chunks()
+        else:
+            self.write_resume_file()
+
+        # write the barcode index once, engines memory-map it.
+        if isinstance(self.matchdict, BarcodeIndex):
+            self.matchdict.save(os.path.join(self.tmpdir, "barcodes"))
+
+
+    def get_signature(self):
+        "params and raw files that must be unchanged to resume a run"
+        raws = []
+        for ftup in self.ftuples:
+            for fname in ftup:
+                if fname:
+                    fstat = os.stat(fname)
+                    raws.append([fname, fstat.st_size, int(fstat.st_mtime)])
+        sig = {
+            "raws": raws,
+            "barcodes": self.data.barcodes,
+            "datatype": self.data.params.datatype,
+            "restriction_overhang": self.data.params.restriction_overhang,
+            "max_barcode_mismatch": self.data.params.max_barcode_mismatch,
+            "hackers": [
+                self.data.hackersonly.demultiplex_on_i7_tags,
+                self.data.hackersonly.demultiplex_streaming,
+                self.data.hackersonly.merge_technical_replicates,
+            ],
+        }
+        # compare as json types (tuples become lists)
+        return json.loads(json.dumps(sig))
+
+
+    def write_resume_file(self):
+        "record params and the chunking plan so this run can be resumed"
+        with open(os.path.join(self.tmpdir, RESUME_FILE), 'w') as out:
+            json.dump({
+                "signature": self.get_signature(),
+                "plan": [
+                    self.get_mode(),
+                    self.optim,
+                    self.do_file_split,
+                    self.blocksize,
+                ],
+            }, out)
+
+
+    def get_mode(self):
+        "chunks of the two modes cover different reads and are not shared"
+        if self.streaming:
+            return "stream"
+        return "split"
+
+
+    def load_finished_chunks(self):
+        """
+        Check that an interrupted run used the same params, restore its 
+        chunking plan, load the manifests of its finished chunks, and 
+        remove any reads written to sample files by unfinished chunks.
+        """
+        with open(os.path.join(self.tmpdir, RESUME_FILE), 'r') as infile:
+            resume = json.load(infile)
+        if resume["signature"] != self.get_signature():
+            raise IPyradError(RESUME_PARAMS_CHANGED.format(
+                self.data.dirs.fastqs))
+        plan = resume["plan"]
+        if len(plan) != 4 or plan[0] != self.get_mode():
+            raise IPyradError(RESUME_MODE_CHANGED.format(
+                self.data.dirs.fastqs, self.get_mode()))
+        self.optim, self.do_file_split, self.blocksize = plan[1:]
+
+        for mfile in glob.glob(os.path.join(self.tmpdir, "done_*.json")):
+            with open(mfile, 'r') as infile:
+                manifest = json.load(infile)
+            # manifests of older versions (one per chunk) are redone
+            if "chunks" in manifest:
+                self.manifests[manifest["chunk"]] = manifest
+                self.finished.update(manifest["chunks"])
+        repair_sample_files(self.data, self.manifests)
+        self.data._print(
+            "  resuming interrupted run: {} chunks already sorted"
+            .format(len(self.finished)))
+
 
     def splitfiles(self):
         "sends raws to be chunked"
@@ -440,18 +631,31 @@ class Demultiplexer:
             handle = os.path.splitext(os.path.basename(ftup[0]))[0]
             if not self.do_file_split:
                 chunksdict[handle] = [ftup]
+                continue
+
+            # uncompressed files are cut into byte ranges w/o writing files
+            ranges = plan_byte_ranges(ftup, self.optim)
+            splitfile = os.path.join(self.tmpdir, "split_{}.json".format(fidx))
+            if ranges:
+                chunksdict[handle] = ranges
+
+            # chunk files were written before the run was interrupted
+            elif os.path.exists(splitfile):
+                with open(splitfile, 'r') as infile:
+                    chunksdict[handle] = [tuple(i) for i in json.load(infile)]
 
             # chunk file into 4 bits using zcat_make_temps                
             else:               
                 args = (self.data, ftup, fidx, self.tmpdir, self.optim, start)
-                rasyncs[handle] = self.iview.apply(zcat_make_temps, *args)
+                rasyncs[handle] = (
+                    splitfile, self.iview.apply(zcat_make_temps, *args))
 
         # track progress until finished
         # for each file submitted we expect it to create 16 or 32 files.
         if rasyncs:
             while 1:
                 # break when all jobs are finished
-                if all([i.ready() for i in rasyncs.values()]):
+                if all([i[1].ready() for i in rasyncs.values()]):
                     break
 
                 # ntemp files written or being written
@@ -459,9 +663,11 @@ class Demultiplexer:
                 self.data._progressbar(njobs, done, start, printstr)
                 time.sleep(0.5)
 
-            # store results
-            for key, val in rasyncs.items():
+            # store results, and record them in case the run is resumed
+            for key, (splitfile, val) in rasyncs.items():
                 chunksdict[key] = val.get()       
+                with open(splitfile, 'w') as out:
+                    json.dump(chunksdict[key], out)
 
             # clean up                    
             self.ipyclient.purge_everything()                    
@@ -480,29 +686,37 @@ class Demultiplexer:
 
         # chunkfiles is a dict with {handle: chunkslist, ...}. The func barmatch
         # writes results to samplename files with PID number, and also writes a 
-        # pickle for chunk specific results with fidx suffix, which it returns.
+        # stats table for each chunk with fidx suffix, which it returns.
         rasyncs = {}
         ridx = 0
+        done = 0
         for handle, ftuplist in self.chunksdict.items():
+
+            # get ready to receive stats: 'total', 'cutfound', 'matched'
+            self.stats.perfile[handle] = np.zeros(3, dtype=np.int)
+
             for fidx, ftuple in enumerate(ftuplist):
+                # skip chunks finished by an interrupted run
+                chunk = "{}-{}".format(handle, fidx)
+                if chunk in self.finished:
+                    self.stats.fill_from_table(self.finished[chunk], handle)
+                    done += 1
+                    continue
+
                 args = (
                     self.data,
                     ftuple,
                     self.longbar,
                     self.cutters,
                     self.matchdict,
-                    fidx,
+                    chunk,
                     )
                 rasync = self.lbview.apply(barmatch, args)
                 rasyncs[ridx] = (handle, rasync)
                 ridx += 1
 
-            # get ready to receive stats: 'total', 'cutfound', 'matched'
-            self.stats.perfile[handle] = np.zeros(3, dtype=np.int)
-
         # collect and store results as jobs finish
-        njobs = len(rasyncs)
-        done = 0
+        njobs = len(rasyncs) + done
         while 1:
             # get list of ridx numbers for finished jobs
             finished = [i for (i, j) in rasyncs.items() if j[1].ready()]
@@ -510,8 +724,7 @@ class Demultiplexer:
             # cleanup finished ridx jobs and grab stats
             for ridx in finished:
                 handle, rasync = rasyncs[ridx]
-                pkl = rasync.get()
-                self.stats.fill_from_pickle(pkl, handle)
+                self.stats.fill_from_table(rasync.get(), handle)
                 del rasyncs[ridx]
                 done += 1
 
@@ -523,66 +736,130 @@ class Demultiplexer:
                 break
 
 
-    def concatenate_chunks(self):
-        """ 
-        If multiple chunk files match to the same sample name but with 
-        different barcodes (i.e., they are technical replicates) then this
-        will assign all the files to the same sample name file.
+    def can_stream(self):
+        """
+        Streaming passes blocks to engines through shared memory, which
+        requires py3.8+ and that all engines are on the same host as this
+        process. Otherwise fall back to splitting files.
+        """
+        if shared_memory is None:
+            self.data._print(
+                "  streaming demultiplexing requires Python>=3.8, "
+                "using chunked files instead.")
+            return False
+
+        hosts = self.ipyclient.direct_view().apply_sync(socket.gethostname)
+        if any(i != socket.gethostname() for i in hosts):
+            self.data._print(
+                "  streaming demultiplexing requires engines on one host, "
+                "using chunked files instead.")
+            return False
+        return True
+
+
+    def remote_run_barmatch_streaming(self):
         """
-        # collate files progress bar
+        Decompress each raw file (or pair) once in this process and send 
+        blocks of whole fastq records to barmatch() through shared memory.
+        Sorting starts on the first block and no chunk files are written.
+        The number of blocks in flight is bounded to limit memory use.
+        """
+        # progress bar info
         start = time.time()
-        printstr = ("writing/compressing ", "s1")
-        self.data._progressbar(10, 0, start, printstr) 
-
-        # get all the files
-        ftmps = glob.glob(os.path.join(
-            self.data.dirs.fastqs, 
-            "tmpdir", 
-            "tmp_*.fastq"))
-
-        # a dict to assign tmp files to names/reads
-        r1dict = {}
-        r2dict = {}
-        for sname in self.data.barcodes:
-            if "-technical-replicate-" in sname:
-                sname = sname.rsplit("-technical-replicate", 1)[0]
-            r1dict[sname] = []
-            r2dict[sname] = []
-
-        # assign to name keys
-        for ftmp in ftmps:
-            base, orient, _ = ftmp.rsplit("_", 2)
-            sname = base.rsplit("/", 1)[-1].split("tmp_", 1)[1]
-            if orient == "R1":
-                r1dict[sname].append(ftmp)
-            else:
-                r2dict[sname].append(ftmp)
-
-        ## concatenate files
-        snames = []
-        for sname in self.data.barcodes:
-            if "-technical-replicate-" in sname:
-                sname = sname.rsplit("-technical-replicate", 1)[0]
-            snames.append(sname)
-
-        writers = []
-        for sname in set(snames):
-            tmp1s = sorted(r1dict[sname])
-            tmp2s = sorted(r2dict[sname])
-            writers.append(
-                self.iview.apply(
-                    collate_files, 
-                    *(self.data, sname, tmp1s, tmp2s))
-                )
+        printstr = ("sorting reads       ", "s1")
+        blocksize = self.blocksize
 
-        total = len(writers)
-        while 1:
-            ready = [i.ready() for i in writers]
-            self.data._progressbar(total, sum(ready), start, printstr)
-            time.sleep(0.1)
-            if all(ready):
-                self.data._print("")
-                break
+        # expected number of blocks from the estimated nreads per file
+        njobs = max(1, int(self.nreads / blocksize) + 1) * len(self.ftuples)
+        maxqueue = 2 * len(self.lbview.targets)
+        done = 0
+
+        rasyncs = {}
+        ridx = 0
+        pending = []
+        try:
+            for ftup in self.ftuples:
+
+                # get file handle w/o basename for stats output
+                handle = os.path.splitext(os.path.basename(ftup[0]))[0]
+                self.stats.perfile[handle] = np.zeros(3, dtype=np.int)
+
+                # submit blocks as they are decompressed
+                blocks = iter_fastq_blocks(ftup, blocksize)
+                for bidx, block in enumerate(blocks):
+
+                    # skip blocks finished by an interrupted run
+                    chunk = "{}-b{}".format(handle, bidx)
+                    if chunk in self.finished:
+                        self.stats.fill_from_table(
+                            self.finished[chunk], handle)
+                        done += 1
+                        continue
+
+                    # wait for room in the queue
+                    while len(rasyncs) >= maxqueue:
+                        done += self.collect_streamed(rasyncs)
+                        self.data._progressbar(
+                            njobs, min(done, njobs), start, printstr)
+                        time.sleep(0.05)
+
+                    # copy block into shared memory and submit
+                    for i in block:
+                        pending.append(SharedBlock(i) if i else 0)
+                    args = (
+                        self.data,
+                        tuple(pending),
+                        self.longbar,
+                        self.cutters,
+                        self.matchdict,
+                        chunk,
+                        )
+                    rasync = self.lbview.apply(barmatch, args)
+                    rasyncs[ridx] = (handle, rasync, tuple(pending))
+                    pending = []
+                    ridx += 1
+
+            # collect remaining jobs
+            while rasyncs:
+                done += self.collect_streamed(rasyncs)
+                self.data._progressbar(
+                    njobs, min(done, njobs), start, printstr)
+                time.sleep(0.1)
+
+        # on errors or interrupts free the blocks of jobs still in flight,
+        # otherwise they stay in /dev/shm until this process exits.
+        finally:
+            free_shared(pending)
+            for ridx in list(rasyncs):
+                free_shared(rasyncs.pop(ridx)[2])
+        self.data._progressbar(njobs, njobs, start, printstr)
+        self.data._print("")
+
+
+    def collect_streamed(self, rasyncs):
+        "store stats and free shared memory of finished streamed blocks"
+        finished = [i for (i, j) in rasyncs.items() if j[1].ready()]
+        for ridx in finished:
+            handle, rasync, shared = rasyncs.pop(ridx)
+            try:
+                statsname = rasync.get()
+            finally:
+                free_shared(shared)
+            self.stats.fill_from_table(statsname, handle)
+        return len(finished)
+
+
+    def save_read_indexes(self):
+        """
+        Save the exact number of reads of each raw file next to it, so 
+        reruns skip estimating/counting.
+        """
+        for ftup in self.ftuples:
+            handle = os.path.splitext(os.path.basename(ftup[0]))[0]
+            nreads = int(self.stats.perfile[handle][0])
+            for fname in ftup:
+                if fname:
+                    save_read_index(fname, nreads)
 
 
     def store_stats(self):
@@ -620,57 +897,86 @@ class Demultiplexer:
             .format("sample_name", "total_reads"))
 
         # names alphabetical. Write to file. Will save again below to Samples.
-        snames = set()
-        for sname in self.data.barcodes:
-            if "-technical-replicate-" in sname:
-                sname = sname.rsplit("-technical-replicate", 1)[0]
-            snames.add(sname)
-
-        for sname in sorted(list(snames)):
+        snames = get_sample_names(self.data)
+        samplehits = self.stats.get_sample_hits()
+        for sname in snames:
             outfile.write("{:<35}  {:>13}\n"
-                .format(sname, self.stats.fsamplehits[sname]))
+                .format(sname, samplehits[sname]))
+
+        # technical replicates merged into samples, reads from each barcode
+        groups = Counter(
+            get_sample_name(self.data, i) for i in self.data.barcodes)
+        rnames = sorted(
+            i for i in self.data.barcodes 
+            if groups[get_sample_name(self.data, i)] > 1
+        )
+        if rnames:
+            outfile.write(
+                "\n{:<35}  {:>13}\n"
+                .format("replicate_name", "total_reads"))
+            replicatehits = self.stats.get_replicate_hits(
+                self.get_replicate_name)
+            for rname in rnames:
+                outfile.write("{:<35}  {:>13}\n"
+                    .format(rname, replicatehits.get(rname, 0)))
+
+        # reads matched by barcodes that are ambiguous between samples, 
+        # which were assigned to the first sample.
+        ambighits = self.stats.get_ambiguous_hits(self.is_ambiguous)
+        if ambighits:
+            outfile.write(
+                "\n{:<35}  {:>13}\n"
+                .format("sample_name", "ambig_reads"))
+            for sname in snames:
+                outfile.write("{:<35}  {:>13}\n"
+                    .format(sname, ambighits.get(sname, 0)))
+            self.data._print(
+                "  {} reads matched barcodes within max_barcode_mismatch "
+                "of >1 sample, see {}"
+                .format(sum(ambighits.values()), self.data.stats_files.s1))
 
         ## spacer, which barcodes were found -----------------------------------
         outfile.write('\n{:<35}  {:>13} {:>13} {:>13}\n'
             .format("sample_name", "true_bar", "obs_bar", "N_records"))
 
         ## write sample results
+        sbars = self.stats.get_sample_bars()
         for sname in sorted(self.data.barcodes):
-            if "-technical-replicate-" in sname:
-                fname = sname.rsplit("-technical-replicate", 1)[0]  
-            else:
-                fname = sname
+            fname = get_sample_name(self.data, sname)
                 
             # write perfect hit
             hit = self.data.barcodes[sname]
             offhitstring = ""
         
             # write off-n hits
-            # sort list of off-n hits  
-            if fname in self.stats.fdbars:
-                offkeys = list(self.stats.fdbars.get(fname))
-                for offhit in offkeys[::-1]:
-                    # exclude perfect hit
-                    if offhit not in self.data.barcodes.values():
+            # sorted list of off-n hits  
+            if fname in sbars:
+                hitcount = 0
+                for offhit, count in sbars[fname]:
+                    # exclude perfect hit, and hits of other replicates
+                    if offhit == hit:
+                        hitcount = count
+                    elif self.get_replicate_name(offhit, fname) != sname:
+                        continue
+                    elif offhit not in self.data.barcodes.values():
                         offhitstring += (
                             "{:<35}  {:>13} {:>13} {:>13}\n"
-                            .format(sname, hit, offhit, 
-                                int(self.stats.fbarhits[offhit] / 2))
+                            .format(sname, hit, offhit, count)
                             )
-                        #sumoffhits += fbarhits[offhit]
             
                 # write string to file
                 outfile.write("{:<35}  {:>13} {:>13} {:>13}\n"
-                    .format(sname, hit, hit, 
-                        int(self.stats.fbarhits[hit] / 2)))
+                    .format(sname, hit, hit, hitcount))
                 outfile.write(offhitstring)
             
-        # write misses
-        misskeys = list(self.stats.fmisses.keys())
-        misskeys.sort(key=self.stats.fmisses.get)
-        for key in misskeys[::-1]:
+        # write total misses, then the most common unmatched barcodes
+        # (estimated counts from the sketch)
+        nmisses = sum(int(i[0] - i[2]) for i in self.stats.perfile.values())
+        outfile.write('{:<35}  {:>13} {:>13} {:>13}\n'
+            .format("no_match", "_", "_", nmisses))
+        for key, count in self.stats.misses.get_top():
             outfile.write('{:<35}  {:>13} {:>13} {:>13}\n'
-                .format("no_match", "_", key, self.stats.fmisses[key]))
+                .format("no_match", "_", key, count))
         outfile.close()        
 
         # Link Sample with this data file to the Assembly object
@@ -709,10 +1015,9 @@ class Demultiplexer:
                 ]
 
             # fill in the summary stats
-            sample.stats["reads_raw"] = int(self.stats.fsamplehits[sname])
+            sample.stats["reads_raw"] = samplehits[sname]
             # fill in the full df stats value
-            sample.stats_dfs.s1["reads_raw"] = int(
-                self.stats.fsamplehits[sname])
+            sample.stats_dfs.s1["reads_raw"] = samplehits[sname]
 
             # Only link Sample if it has data
             if sample.stats["reads_raw"]:
@@ -733,7 +1038,8 @@ class Demultiplexer:
 class BarMatch:
     def __init__(self, data, ftuple, longbar, cutters, matchdict, fidx):
         """
-        Sorts reads to samples based on barcodes and writes stats to a pickle.
+        Sorts reads to samples based on barcodes and writes stats to a table.
+        fidx is the name of the chunk, used for its stats and manifest.
         """
         # store attrs
         self.data = data
@@ -743,45 +1049,54 @@ class BarMatch:
         self.matchdict = matchdict
         self.fidx = fidx
 
-        # when to write to disk
-        self.chunksize = int(1e6) 
+        # number of reads parsed together by the batched matcher
+        self.batchsize = int(1e5)
         self.epid = os.getpid()
         self.filestat = np.zeros(3, dtype=int)
         
         # store reads per sample (group technical replicates)
-        self.samplehits = {}
-        for sname in self.data.barcodes:
-            if "-technical-replicate-" in sname:
-                sname = sname.rsplit("-technical-replicate", 1)[0]
-            self.samplehits[sname] = 0
+        self.snames = get_sample_names(self.data)
+        self.samplehits = {i: 0 for i in self.snames}
 
         # store all barcodes observed
-        self.barhits = {}
-        for barc in self.matchdict:
-            self.barhits[barc] = 0
-
-        # store reads and bars matched to samples
-        self.read1s = {} 
-        self.read2s = {} 
-        self.dbars = {} 
-        for sname in self.data.barcodes:
-            if "-technical-replicate-" in sname:
-                sname = sname.rsplit("-technical-replicate", 1)[0]
-            self.read1s[sname] = []
-            self.read2s[sname] = []
-            self.dbars[sname] = set()
-
-        # store counts of what didn't match to samples
-        self.misses = {}
-        self.misses['_'] = 0
+        self.barhits = Counter()
+
+        # store bars matched to samples
+        self.dbars = {i: set() for i in self.snames}
+
+        # buffers sorted reads and appends them to the sample fastq.gz files,
+        # kept alive on this engine across chunks of the run.
+        self.writer = get_writer(self.data)
+
+        # store counts of what didn't match to samples in a bounded sketch,
+        # barcodes of the per-read path are buffered and added per batch.
+        self.misses = MissSketch(
+            '3rad' in self.data.params.datatype and 
+            not self.data.hackersonly.demultiplex_on_i7_tags
+        )
+        self.missbuf = Counter()
 
 
     def run(self):
         self.demux = self.get_matching_function()
         self.open_read_generators()
-        pkl = self.sort_reads()
-        self.close_read_generators()
-        return pkl
+        self.batcher = self.get_batch_matcher()
+        try:
+            if self.batcher:
+                statsname = self.sort_reads_batched()
+            else:
+                statsname = self.sort_reads()
+            self.writer.finish(self.fidx, statsname)
+
+        # drop the reads of this chunk (and of uncommitted chunks before it)
+        # from the writer of this engine, else a later commit would record 
+        # them for another chunk. Uncommitted chunks are redone on resume.
+        except Exception:
+            reset_writer()
+            raise
+        finally:
+            self.close_read_generators()
+        return statsname
 
 
     def get_matching_function(self):
@@ -794,10 +1109,55 @@ class BarMatch:
             return getbarcode3
 
 
+    def get_batch_matcher(self):
+        """
+        Returns a BatchMatcher for the numba batched path, or None if the 
+        data must use the per-read path (barcodes that cannot be packed 
+        into the integer hash table).
+        """
+        try:
+            return BatchMatcher(
+                self.matchdict, 
+                self.cutters, 
+                self.longbar, 
+                self.data.params.datatype,
+                self.data.hackersonly.demultiplex_on_i7_tags,
+            )
+        except ValueError:
+            return None
+
+
     def open_read_generators(self):
         """
         Gzips are always bytes so let's use rb to make unzipped also bytes.
         """
+        # byte ranges of whole records in uncompressed raw files
+        if isinstance(self.ftuple[0], FileRange):
+            self.ofile1 = self.ftuple[0].open()
+            quart1 = izip(self.ofile1, self.ofile1, self.ofile1, self.ofile1)
+            if self.ftuple[1]:
+                self.ofile2 = self.ftuple[1].open()
+                quart2 = izip(
+                    self.ofile2, self.ofile2, self.ofile2, self.ofile2)
+                self.quarts = izip(quart1, quart2)
+            else:
+                self.quarts = izip(quart1, iter(int, 1))
+            return
+
+        # streamed blocks of reads in shared memory
+        if isinstance(self.ftuple[0], SharedBlock):
+            self.ofile1 = io.BytesIO(self.ftuple[0].read())
+            fr1 = iter(self.ofile1)
+            quart1 = izip(fr1, fr1, fr1, fr1)
+            if self.ftuple[1]:
+                self.ofile2 = io.BytesIO(self.ftuple[1].read())
+                fr2 = iter(self.ofile2)
+                quart2 = izip(fr2, fr2, fr2, fr2)
+                self.quarts = izip(quart1, quart2)
+            else:
+                self.quarts = izip(quart1, iter(int, 1))
+            return
+
         # get file type
         if self.ftuple[0].endswith(".gz"):
             self.ofile1 = gzip.open(self.ftuple[0], 'rb')
@@ -872,10 +1232,6 @@ class BarMatch:
 
                 self.samplehits[sname_match] += 1
                 self.barhits[barcode] += 1
-                if barcode in self.barhits:
-                    self.barhits[barcode] += 1
-                else:
-                    self.barhits[barcode] = 1
 
                 # trim off barcode
                 lenbar1 = len(barcode)
@@ -905,88 +1261,770 @@ class BarMatch:
                     read2[1] = read2[1][lenbar2:]
                     read2[3] = read2[3][lenbar2:]
 
-                # append to sorted reads list
-                self.read1s[sname_match].append(b"".join(read1).decode())
+                # append to sorted reads buffers
                 if 'pair' in self.data.params.datatype:
-                    self.read2s[sname_match].append(b"".join(read2).decode())
+                    self.writer.add(
+                        sname_match, b"".join(read1), b"".join(read2))
+                else:
+                    self.writer.add(sname_match, b"".join(read1))
 
             else:
-                self.misses["_"] += 1
                 if barcode:
                     self.filestat[1] += 1
+                    self.missbuf[barcode] += 1
 
-            # Write to each sample file (pid's have different handles)
-            if not self.filestat[0] % int(1e6):
+            # same batches as sort_reads_batched() so sketches are identical
+            if not self.filestat[0] % self.batchsize:
+                self.add_missbuf()
 
-                # write reads to file
-                write_to_file(self.data, self.read1s, 1, self.epid)
-                if 'pair' in self.data.params.datatype:
-                    write_to_file(self.data, self.read2s, 2, self.epid)
+        ## add the remaining barcodes to the sketch
+        self.add_missbuf()
+        return self.dump_stats()
 
-                # clear out lits of sorted reads
-                for sname in self.data.barcodes:
-                    if "-technical-replicate-" in sname:
-                        sname = sname.rsplit("-technical-replicate", 1)[0]
-                    self.read1s[sname] = []
-                    self.read2s[sname] = []             
 
-        ## write the remaining reads to file
-        write_to_file(self.data, self.read1s, 1, self.epid)
-        if 'pair' in self.data.params.datatype:
-            write_to_file(self.data, self.read2s, 2, self.epid)
+    def add_missbuf(self):
+        "add unmatched barcodes buffered by sort_reads() to the sketch"
+        keys = []
+        counts = []
+        for barcode, count in self.missbuf.items():
+            try:
+                keys.append(pack_barcode(barcode, self.misses.is3rad))
+                counts.append(count)
+            except ValueError:
+                pass
+        self.misses.add(
+            np.array(keys, dtype=np.uint64).reshape(-1, 2), 
+            np.array(counts, dtype=np.int64),
+        )
+        self.missbuf.clear()
+
+
+    def sort_reads_batched(self):
+        """
+        Same result as sort_reads() but barcodes are parsed and matched for 
+        blocks of reads at a time by the numba kernel in BatchMatcher.
+        """
+        is3rad = '3rad' in self.data.params.datatype
+        is2brad = self.data.params.datatype == '2brad'
+        ispair = 'pair' in self.data.params.datatype
+        snames = self.batcher.snames
+
+        while 1:
+            reads = list(islice(self.quarts, self.batchsize))
+            if not reads:
+                break
+            nreads = len(reads)
+            sidx, keys, nonempty, lenbars1, lenbars2 = (
+                self.batcher.match(reads))
+
+            # file stats: total, cutfound (non-empty barcode), matched
+            matched = np.where(sidx >= 0)[0]
+            self.filestat[0] += nreads
+            self.filestat[1] += nonempty.sum()
+            self.filestat[2] += matched.size
+
+            # unmatched barcodes that could be packed
+            missed = (sidx < 0) & nonempty & keys.any(axis=1)
+            if missed.any():
+                mkeys, mcounts = np.unique(
+                    keys[missed], axis=0, return_counts=True)
+                self.misses.add(mkeys, mcounts)
+
+            # barcode and sample stats
+            if matched.size:
+                ukeys, first, counts = np.unique(
+                    keys[matched], axis=0, return_index=True, 
+                    return_counts=True)
+                for kidx in range(ukeys.shape[0]):
+                    barcode = unpack_barcode(ukeys[kidx], self.batcher.is3rad)
+                    sname = snames[sidx[matched[first[kidx]]]]
+                    self.barhits[barcode] += int(counts[kidx])
+                    self.samplehits[sname] += int(counts[kidx])
+                    self.dbars[sname].add(barcode)
+
+            # trim barcodes and append to sorted reads lists
+            for ridx in matched:
+                read1, read2 = reads[ridx]
+                read1 = list(read1)
+                sname = snames[sidx[ridx]]
+                lenbar1 = lenbars1[ridx]
+
+                # for 2brad we trim the barcode AND the synthetic overhang
+                if is2brad:
+                    overlen = len(self.cutters[0][0]) + lenbar1 + 1
+                    read1[1] = read1[1][:-overlen] + b"\n"
+                    read1[3] = read1[3][:-overlen] + b"\n"
+                else:
+                    read1[1] = read1[1][lenbar1:]
+                    read1[3] = read1[3][lenbar1:]
+
+                # trim barcode off R2, only for 3rad
+                if is3rad:
+                    lenbar2 = lenbars2[ridx]
+                    read2 = list(read2)
+                    read2[1] = read2[1][lenbar2:]
+                    read2[3] = read2[3][lenbar2:]
+
+                if ispair:
+                    self.writer.add(sname, b"".join(read1), b"".join(read2))
+                else:
+                    self.writer.add(sname, b"".join(read1))
+        return self.dump_stats()
+
+
+    def dump_stats(self):
+        """
+        Return stats in a saved table b/c return_queue is too small and the
+        size of the match dictionary can become quite large. The table has
+        a fixed schema: file stats, reads per sample (in get_sample_names 
+        order), matched barcodes with their sample index and count, and the
+        sketch of unmatched barcodes. The chunk is marked as finished once
+        its reads are committed by the SampleWriter.
+        """
+        bars = []
+        barsidx = []
+        for sidx, sname in enumerate(self.snames):
+            for barcode in sorted(self.dbars[sname]):
+                bars.append(barcode)
+                barsidx.append(sidx)
+
+        tmpdir = os.path.join(self.data.dirs.fastqs, "tmpdir")
+        statsname = os.path.join(tmpdir, "stats_{}.npz".format(self.fidx))
+        with open(statsname, 'wb') as out:
+            np.savez_compressed(
+                out,
+                filestat=self.filestat,
+                samplehits=np.array(
+                    [self.samplehits[i] for i in self.snames], dtype=np.int64),
+                bars=np.array(bars, dtype=str),
+                barsidx=np.array(barsidx, dtype=np.int64),
+                barcounts=np.array(
+                    [self.barhits[i] for i in bars], dtype=np.int64),
+                misstable=self.misses.table,
+                misskeys=self.misses.keys,
+            )
+        return statsname
+
+
+# used inside BarMatch by sort_reads_batched()
+class BatchMatcher:
+    """
+    Finds and matches barcodes for a block of reads at a time. The barcode
+    window of each read is copied into a fixed-width uint8 array, and the
+    cutter search, barcode packing and hash table lookup run in a single 
+    numba kernel. Results are identical to the getbarcode/find3radbcode 
+    functions used by the per-read path. With i7 tags the index field is 
+    found by scanning the header lines instead. The matchdict can be a 
+    dict or a BarcodeIndex. Raises ValueError if a barcode in a matchdict 
+    dict cannot be packed (too long or unexpected characters).
+    """
+    def __init__(self, matchdict, cutters, longbar, datatype, i7=False):
+
+        # select the parsing mode the same way get_matching_function() does
+        self.longbar1 = longbar[0]
+        self.longbar2 = 0
+        self.is3rad = '3rad' in datatype and not i7
+        if i7:
+            self.mode = BATCH_I7
+            cuts = cutters[0]
+        elif self.is3rad:
+            self.mode = BATCH_3RAD
+            self.longbar2 = longbar[2]
+            cuts = [j for i in cutters for j in i]
+        elif longbar[1] == 'same':
+            if datatype == '2brad':
+                self.mode = BATCH_2BRAD
+            else:
+                self.mode = BATCH_FIXED
+            cuts = cutters[0]
+        else:
+            self.mode = BATCH_CUTTER
+            cuts = cutters[0]
+
+        # cutters as a padded uint8 array
+        maxcut = max(len(i) for i in cuts)
+        self.cuts = np.zeros((len(cuts), max(1, maxcut)), dtype=np.uint8)
+        self.cutlens = np.zeros(len(cuts), dtype=np.int64)
+        for idx, cut in enumerate(cuts):
+            self.cuts[idx, :len(cut)] = bytearray(cut.encode())
+            self.cutlens[idx] = len(cut)
+
+        # width of the window where barcodes can be found
+        self.lencut = len(cutters[0][0]) + 1
+        if self.mode == BATCH_2BRAD:
+            self.width = self.longbar1 + self.lencut
+        elif self.mode == BATCH_FIXED:
+            self.width = self.longbar1
+        else:
+            self.width = max(self.longbar1, self.longbar2) + maxcut + 1
+
+        # hash table of packed barcodes to sample indices
+        if not isinstance(matchdict, BarcodeIndex):
+            matchdict = BarcodeIndex(matchdict, self.is3rad)
+        self.index = matchdict
+        self.snames = self.index.snames
+
+
+    def get_window(self, lines, tail=False):
+        "fixed-width uint8 array of the start (or end) of each seq line"
+        width = self.width
+        lens = np.array([len(i) for i in lines], dtype=np.int64)
+        if tail:
+            buf = b"".join(i[-width:].ljust(width, b"\0") for i in lines)
+        else:
+            buf = b"".join(i[:width].ljust(width, b"\0") for i in lines)
+        seqs = np.frombuffer(buf, dtype=np.uint8).reshape(len(lines), width)
+        return seqs, lens
+
+
+    def match(self, reads):
+        """
+        Returns arrays with the index of the matched sample (-1 if none),
+        the packed barcodes, whether a barcode was found, and the length 
+        of barcodes 1 and 2.
+        """
+        # i7: scan the header lines joined into one buffer by offsets
+        if self.mode == BATCH_I7:
+            lines = [i[0][0] for i in reads]
+            buf = np.frombuffer(b"".join(lines), dtype=np.uint8)
+            ends = np.cumsum(
+                np.fromiter(map(len, lines), np.int64, len(lines)))
+            return match_i7_numba(
+                buf, ends, BARCODE_LUT, self.index.tkeys, self.index.tvals)
+
+        seqs1, lens1 = self.get_window(
+            [i[0][1] for i in reads], tail=(self.mode == BATCH_2BRAD))
+        if self.is3rad:
+            seqs2, lens2 = self.get_window([i[1][1] for i in reads])
+        else:
+            seqs2, lens2 = seqs1[:, :0], lens1
+        return match_barcodes_numba(
+            seqs1, lens1, seqs2, lens2, 
+            self.mode, self.cuts, self.cutlens, 
+            self.longbar1, self.longbar2, self.lencut,
+            BARCODE_LUT, self.index.tkeys, self.index.tvals,
+        )
+
 
-        ## return stats in saved pickle b/c return_queue is too small
-        ## and the size of the match dictionary can become quite large
-        samplestats = [self.samplehits, self.barhits, self.misses, self.dbars]
-        pklname = os.path.join(
-            self.data.dirs.fastqs, 
-            "tmpdir",
-            "tmp_{}_{}.p".format(self.epid, self.fidx))
-        with open(pklname, 'wb') as wout:
-            pickle.dump([self.filestat, samplestats], wout)
-        return pklname
+# built by Demultiplexer and used by BarMatch and BatchMatcher
+class BarcodeIndex:
+    """
+    Compact index of barcodes (and their mismatch variants from 
+    inverse_barcodes) to samples: an open addressing hash table of barcodes
+    packed at 4 bits per base with a sample index and an ambiguity flag, 
+    i.e., whether the barcode is within max_barcode_mismatch of more than 
+    one sample. Ambiguous barcodes are assigned to the first sample, as in
+    the matchdict. After save() only the file path is pickled, and engines
+    memory-map the arrays. Raises ValueError if a barcode cannot be packed.
+    """
+    def __init__(self, matchdict, is3rad, ambigs=()):
+        self.is3rad = is3rad
+        self.path = None
+        self.snames = sorted(set(matchdict.values()))
+        sidxs = {j: i for (i, j) in enumerate(self.snames)}
+
+        # Mismatch variants of 3rad barcodes that replaced the '+' can never
+        # match a read, so they are left out.
+        nsplit = (1 if self.is3rad else 0)
+        barcodes = [i for i in matchdict if i.count("+") == nsplit]
+        keys = np.zeros((len(barcodes), 2), dtype=np.uint64)
+        vals = np.zeros(len(barcodes), dtype=np.int32)
+        flags = np.zeros(len(barcodes), dtype=np.uint8)
+        for idx, barcode in enumerate(barcodes):
+            keys[idx] = pack_barcode(barcode, self.is3rad)
+            vals[idx] = sidxs[matchdict[barcode]]
+            flags[idx] = barcode in ambigs
+        self._arrs = build_barcode_table(keys, vals, flags)
+
+
+    def __len__(self):
+        return int((self.tvals >= 0).sum())
+
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.path:
+            state["_arrs"] = None
+        return state
+
+
+    @property
+    def tkeys(self):
+        return self._load()[0]
+
+    @property
+    def tvals(self):
+        return self._load()[1]
+
+    @property
+    def tflags(self):
+        return self._load()[2]
+
+
+    def _load(self):
+        if self._arrs is None:
+            self._arrs = tuple(
+                np.load("{}.{}.npy".format(self.path, i), mmap_mode='r')
+                for i in ("keys", "vals", "flags")
+            )
+        return self._arrs
+
+
+    def save(self, path):
+        "write the arrays to {path}.*.npy to be memory-mapped by engines"
+        for name, arr in zip(("keys", "vals", "flags"), self._load()):
+            np.save("{}.{}.npy".format(path, name), arr)
+        self.path = path
+
+
+    def lookup(self, barcode):
+        "returns (sample name or None, whether barcode is ambiguous)"
+        try:
+            keys = pack_barcode(barcode, self.is3rad)
+        except ValueError:
+            return None, False
+        slot = _lookup_barcode_slot(
+            np.uint64(keys[0]), np.uint64(keys[1]), self.tkeys, self.tvals)
+        if slot < 0:
+            return None, False
+        return self.snames[self.tvals[slot]], bool(self.tflags[slot])
+
+
+    def get(self, barcode, default=None):
+        "dict-like lookup of the sample name for a barcode"
+        sname = self.lookup(barcode)[0]
+        if sname is None:
+            return default
+        return sname
+
+
+# used inside BarMatch to write sorted reads
+class SampleWriter:
+    """
+    Keeps a bounded buffer of sorted reads for each sample. When a buffer
+    fills it is compressed to a gzip member and appended to the sample's
+    final _R1_.fastq.gz (and _R2_) file. Concatenated gzip members are a
+    valid gzip file, so no temp files or collate pass are needed. Engines
+    compress in parallel and only hold an exclusive lock on the R1 file 
+    while appending, which also keeps R1 and R2 records in the same order.
+
+    One writer is kept on each engine across all chunks it sorts (see
+    get_writer), so sample files are opened once per large member rather
+    than once per sample per chunk. Finished chunks are committed in
+    groups: once 'maxbuffered' bytes were added since the last commit all
+    buffers are written and one manifest records the chunks of the group
+    with the byte ranges written for them.
+    """
+    def __init__(self, data, bufsize=int(4e6), maxbuffered=int(2.5e8)):
+        self.data = data
+        self.fastqs = data.dirs.fastqs
+        self.bufsize = bufsize
+        self.maxbuffered = maxbuffered
+        self.paired = 'pair' in self.data.params.datatype
+        self.buf1s = {}
+        self.buf2s = {}
+        self.sizes = Counter()
+        self.buffered = 0
+
+        # bytes added since the last commit
+        self.uncommitted = 0
+
+        # finished chunks not yet committed {chunk: statsname}
+        self.pending = {}
+
+        # {sname: [[R1 start, R1 length, R2 start, R2 length], ...]}
+        self.offsets = {}
+
+
+    def add(self, sname, read1, read2=b""):
+        "add one fastq record (bytes) to a sample buffer"
+        if sname not in self.buf1s:
+            self.buf1s[sname] = []
+            self.buf2s[sname] = []
+        self.buf1s[sname].append(read1)
+        if self.paired:
+            self.buf2s[sname].append(read2)
+        size = len(read1) + len(read2)
+        self.sizes[sname] += size
+        self.buffered += size
+        self.uncommitted += size
+
+        # write this sample, or all of them if too much is buffered
+        if self.sizes[sname] >= self.bufsize:
+            self.flush(sname)
+        elif self.buffered >= self.maxbuffered:
+            for sname in list(self.buf1s):
+                self.flush(sname)
+
+
+    def flush(self, sname):
+        "compress a sample buffer and append it to the sample's files"
+        if not self.buf1s.get(sname):
+            return
+        chunk1 = gzip.compress(b"".join(self.buf1s[sname]), compresslevel=6)
+        if self.paired:
+            chunk2 = gzip.compress(
+                b"".join(self.buf2s[sname]), compresslevel=6)
+        self.buffered -= self.sizes.pop(sname)
+        self.buf1s[sname] = []
+        self.buf2s[sname] = []
+
+        # the lock is released when out1 closes, after R2 is written
+        out1 = os.path.join(self.fastqs, "{}_R1_.fastq.gz".format(sname))
+        written = [0, 0, 0, 0]
+        with open(out1, 'ab') as out:
+            fcntl.flock(out, fcntl.LOCK_EX)
+            written[0] = out.seek(0, 2)
+            written[1] = len(chunk1)
+            out.write(chunk1)
+            if self.paired:
+                out2 = os.path.join(
+                    self.fastqs, "{}_R2_.fastq.gz".format(sname))
+                with open(out2, 'ab') as pout:
+                    written[2] = pout.seek(0, 2)
+                    written[3] = len(chunk2)
+                    pout.write(chunk2)
+        self.offsets.setdefault(sname, []).append(written)
+
+
+    def finish(self, chunk, statsname):
+        "mark all reads of a chunk as added, commit if enough are pending"
+        self.pending[chunk] = statsname
+        if self.uncommitted >= self.maxbuffered:
+            self.commit()
+
+
+    def commit(self):
+        """
+        Write all buffers and then the manifest of the pending chunks. The
+        manifest is renamed into place so it only exists once complete.
+        """
+        if not self.pending:
+            return
+        for sname in list(self.buf1s):
+            self.flush(sname)
+
+        name = next(iter(self.pending))
+        manifest = os.path.join(
+            self.fastqs, "tmpdir", "done_{}.json".format(name))
+        with open(manifest + ".tmp", 'w') as out:
+            json.dump({
+                "chunk": name,
+                "chunks": self.pending,
+                "offsets": self.offsets,
+            }, out)
+        os.rename(manifest + ".tmp", manifest)
+        self.pending = {}
+        self.offsets = {}
+        self.uncommitted = 0
 
 
 # used inside BarMatch to store stats nicely.
 class Stats:
-    def __init__(self):
+    """
+    Merges the per-chunk stats tables written by BarMatch.dump_stats().
+    Counts are stored as arrays aligned to the sample names and observed
+    barcodes, and unmatched barcodes in a MissSketch, so merging chunks is
+    vectorized and memory is bounded no matter how many reads miss.
+    """
+    def __init__(self, snames, is3rad):
         # stats for each raw input file
         self.perfile = {}
 
         # stats for each sample
-        self.fdbars = {}
-        self.fsamplehits = Counter()
-        self.fbarhits = Counter()
-        self.fmisses = Counter()
+        self.snames = snames
+        self.samplehits = np.zeros(len(snames), dtype=np.int64)
+
+        # observed barcodes, the index of their sample, and counts
+        self.bars = np.zeros(0, dtype=str)
+        self.barsidx = np.zeros(0, dtype=np.int64)
+        self.barcounts = np.zeros(0, dtype=np.int64)
+
+        # unmatched barcodes
+        self.misses = MissSketch(is3rad)
+
+
+    def fill_from_table(self, statsname, handle):
+
+        # load in stats table
+        with np.load(statsname) as table:
+
+            ## pull new stats
+            self.perfile[handle] += table["filestat"]
+            self.samplehits += table["samplehits"]
 
+            ## sum counts of barcodes seen in several chunks
+            bars = np.concatenate([self.bars, table["bars"]])
+            barsidx = np.concatenate([self.barsidx, table["barsidx"]])
+            counts = np.concatenate([self.barcounts, table["barcounts"]])
+            self.bars, first, inverse = np.unique(
+                bars, return_index=True, return_inverse=True)
+            self.barsidx = barsidx[first]
+            self.barcounts = np.bincount(
+                inverse, weights=counts, minlength=self.bars.size,
+            ).astype(np.int64)
 
-    def fill_from_pickle(self, pkl, handle):
+            ## update the sketch of unmatched barcodes
+            self.misses.merge(table["misstable"], table["misskeys"])
 
-        # load in stats pickle
-        with open(pkl, 'rb') as infile:
-            filestats, samplestats = pickle.load(infile)
 
-        ## pull new stats
-        self.perfile[handle] += filestats
+    def get_sample_hits(self):
+        "returns {sname: nreads}"
+        return dict(zip(self.snames, self.samplehits.tolist()))
 
-        ## update sample stats
-        samplehits, barhits, misses, dbars = samplestats
-        self.fsamplehits.update(samplehits)
-        self.fbarhits.update(barhits)
-        self.fmisses.update(misses)
-        self.fdbars.update(dbars)
+
+    def get_replicate_hits(self, get_replicate_name):
+        "returns {barcodes name: nreads} of get_replicate_name(barcode, sname)"
+        rhits = Counter()
+        for bidx, barcode in enumerate(self.bars.tolist()):
+            sname = self.snames[self.barsidx[bidx]]
+            rhits[get_replicate_name(barcode, sname)] += int(
+                self.barcounts[bidx])
+        return rhits
+
+
+    def get_ambiguous_hits(self, is_ambiguous):
+        "returns {sname: nreads} of barcodes for which is_ambiguous is True"
+        ahits = Counter()
+        for bidx, barcode in enumerate(self.bars.tolist()):
+            if is_ambiguous(barcode):
+                sname = self.snames[self.barsidx[bidx]]
+                ahits[sname] += int(self.barcounts[bidx])
+        return ahits
+
+
+    def get_sample_bars(self):
+        "returns {sname: [(barcode, nreads), ...]} sorted by nreads"
+        sbars = {i: [] for i in self.snames}
+        for bidx in np.lexsort((self.bars, -self.barcounts)):
+            sname = self.snames[self.barsidx[bidx]]
+            sbars[sname].append((self.bars[bidx], int(self.barcounts[bidx])))
+        return sbars
+
+
+
+# used by BarMatch and Stats to count unmatched barcodes.
+class MissSketch:
+    """
+    Count-min sketch of unmatched barcodes (as key pairs packed by 
+    pack_barcode) that also tracks the topk most common barcodes. Memory 
+    is fixed by the table size no matter how many distinct barcodes are 
+    added, and sketches are merged by adding tables. Counts can be 
+    overestimated by hash collisions, but not underestimated.
+    """
+    def __init__(self, is3rad, depth=4, width=2 ** 15, topk=100):
+        self.is3rad = is3rad
+        self.topk = topk
+        self.table = np.zeros((depth, width), dtype=np.int64)
+        self.keys = np.zeros((0, 2), dtype=np.uint64)
+        self.shift = np.uint64(64 - int(np.log2(width)))
+
+
+    def get_slots(self, keys):
+        "multiply-shift hash of each key pair for each row of the table"
+        seeds = SKETCH_SEEDS[:self.table.shape[0]]
+        return (
+            keys[:, 0] * seeds[:, 0:1] + keys[:, 1] * seeds[:, 1:2]
+        ) >> self.shift
+
+
+    def count(self, keys):
+        "estimated counts of an array of key pairs"
+        slots = self.get_slots(keys)
+        rows = np.arange(self.table.shape[0])[:, None]
+        return self.table[rows, slots.astype(np.int64)].min(axis=0)
+
+
+    def add(self, keys, counts):
+        "add counts of an array of unique key pairs"
+        if not keys.shape[0]:
+            return
+        slots = self.get_slots(keys).astype(np.int64)
+        for row in range(self.table.shape[0]):
+            self.table[row] += np.bincount(
+                slots[row], weights=counts, minlength=self.table.shape[1],
+            ).astype(np.int64)
+        self.update_top(keys)
+
+
+    def merge(self, table, keys):
+        "add the table and top keys of another sketch"
+        self.table += table
+        self.update_top(keys)
+
+
+    def update_top(self, keys):
+        "keep the topk keys by estimated count (ties sorted by key)"
+        cands = np.unique(np.concatenate([self.keys, keys]), axis=0)
+        counts = self.count(cands)
+        order = np.lexsort((cands[:, 1], cands[:, 0], -counts))
+        self.keys = cands[order[:self.topk]]
+
+
+    def get_top(self):
+        "returns [(barcode, estimated count), ...] sorted by count"
+        counts = self.count(self.keys)
+        return [
+            (unpack_barcode(key, self.is3rad), int(count))
+            for key, count in zip(self.keys, counts)
+        ]
+
+
+# used by remote_run_barmatch_streaming() to pass blocks to engines.
+class SharedBlock:
+    """
+    A block of fastq records copied into a shared memory segment. Only the 
+    segment name and size are pickled, so sending this to an engine on the 
+    same host does not copy the data through the ipyparallel hub.
+    """
+    def __init__(self, block):
+        self.size = len(block)
+        self._shm = shared_memory.SharedMemory(
+            create=True, size=max(1, self.size))
+        self._shm.buf[:self.size] = block
+        self.name = self._shm.name
+
+
+    def __getstate__(self):
+        return {"name": self.name, "size": self.size, "_shm": None}
+
+
+    def read(self):
+        "attach to the segment on an engine and return a copy of the bytes"
+        shm = shared_memory.SharedMemory(name=self.name)
+        # the creating process owns the segment, stop the engine's resource
+        # tracker from unlinking it (or warning about it) on exit.
+        try:
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name, "shared_memory")
+        except (ImportError, AttributeError):
+            pass
+        try:
+            return bytes(shm.buf[:self.size])
+        finally:
+            shm.close()
+
+
+    def unlink(self):
+        "free the segment, called by the creating process"
+        if self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+
+def free_shared(shared):
+    "unlink the SharedBlocks of a streamed job (0 for a missing R2)"
+    for block in shared:
+        if block:
+            block.unlink()
+
+
+# used by splitfiles() to pass byte ranges of raw files to engines.
+class FileRange:
+    """
+    A range [start, end) of whole fastq records in an uncompressed file
+    (byte offsets) or a BGZF file (virtual offsets). open() returns a 
+    line iterator over the range.
+    """
+    def __init__(self, path, start, end, bgzf=False):
+        self.path = path
+        self.start = start
+        self.end = end
+        self.bgzf = bgzf
+
+
+    def open(self):
+        if self.bgzf:
+            return _BgzfRangeReader(self)
+        return _FileRangeReader(self)
+
+
+class _FileRangeReader:
+    "iterates over the lines of a FileRange and can be closed"
+    def __init__(self, frange):
+        self.end = frange.end
+        self.pos = frange.start
+        self.handle = open(frange.path, 'rb')
+        self.handle.seek(frange.start)
+
+
+    def __iter__(self):
+        return self
+
+
+    def __next__(self):
+        if self.pos >= self.end:
+            raise StopIteration
+        line = self.handle.readline()
+        if not line:
+            raise StopIteration
+        self.pos += len(line)
+        return line
+    next = __next__
+
+
+    def close(self):
+        self.handle.close()
+
+
+class _BgzfRangeReader:
+    "iterates over the lines of a BGZF FileRange and can be closed"
+    def __init__(self, frange):
+        self.end = frange.end
+        self.lines = iter_bgzf_lines(frange.path, frange.start)
+
+
+    def __iter__(self):
+        return self
+
+
+    def __next__(self):
+        pos, line = next(self.lines)
+        if pos >= self.end:
+            raise StopIteration
+        return line
+    next = __next__
+
+
+    def close(self):
+        self.lines.close()
 
 
 # -------------------------------------
 # EXTERNAL FUNCS 
 # -------------------------------------
 
+# SampleWriter of this engine, kept across the barmatch() jobs of a run
+WRITER = None
+
+
+def get_writer(data):
+    "return the SampleWriter of this engine, new if the run changed"
+    global WRITER
+    if WRITER is None or WRITER.fastqs != data.dirs.fastqs:
+        WRITER = SampleWriter(data)
+    return WRITER
+
+
+def commit_writer():
+    "called on each engine once all chunks are sorted"
+    if WRITER is not None:
+        WRITER.commit()
+
+
+def reset_writer():
+    "drop reads left buffered on this engine by an interrupted run"
+    global WRITER
+    WRITER = None
+
+
 def barmatch(args):
     # run procesor
     bar = BarMatch(*args)
-    # writes reads t ofile and writes stats to pickle
-    pkl = bar.run()
-    return pkl
+    # writes reads t ofile and writes stats to a table
+    statsname = bar.run()
+    return statsname
 
 
 # CALLED BY FILELINKER
@@ -1040,22 +2078,64 @@ def get_name_from_file(fname, splitnames, fields):
     return base
 
 
-def zbufcountlines(filename, gzipped):
-    "Fast line counter using unix utils"
-    if gzipped:
-        cmd1 = ["gunzip", "-c", filename]
-    else:
-        cmd1 = ["cat", filename]
-    cmd2 = ["wc"]
-    proc1 = sps.Popen(cmd1, stdout=sps.PIPE, stderr=sps.PIPE)
-    proc2 = sps.Popen(cmd2, stdin=proc1.stdout, stdout=sps.PIPE, stderr=sps.PIPE)
-    res = proc2.communicate()[0]
-    if proc2.returncode:
-        raise IPyradError("error zbufcountlines {}:".format(res))
-    nlines = int(res.split()[0])
+def countlines(filename, blocksize=int(4e6)):
+    """
+    Line counter run in-process on engines, decompressing gzip files with
+    zlib (including concatenated gzip members). Like gunzip, trailing 
+    garbage after the last complete member is ignored.
+    """
+    nlines = 0
+    gzipped = filename.endswith(".gz")
+    with open(filename, 'rb') as infile:
+        decomp = zlib.decompressobj(zlib.MAX_WBITS | 32)
+        members = 0
+        fresh = True
+        while 1:
+            chunk = infile.read(blocksize)
+            if not chunk:
+                break
+            if not gzipped:
+                nlines += chunk.count(b"\n")
+                continue
+            try:
+                while chunk:
+                    nlines += decomp.decompress(chunk).count(b"\n")
+                    fresh = False
+                    chunk = decomp.unused_data
+                    if decomp.eof:
+                        decomp = zlib.decompressobj(zlib.MAX_WBITS | 32)
+                        members += 1
+                        fresh = True
+            except zlib.error as inst:
+                # garbage (not a gzip header) where the next member starts
+                if members and fresh and not chunk.startswith(b"\x1f\x8b"):
+                    break
+                raise IPyradError(
+                    "error counting lines in {}: {}".format(filename, inst))
     return nlines
 
 
+def load_read_counts(project_dir):
+    """
+    Returns the cache of line counts of sorted fastq files in the project
+    dir, {realpath: [size, mtime_ns, nlines]}, or {} if there is none.
+    """
+    try:
+        with open(os.path.join(project_dir, READ_COUNTS_CACHE), 'r') as inf:
+            return json.load(inf)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def save_read_counts(project_dir, cache):
+    "write the cache of line counts, renamed so it is never partly written"
+    cachefile = os.path.join(project_dir, READ_COUNTS_CACHE)
+    tmpfile = "{}.{}.tmp".format(cachefile, os.getpid())
+    with open(tmpfile, 'w') as out:
+        json.dump({i: j for (i, j) in cache.items() if j[2] is not None}, out)
+    os.replace(tmpfile, cachefile)
+
+
 def find3radbcode(cutters, longbar, read):
     "find barcode sequence in the beginning of read"
     # default barcode string
@@ -1116,108 +2196,345 @@ def getbarcode3(cutters, read1, longbar):
 
 
 
-def write_to_file(data, dsort, read, pid):
-    "Writes sorted data to tmp files"
-    if read == 1:
-        rrr = "R1"
+def pack_barcode(barcode, is3rad):
+    """
+    Packs a barcode string into two uint64 keys at 4 bits per base (the 
+    second key is the R2 barcode for 3rad, else 0). Raises ValueError if 
+    it cannot be packed.
+    """
+    if is3rad:
+        parts = barcode.split("+")
+        if len(parts) != 2:
+            raise ValueError("3rad barcode must have two parts")
     else:
-        rrr = "R2"
+        parts = [barcode, ""]
+
+    keys = []
+    for part in parts:
+        if len(part) > 16:
+            raise ValueError("barcode too long to pack")
+        key = 0
+        for base in part:
+            code = BARCODE_LUT[ord(base)] if ord(base) < 256 else 0
+            if not code:
+                raise ValueError("unexpected character in barcode")
+            key = (key << 4) | int(code)
+        keys.append(key)
+    return keys
+
+
+def unpack_barcode(keys, is3rad):
+    "returns the barcode string of packed keys from pack_barcode()"
+    parts = []
+    for key in keys[:(2 if is3rad else 1)]:
+        key = int(key)
+        bases = []
+        while key:
+            bases.append(BARCODE_BASES[(key & 15) - 1])
+            key >>= 4
+        parts.append("".join(bases[::-1]))
+    return "+".join(parts)
+
+
+def build_barcode_table(keys, vals, flags):
+    """
+    Returns an open addressing hash table (keys, vals, flags) of packed
+    keys at <= 50% load. Empty slots have val -1.
+    """
+    size = 16
+    while size < 2 * keys.shape[0]:
+        size *= 2
+    tkeys = np.zeros((size, 2), dtype=np.uint64)
+    tvals = np.zeros(size, dtype=np.int32) - 1
+    tflags = np.zeros(size, dtype=np.uint8)
+    fill_barcode_table_numba(keys, vals, flags, tkeys, tvals, tflags)
+    return tkeys, tvals, tflags
+
+
+@njit
+def _barcode_slot(key1, key2, mask):
+    "hash of a pair of packed keys"
+    hsh = key1 * np.uint64(0x9E3779B97F4A7C15)
+    hsh ^= key2 * np.uint64(0xC2B2AE3D27D4EB4F)
+    return (hsh >> np.uint64(17)) & mask
+
+
+@njit
+def fill_barcode_table_numba(keys, vals, flags, tkeys, tvals, tflags):
+    "insert keys into the table w/ linear probing"
+    mask = np.uint64(tvals.shape[0] - 1)
+    for idx in range(keys.shape[0]):
+        slot = _barcode_slot(keys[idx, 0], keys[idx, 1], mask)
+        while tvals[slot] != -1:
+            slot = (slot + np.uint64(1)) & mask
+        tkeys[slot, 0] = keys[idx, 0]
+        tkeys[slot, 1] = keys[idx, 1]
+        tvals[slot] = vals[idx]
+        tflags[slot] = flags[idx]
+
+
+@njit
+def _lookup_barcode_slot(key1, key2, tkeys, tvals):
+    "slot of the packed key pair in the table or -1"
+    mask = np.uint64(tvals.shape[0] - 1)
+    slot = _barcode_slot(key1, key2, mask)
+    while tvals[slot] != -1:
+        if tkeys[slot, 0] == key1 and tkeys[slot, 1] == key2:
+            return np.int64(slot)
+        slot = (slot + np.uint64(1)) & mask
+    return -1
+
+
+@njit
+def _lookup_barcode(key1, key2, tkeys, tvals):
+    "value of the packed key pair in the table or -1"
+    slot = _lookup_barcode_slot(key1, key2, tkeys, tvals)
+    if slot < 0:
+        return -1
+    return tvals[slot]
+
+
+@njit
+def _pack_window(row, start, end, lut):
+    "packs row[start:end] or returns BAD_KEY if it cannot match a barcode"
+    if end - start > 16:
+        return BAD_KEY
+    key = np.uint64(0)
+    for idx in range(start, end):
+        code = lut[row[idx]]
+        if not code:
+            return BAD_KEY
+        key = (key << np.uint64(4)) | code
+    return key
+
+
+@njit
+def _find_cut_barcode(row, length, cuts, cutlens, longbar):
+    """
+    Returns the end of the barcode at the start of a read, i.e., the last
+    occurrence of the first cutter found in read[:longbar + len(cut) + 1]
+    (str.rsplit) or the full search window if no cutter is found.
+    """
+    end = 0
+    for cidx in range(cuts.shape[0]):
+        lcut = cutlens[cidx]
+        if not lcut:
+            continue
+        wind = min(length, longbar + lcut + 1)
+        end = wind
+        for pos in range(wind - lcut, -1, -1):
+            hit = True
+            for jdx in range(lcut):
+                if row[pos + jdx] != cuts[cidx, jdx]:
+                    hit = False
+                    break
+            if hit:
+                return pos
+    return end
+
+
+@njit
+def _find_i7_barcode(buf, first, last):
+    """
+    Returns the (start, end) of the i7 index in the header line at 
+    buf[first:last], same as header.rsplit(":", 1)[-1].split("+")[0].strip()
+    """
+    start = first
+    for pos in range(last - 1, first - 1, -1):
+        if buf[pos] == 58:       # :
+            start = pos + 1
+            break
+    end = last
+    for pos in range(start, last):
+        if buf[pos] == 43:       # +
+            end = pos
+            break
+    # ascii whitespace as in str.strip(): \t\n\v\f\r, \x1c-\x1f, space
+    while start < end and (
+            (9 <= buf[start] <= 13) or (28 <= buf[start] <= 32)):
+        start += 1
+    while end > start and (
+            (9 <= buf[end - 1] <= 13) or (28 <= buf[end - 1] <= 32)):
+        end -= 1
+    return start, end
+
+
+@njit
+def match_i7_numba(buf, ends, lut, tkeys, tvals):
+    """
+    find, pack and look up the i7 index of a block of header lines joined
+    in buf, where ends are the offsets of the end of each line. Returns 
+    the same arrays as match_barcodes_numba, nothing is trimmed.
+    """
+    nreads = ends.shape[0]
+    sidx = np.zeros(nreads, dtype=np.int64) - 1
+    keys = np.zeros((nreads, 2), dtype=np.uint64)
+    nonempty = np.zeros(nreads, dtype=np.bool_)
+    lenbars = np.zeros(nreads, dtype=np.int64)
+
+    first = 0
+    for ridx in range(nreads):
+        start, end = _find_i7_barcode(buf, first, ends[ridx])
+        first = ends[ridx]
+        nonempty[ridx] = end > start
+        key1 = _pack_window(buf, start, end, lut)
+        if key1 != BAD_KEY:
+            sidx[ridx] = _lookup_barcode(key1, np.uint64(0), tkeys, tvals)
+            keys[ridx, 0] = key1
+    return sidx, keys, nonempty, lenbars, lenbars
+
+
+@njit
+def match_barcodes_numba(
+    seqs1, lens1, seqs2, lens2, mode, cuts, cutlens, 
+    longbar1, longbar2, lencut, lut, tkeys, tvals):
+    "find, pack and look up the barcodes of a block of reads"
+    nreads = seqs1.shape[0]
+    sidx = np.zeros(nreads, dtype=np.int64) - 1
+    keys = np.zeros((nreads, 2), dtype=np.uint64)
+    nonempty = np.zeros(nreads, dtype=np.bool_)
+    lenbars1 = np.zeros(nreads, dtype=np.int64)
+    lenbars2 = np.zeros(nreads, dtype=np.int64)
+
+    for ridx in range(nreads):
+        row = seqs1[ridx]
+        key2 = np.uint64(0)
+
+        # 2brad: read[:-lencut][-longbar:], row is the tail of the read
+        if mode == BATCH_2BRAD:
+            length = lens1[ridx]
+            offset = length - min(length, seqs1.shape[1])
+            end = max(length - lencut, 0)
+            start = max(end - longbar1, 0)
+            key1 = _pack_window(row, start - offset, end - offset, lut)
+            lenbar = end - start
+
+        # read[:longbar]
+        elif mode == BATCH_FIXED:
+            end = min(lens1[ridx], longbar1)
+            key1 = _pack_window(row, 0, end, lut)
+            lenbar = end
+
+        # read[:longbar + len(cut) + 1].rsplit(cut, 1)[0]
+        else:
+            end = _find_cut_barcode(row, lens1[ridx], cuts, cutlens, longbar1)
+            key1 = _pack_window(row, 0, end, lut)
+            lenbar = end
+
+        # 3rad: barcode1 + "+" + barcode2 is never empty
+        if mode == BATCH_3RAD:
+            end2 = _find_cut_barcode(
+                seqs2[ridx], lens2[ridx], cuts, cutlens, longbar2)
+            key2 = _pack_window(seqs2[ridx], 0, end2, lut)
+            lenbars2[ridx] = end2
+            nonempty[ridx] = True
+        else:
+            nonempty[ridx] = lenbar > 0
 
-    # appends to file for each sample, avoids parallel fighting by using 
-    # pid assigned file handle.
-    for sname in dsort:
+        lenbars1[ridx] = lenbar
+        if key1 != BAD_KEY and key2 != BAD_KEY:
+            sidx[ridx] = _lookup_barcode(key1, key2, tkeys, tvals)
+            keys[ridx, 0] = key1
+            keys[ridx, 1] = key2
+    return sidx, keys, nonempty, lenbars1, lenbars2
 
-        # file out handle
-        handle = os.path.join(
-            data.dirs.fastqs, 
-            "tmpdir",
-            "tmp_{}_{}_{}.fastq".format(sname, rrr, pid))
 
-        # append to this sample name
-        with open(handle, 'a') as out:
-            out.write("".join(dsort[sname]))
+def repair_sample_files(data, manifests):
+    """
+    Called when resuming an interrupted run. Rewrites sample files to keep
+    only the byte ranges (gzip members) written by committed groups of
+    chunks, which drops anything written by chunks that died or were not
+    yet committed, and updates the offsets in the manifests to match. 
+    Files already valid are not touched.
+    """
+    # {path: [(start, length, manifest writes list, index in it), ...]}
+    ranges = {}
+    for manifest in manifests.values():
+        for sname, writes in manifest["offsets"].items():
+            for write in writes:
+                for ridx, rname in ((0, "R1"), (2, "R2")):
+                    if write[ridx + 1]:
+                        path = os.path.join(
+                            data.dirs.fastqs, 
+                            "{}_{}_.fastq.gz".format(sname, rname))
+                        ranges.setdefault(path, []).append((write, ridx))
+
+    # remove files only written to by unfinished chunks
+    for path in glob.glob(os.path.join(data.dirs.fastqs, "*_R[12]_.fastq.gz")):
+        if path not in ranges:
+            os.remove(path)
+
+    # rewrite files that have gaps
+    changed = False
+    for path, writes in ranges.items():
+        writes.sort(key=lambda x: x[0][x[1]])
+        pos = 0
+        valid = True
+        for write, ridx in writes:
+            if write[ridx] != pos:
+                valid = False
+            pos += write[ridx + 1]
+        if valid and pos == os.path.getsize(path):
+            continue
 
+        changed = True
+        pos = 0
+        with open(path, 'rb') as infile, open(path + ".tmp", 'wb') as out:
+            for write, ridx in writes:
+                infile.seek(write[ridx])
+                out.write(infile.read(write[ridx + 1]))
+                write[ridx] = pos
+                pos += write[ridx + 1]
+        os.rename(path + ".tmp", path)
+
+    # store updated offsets
+    if changed:
+        tmpdir = os.path.join(data.dirs.fastqs, "tmpdir")
+        for manifest in manifests.values():
+            mfile = os.path.join(
+                tmpdir, "done_{}.json".format(manifest["chunk"]))
+            with open(mfile + ".tmp", 'w') as out:
+                json.dump(manifest, out)
+            os.rename(mfile + ".tmp", mfile)
+
+
+def get_sample_name(data, name):
+    """
+    Returns the sample that reads of a barcodes name are written to. 
+    Technical replicates (name-technical-replicate-N) are merged into one
+    sample unless hackersonly.merge_technical_replicates is False.
+    """
+    if data.hackersonly.merge_technical_replicates:
+        if "-technical-replicate-" in name:
+            return name.rsplit("-technical-replicate", 1)[0]
+    return name
 
 
-def collate_files(data, sname, tmp1s, tmp2s):
-    """ 
-    Collate temp fastq files in tmp-dir into 1 gzipped sample.
-    """
-    ## out handle
-    out1 = os.path.join(data.dirs.fastqs, "{}_R1_.fastq.gz".format(sname))
-    out = io.BufferedWriter(gzip.open(out1, 'w'))
-
-    ## build cmd
-    cmd1 = ['cat']
-    for tmpfile in tmp1s:
-        cmd1 += [tmpfile]
-
-    ## compression function
-    proc = sps.Popen(['which', 'pigz'], 
-        stderr=sps.PIPE, 
-        stdout=sps.PIPE).communicate()
-    if proc[0].strip():
-        compress = ["pigz"]
-    else:
-        compress = ["gzip"]
+def get_sample_names(data):
+    "sorted sample names of the barcodes (technical replicates grouped)"
+    return sorted(set(get_sample_name(data, i) for i in data.barcodes))
 
-    ## call cmd
-    proc1 = sps.Popen(cmd1, stderr=sps.PIPE, stdout=sps.PIPE)
-    proc2 = sps.Popen(compress, 
-        stdin=proc1.stdout, 
-        stderr=sps.PIPE, 
-        stdout=out)
-    err = proc2.communicate()
-    if proc2.returncode:
-        raise IPyradError("error in collate_files R1 %s", err)
-    proc1.stdout.close()
-    out.close()
-
-    ## then cleanup
-    for tmpfile in tmp1s:
-        os.remove(tmpfile)
-
-    if 'pair' in data.params.datatype:
-        ## out handle
-        out2 = os.path.join(data.dirs.fastqs, "{}_R2_.fastq.gz".format(sname))
-        out = io.BufferedWriter(gzip.open(out2, 'w'))
-
-        ## build cmd
-        cmd1 = ['cat']
-        for tmpfile in tmp2s:
-            cmd1 += [tmpfile]
-
-        ## call cmd
-        proc1 = sps.Popen(cmd1, stderr=sps.PIPE, stdout=sps.PIPE)
-        proc2 = sps.Popen(compress, 
-            stdin=proc1.stdout,
-            stderr=sps.PIPE, 
-            stdout=out)
-        err = proc2.communicate()
-        if proc2.returncode:
-            raise IPyradError("error in collate_files R2 %s", err)
-        proc1.stdout.close()
-        out.close()
-
-        ## then cleanup
-        for tmpfile in tmp2s:
-            os.remove(tmpfile)
-
-
-def inverse_barcodes(data):
-    """ Build full inverse barcodes dictionary """
+
+def inverse_barcodes(data, ambigs=None):
+    """ 
+    Build full inverse barcodes dictionary. If a set is passed as 'ambigs'
+    it is filled with barcodes within max_barcode_mismatch of >1 sample.
+    """
+    if ambigs is None:
+        ambigs = set()
     matchdict = {}
     bases = set("CATGN")
     poss = set()
 
     # do perfect matches
-    for sname, barc in data.barcodes.items():
+    for rname, barc in data.barcodes.items():
         
         # remove -technical-replicate-N if present
-        if "-technical-replicate-" in sname:
-            sname = sname.rsplit("-technical-replicate", 1)[0]
+        sname = get_sample_name(data, rname)
 
         # store {barcode: name} mapping
+        if matchdict.get(barc, sname) != sname:
+            ambigs.add(barc)
         matchdict[barc] = sname
 
         # record that this barcodes has been seen
@@ -1245,6 +2562,8 @@ def inverse_barcodes(data):
 
                     # if it has been seen in another taxon, problem.
                     else:
+                        if matchdict.get(tbar1) != sname:
+                            ambigs.add(tbar1)
                         print("""\n
         Warning: 
         Sample: {} ({})
@@ -1271,10 +2590,11 @@ def inverse_barcodes(data):
                                 ltbar[idx2] = diff
                                 tbar2 = "".join(ltbar)
                                 if tbar2 not in poss:
-                                    matchdict[tbar2] = sname                    
+                                    matchdict[tbar2] = sname
                                     poss.add(tbar2)
                                 else:
                                     if matchdict.get(tbar2) != sname:
+                                        ambigs.add(tbar2)
                                         print("""\
         Note: barcodes {}:{} and {}:{} are within {} base change of each other\
              Ambiguous barcodes that match to both samples will arbitrarily
@@ -1286,48 +2606,335 @@ def inverse_barcodes(data):
     return matchdict
 
 
-def estimate_nreads(data, testfile):
+def read_index_path(fastq):
+    "path of the read index saved next to a raw fastq file"
+    return fastq + ".ipyrad-index.json"
+
+
+def load_read_index(fastq):
+    """
+    Returns the read index dict of a fastq file (nreads) if one was saved and the file has not changed since, else None.
+    """
+    try:
+        with open(read_index_path(fastq), 'r') as infile:
+            index = json.load(infile)
+        fstat = os.stat(fastq)
+    except (IOError, OSError, ValueError):
+        return None
+    if (index.get("size"), index.get("mtime")) != (
+            fstat.st_size, int(fstat.st_mtime)):
+        return None
+    return index
+
+
+def save_read_index(fastq, nreads):
+    """
+    Save the exact number of reads in a fastq file. Skipped silently if 
+    the raw data dir is not writable.
+    """
+    fstat = os.stat(fastq)
+    index = {
+        "size": fstat.st_size,
+        "mtime": int(fstat.st_mtime),
+        "nreads": int(nreads),
+    }
+    try:
+        with open(read_index_path(fastq), 'w') as out:
+            json.dump(index, out)
+    except (IOError, OSError):
+        pass
+
+
+def estimate_nreads(data, testfile, nblocks=4, blocksize=int(1e6)):
     """ 
-    Estimate a reasonable optim value by grabbing a chunk of sequences, 
-    decompressing and counting them, to estimate the full file size.
+    Returns the number of reads in a raw file from its saved read index, 
+    else estimates it from the reads per compressed byte in the first few
+    compressed blocks. Exact if the whole file fits in the sampled blocks.
     """
-    ## count the len of one file and assume all others are similar len
+    index = load_read_index(testfile)
+    if index:
+        return index["nreads"]
+
     insize = os.path.getsize(testfile)
-    tmp_file_name = os.path.join(
-        data.params.project_dir, 
-        "tmp-step1-count.fq")
+    gzipped = testfile.endswith(".gz")
+    nlines = 0
+    consumed = 0
+    with open(testfile, 'rb') as infile:
+        # auto-detect gzip header, restart on concatenated gzip members
+        decomp = zlib.decompressobj(zlib.MAX_WBITS | 32)
+        for _ in range(nblocks):
+            chunk = infile.read(blocksize)
+            if not chunk:
+                break
+            consumed += len(chunk)
+            if not gzipped:
+                nlines += chunk.count(b"\n")
+                continue
+            try:
+                while chunk:
+                    nlines += decomp.decompress(chunk).count(b"\n")
+                    chunk = decomp.unused_data
+                    if decomp.eof:
+                        decomp = zlib.decompressobj(zlib.MAX_WBITS | 32)
+            # e.g., trailing garbage after the last member
+            except zlib.error:
+                break
+
+    # the whole file was read
+    if consumed >= insize or not consumed:
+        return nlines // 4
+    return int(insize * (nlines / 4.) / consumed)
+
+
+def is_bgzf(path):
+    """
+    True if a file starts with a BGZF block (bgzip/htslib), i.e., a gzip
+    member with a 'BC' extra subfield holding the compressed block size.
+    """
+    with open(path, 'rb') as infile:
+        return is_bgzf_header(infile.read(BGZF_HEADER_SIZE))
+
+
+def is_bgzf_header(header):
+    "check the fixed fields of a BGZF block header"
+    return (
+        len(header) == BGZF_HEADER_SIZE and
+        header[:4] == b"\x1f\x8b\x08\x04" and
+        header[10:16] == b"\x06\x00BC\x02\x00"
+    )
+
+
+def read_bgzf_block(handle):
+    """
+    Read the BGZF block at the current position of an open file. Returns
+    the decompressed data and the compressed size of the block, or 
+    (None, 0) at the end of the file.
+    """
+    header = handle.read(BGZF_HEADER_SIZE)
+    if not header:
+        return None, 0
+    if not is_bgzf_header(header):
+        raise IPyradError(BAD_BGZF_BLOCK.format(handle.name))
+    bsize = struct.unpack("<H", header[16:18])[0] + 1
+    block = header + handle.read(bsize - BGZF_HEADER_SIZE)
+    return zlib.decompress(block, 31), bsize
+
+
+def find_bgzf_block(handle, offset):
+    """
+    Returns the offset of the first BGZF block that starts at or after 
+    'offset'. A candidate header must be followed by another block header
+    (or the end of the file) to not match compressed data by chance.
+    """
+    size = os.fstat(handle.fileno()).st_size
+    pos = offset
+    while pos < size:
+        handle.seek(pos)
+        data = handle.read(BGZF_SCAN_SIZE)
+        hit = data.find(b"\x1f\x8b\x08\x04")
+        while hit >= 0:
+            start = pos + hit
+            handle.seek(start)
+            header = handle.read(BGZF_HEADER_SIZE)
+            if is_bgzf_header(header):
+                bsize = struct.unpack("<H", header[16:18])[0] + 1
+                handle.seek(start + bsize)
+                after = handle.read(BGZF_HEADER_SIZE)
+                if not after or is_bgzf_header(after):
+                    return start
+            hit = data.find(b"\x1f\x8b\x08\x04", hit + 1)
+        # keep a few bytes in case a header spans the read
+        pos += max(1, len(data) - BGZF_HEADER_SIZE)
+    return size
+
+
+def iter_bgzf_lines(path, voffset):
+    """
+    Yields (virtual offset, line) of a BGZF file starting at a virtual 
+    offset (compressed block offset << 16 | offset in the block), the 
+    same positions used by htslib (BAM/tabix) indexes.
+    """
+    coffset = voffset >> 16
+    uoffset = voffset & 0xFFFF
+    partial = b""
+    pstart = None
+    with open(path, 'rb') as infile:
+        infile.seek(coffset)
+        while 1:
+            data, bsize = read_bgzf_block(infile)
+            if data is None:
+                break
+            pos = uoffset
+            uoffset = 0
+            while pos < len(data):
+                if pstart is None:
+                    pstart = (coffset << 16) | pos
+                end = data.find(b"\n", pos)
+                if end < 0:
+                    partial += data[pos:]
+                    break
+                yield pstart, partial + data[pos:end + 1]
+                partial = b""
+                pstart = None
+                pos = end + 1
+            coffset += bsize
+    if partial:
+        yield pstart, partial
+
 
-    if testfile.endswith(".gz"):
-        infile = gzip.open(testfile)
-        outfile = gzip.open(tmp_file_name, 'w', compresslevel=5)
+def iter_raw_lines(path, offset, bgzf):
+    """
+    Yields (position, line) for the lines that start after byte 'offset' 
+    of an uncompressed or BGZF file. The line that 'offset' falls in is
+    skipped, unless 'offset' is 0. Positions are byte offsets, or virtual
+    offsets for BGZF files.
+    """
+    if bgzf:
+        with open(path, 'rb') as infile:
+            start = find_bgzf_block(infile, offset)
+        lines = iter_bgzf_lines(path, start << 16)
     else:
-        infile = open(testfile)
-        outfile = open(tmp_file_name, 'w')
-        
-    ## We'll take the average of the size of a file based on the
-    ## first 10000 reads to approximate number of reads in the main file
-    try:
-        dat = b"".join(islice(infile, 40000))
-    except TypeError:
-        dat = "".join(islice(infile, 40000))
-    outfile.write(dat)
-    outfile.close()
-    infile.close()
-
-    ## Get the size of the tmp file
-    tmp_size = os.path.getsize(tmp_file_name)
-
-    # divide by the tmp file size and multiply by 10000 to approximate
-    # the size of the input .fq files
-    # If the input file is less than 40000 lines long the islice returns
-    # 0, so here just return the full file size because this is toy data.
-    try:
-        inputreads = int(insize / tmp_size) * 10000
-    except ZeroDivisionError:
-        inputreads = insize
-    os.remove(tmp_file_name)
+        start = offset
+        lines = _iter_plain_lines(path, max(0, offset - 1))
+    if start:
+        next(lines, None)
+    for pos, line in lines:
+        yield pos, line
+
+
+def _iter_plain_lines(path, offset):
+    "yields (byte offset, line) of an uncompressed file from 'offset'"
+    with open(path, 'rb') as infile:
+        infile.seek(offset)
+        pos = offset
+        for line in infile:
+            yield pos, line
+            pos += len(line)
+
+
+def get_read_name(header):
+    "read name of a fastq header line w/o the comment or /1 /2 suffix"
+    name = header.split()[0] if header.strip() else header
+    if name[-2:] in (b"/1", b"/2"):
+        name = name[:-2]
+    return name
+
 
-    return inputreads
+def find_record_start(path, offset, bgzf=False, name=None, maxpos=None):
+    """
+    Returns (position, read name) of the first fastq record that starts 
+    after byte 'offset': a line starting with '@' that is followed two 
+    lines later by a line starting with '+'. If 'name' is given, returns
+    the first record with that read name instead, searching records that 
+    start before position 'maxpos'. Returns (None, None) if not found.
+    """
+    lines = iter_raw_lines(path, offset, bgzf)
+    window = [next(lines, (None, b"")) for _ in range(3)]
+    while window[0][0] is not None:
+        pos, line = window[0]
+        if maxpos is not None and pos >= maxpos:
+            break
+        if line.startswith(b"@") and window[2][1].startswith(b"+"):
+            rname = get_read_name(line)
+            if name is None or rname == name:
+                return pos, rname
+        window = window[1:] + [next(lines, (None, b""))]
+    return None, None
+
+
+def plan_byte_ranges(ftup, optim):
+    """
+    Cut uncompressed or BGZF-compressed (bgzip) raw files into FileRanges
+    of about 'optim' reads w/o decompressing them. R1 is cut anywhere and 
+    moved to the next record start. R2 is cut at the record with the same
+    read name, searched for near the same fraction of the file. Returns 
+    None if the files cannot be cut (plain gzip cannot be entered mid-
+    stream, or R2 reads were not found) and must be split by 
+    zcat_make_temps.
+    """
+    files = [i for i in ftup if i]
+    bgzfs = [i.endswith(".gz") and is_bgzf(i) for i in files]
+    if any(i.endswith(".gz") and not j for (i, j) in zip(files, bgzfs)):
+        return None
+    sizes = [os.path.getsize(i) for i in files]
+    ends = [j << 16 if k else j for (j, k) in zip(sizes, bgzfs)]
+    nreads = estimate_nreads(None, ftup[0])
+    nchunks = max(1, int(round(nreads / float(max(1, optim)))))
+
+    # R1 cuts at record starts
+    cuts1 = [(0, None)]
+    for idx in range(1, nchunks):
+        pos, name = find_record_start(
+            files[0], int(sizes[0] * idx / nchunks), bgzfs[0])
+        if pos is not None and pos > cuts1[-1][0]:
+            cuts1.append((pos, name))
+    cuts = [[i[0] for i in cuts1] + [ends[0]]]
+
+    # R2 cuts at the same reads as R1
+    if len(files) > 1:
+        margin = max(BGZF_SCAN_SIZE, int(sizes[1] * R2_SEARCH_MARGIN))
+        cuts.append([0])
+        for pos1, name in cuts1[1:]:
+            frac = (pos1 >> 16 if bgzfs[0] else pos1) / float(sizes[0])
+            approx = int(sizes[1] * frac)
+            maxpos = approx + margin
+            pos, _ = find_record_start(
+                files[1], max(0, approx - margin), bgzfs[1], name,
+                maxpos << 16 if bgzfs[1] else maxpos)
+            if pos is None or pos <= cuts[1][-1]:
+                return None
+            cuts[1].append(pos)
+        cuts[1].append(ends[1])
+
+    ranges = []
+    for idx in range(len(cuts[0]) - 1):
+        frs = [
+            FileRange(fname, fcuts[idx], fcuts[idx + 1], bgzf) 
+            for (fname, fcuts, bgzf) in zip(files, cuts, bgzfs)
+        ]
+        ranges.append(tuple(frs) if len(frs) > 1 else (frs[0], 0))
+    return ranges
+
+
+# used by remote_run_barmatch_streaming()
+def iter_fastq_blocks(ftup, blocksize):
+    """
+    Decompress R1 (and R2) once and yield tuples of aligned byte blocks of
+    'blocksize' whole fastq records. R1 and R2 are decompressed in separate
+    threads (zlib releases the GIL) and the next block is read while the 
+    current one is being consumed. Raises an IPyradError if R1 and R2 
+    do not have the same number of records.
+    """
+    def _open(path):
+        if not path:
+            return None
+        if path.endswith(".gz"):
+            return gzip.open(path, 'rb')
+        return open(path, 'rb')
+
+    def _read(handle):
+        if handle is None:
+            return 0, 0
+        lines = list(islice(handle, 4 * blocksize))
+        return b"".join(lines), len(lines)
+
+    handles = [_open(ftup[0]), _open(ftup[1])]
+    try:
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            nexts = [pool.submit(_read, i) for i in handles]
+            while 1:
+                (r1, n1), (r2, n2) = (i.result() for i in nexts)
+                if handles[1] is not None and n1 != n2:
+                    raise IPyradError(
+                        PAIRS_DIFFER.format(ftup[0], ftup[1]))
+                if not r1:
+                    break
+                nexts = [pool.submit(_read, i) for i in handles]
+                yield r1, r2
+    finally:
+        for handle in handles:
+            if handle is not None:
+                handle.close()
 
 
 # used by splitfiles()
@@ -1399,6 +3006,44 @@ def zcat_make_temps(data, ftup, num, tmpdir, optim, start):
 
 
 ## GLOBALS
+# written to tmpdir at the start of a run, allows resuming it
+RESUME_FILE = "s1_resume.json"
+
+# fixed size of a BGZF block header and bytes read when looking for one
+BGZF_HEADER_SIZE = 18
+BGZF_SCAN_SIZE = int(4e6)
+
+# fraction of the R2 file searched on each side for the read an R1 cut
+# starts with, the compression ratios of R1 and R2 drift only slowly.
+R2_SEARCH_MARGIN = 0.005
+
+# cache of line counts of sorted_fastq_path files, in the project dir
+READ_COUNTS_CACHE = "s1_read_counts.json"
+
+# barcode parsing modes of BatchMatcher
+BATCH_2BRAD = 0
+BATCH_FIXED = 1
+BATCH_CUTTER = 2
+BATCH_3RAD = 3
+BATCH_I7 = 4
+
+# odd multipliers for the rows of the MissSketch hash (two per row)
+SKETCH_SEEDS = np.array([
+    [0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F],
+    [0x165667B19E3779F9, 0xD6E8FEB86659FD93],
+    [0xFF51AFD7ED558CCD, 0xC4CEB9FE1A85EC53],
+    [0x94D049BB133111EB, 0xBF58476D1CE4E5B9],
+    [0x2545F4914F6CDD1D, 0x9FB21C651E98DF25],
+    [0xD1342543DE82EF95, 0xAEF17502108EF2D9],
+], dtype=np.uint64)
+
+# 4-bit codes for packing barcodes, 0 cannot be in a barcode
+BARCODE_LUT = np.zeros(256, dtype=np.uint64)
+BARCODE_BASES = "ACGTNRKSYWM"
+for _idx, _base in enumerate(BARCODE_BASES):
+    BARCODE_LUT[ord(_base)] = _idx + 1
+BAD_KEY = np.uint64(0xFFFFFFFFFFFFFFFF)
+
 NO_RAWS = """\
     No data found in {}. Fix path to data files.
     """
@@ -1417,6 +3062,26 @@ NO_SEQ_PATH_FOUND = """\
         (1) a sorted_fastq_path
         (2) a raw_fastq_path + barcodes_path
     """
+BAD_BGZF_BLOCK = """\
+    Error: invalid BGZF block in {}. The file may be truncated or
+    corrupted.
+    """
+RESUME_PARAMS_CHANGED = """\
+    Error: Found an interrupted step 1 run in {}
+    but its raw files or barcode params differ from the current ones.
+    Use force to overwrite and start over.
+    """
+RESUME_MODE_CHANGED = """\
+    Error: Found an interrupted step 1 run in {}
+    that sorted reads in a different mode than this run ({}), e.g.,
+    streaming was turned on/off or is unavailable on these engines.
+    Use force to overwrite and start over.
+    """
+PAIRS_DIFFER = """\
+    Error: R1 and R2 files have a different number of reads:
+    {}
+    {}
+    """
 SAMPLES_EXIST = """\
     Error: {} Samples already found in Assembly {}.
     (Use force argument to overwrite)
@@ -3,16 +3,24 @@
 """ 
 Modifies and/or trims reads based on quality scores, presence of adapters, 
 and user entered options to trim ends of reads. Uses the probabilistic trimming
-methods implemented in the 'cutadapt' software.
+methods implemented in the 'cutadapt' software, or by an equivalent built-in
+engine (hackersonly.filter_adapters_mode = 'builtin').
 """
 
 from __future__ import print_function
 
 import os
 import io
+import gzip
+import json
 import time
+import heapq
+import socket
+import threading
+from itertools import islice
 import numpy as np
 import subprocess as sps
+from numba import njit
 from .utils import IPyradError, fullcomp
 
 
@@ -21,9 +29,9 @@ class Step2(object):
         self.data = data
         self.force = force
         self.ipyclient = ipyclient
-        self.lbview = self.ipyclient.load_balanced_view(self.ipyclient.ids[::2])
         self.print_headers()
         self.samples = self.get_subsamples()
+        self.check_index_mode()
         self.check_binaries()
         self.setup_dirs()
         self.check_adapters()
@@ -85,13 +93,40 @@ class Step2(object):
             os.makedirs(self.data.dirs.edits)        
 
 
+    def check_index_mode(self):
+        "trim coordinates (trim_reads_as_index) come from the built-in engine"
+        if self.data.hackersonly.trim_reads_as_index:
+            if self.data.hackersonly.filter_adapters_mode != "builtin":
+                raise IPyradError(
+                    "trim_reads_as_index requires filter_adapters_mode "
+                    "'builtin'")
+
+
     def check_binaries(self):
+        # the built-in engine uses one thread per job, cutadapt jobs reserve
+        # extra engines for their compression subprocesses.
+        self.maxthreads = 1
+        self.headroom = 0
+        if self.data.hackersonly.filter_adapters_mode == "builtin":
+            return
+        self.headroom = TRIM_CUTADAPT_HEADROOM
         cmd = ['which', 'cutadapt']
         proc = sps.Popen(cmd, stderr=sps.PIPE, stdout=sps.PIPE)
         comm = proc.communicate()[0]
         if not comm:
             raise IPyradError("program 'cutadapt' not found.")
 
+        # cutadapt >=1.18 can use multiple cores for SE and PE data
+        cmd = ['cutadapt', '--version']
+        proc = sps.Popen(cmd, stderr=sps.STDOUT, stdout=sps.PIPE)
+        comm = proc.communicate()[0].decode().strip()
+        try:
+            version = tuple(int(i) for i in comm.split(".")[:2])
+        except ValueError:
+            version = (0, 0)
+        if version >= (1, 18):
+            self.maxthreads = TRIM_MAX_THREADS
+
 
     def check_adapters(self):
         """
@@ -110,73 +145,27 @@ class Step2(object):
 
 
     def run(self):
-        self.remote_concat_multiple_raws()
-        self.remote_run_cutadapt()
+        if self.data.hackersonly.filter_adapters_mode == "builtin":
+            self.remote_run_builtin()
+        else:
+            self.remote_run_cutadapt()
         self.assembly_cleanup()
         self.data.save()
 
 
-    def remote_concat_multiple_raws(self):
-        "concatenate multiple raw files into a single file."
-
-        # if no samples have multiple then just move on
-        if not any([len(i.files.fastqs) > 1 for i in self.samples]):
-            for sample in self.samples:
-                sample.files.concat = sample.files.fastqs
-
-        # otherwise concatenate them
-        else:
-            # run on single engine due to i/o limits
-            start = time.time()
-            printstr = ("concatenating inputs", "s2")
-            finished = 0
-            catjobs = {}
-            for sample in self.samples:
-                if len(sample.files.fastqs) > 1:
-                    catjobs[sample.name] = self.lbview.apply(
-                        concat_multiple_inputs, *(self.data, sample))
-                else:
-                    sample.files.concat = sample.files.fastqs
-
-            # wait for all to finish
-            while 1:
-                finished = sum([i.ready() for i in catjobs.values()])
-                self.data._progressbar(len(catjobs), finished, start, printstr)
-                time.sleep(0.1)
-                if finished == len(catjobs):
-                    break
-
-            # collect results, which are concat file handles.
-            self.data._print("")
-            for rasync in catjobs:
-                self.data.samples[rasync].files.concat = catjobs[rasync].get()
-
-
     def remote_run_cutadapt(self):
         # choose cutadapt function based on datatype
-        start = time.time()
-        printstr = ("processing reads    ", "s2")
-        finished = 0
-        rawedits = {}
-
-        # send samples to cutadapt filtering
-        for sample in self.samples:
-            if "pair" in self.data.params.datatype:
-                rasync = self.lbview.apply(
-                    cutadaptit_pairs, *(self.data, sample))
-            else:
-                rasync = self.lbview.apply(
-                    cutadaptit_single, *(self.data, sample))
-            rawedits[sample.name] = rasync
+        if "pair" in self.data.params.datatype:
+            func = cutadaptit_pairs
+        else:
+            func = cutadaptit_single
 
-        # wait for all to finish
-        while 1:
-            finished = sum([i.ready() for i in rawedits.values()])
-            self.data._progressbar(len(rawedits), finished, start, printstr)
-            time.sleep(0.1)
-            if finished == len(rawedits):
-                print("")
-                break
+        # send samples to cutadapt filtering, largest first
+        rawedits = self.run_scheduled(
+            [(func, (self.data, sample)) for sample in self.samples],
+            [sample.stats.reads_raw for sample in self.samples],
+        )
+        rawedits = dict(zip([i.name for i in self.samples], rawedits))
 
         # collect results, report failures, store stats. async = sample.name
         faildict = {}
@@ -192,6 +181,146 @@ class Step2(object):
             except Exception as inst:
                 faildict[self.data.samples[rasync]] = inst
 
+        self.report_failures(faildict)
+
+
+    def remote_run_builtin(self):
+        """
+        Trims reads with the built-in engine. Samples (sorted largest first)
+        are grouped into jobs of at least TRIM_JOB_READS reads, or of the 
+        reads per engine if fewer, so that many small samples are trimmed
+        by one engine call.
+        """
+        target = min(
+            TRIM_JOB_READS, 
+            sum(i.stats.reads_raw for i in self.samples) / 
+            float(len(self.ipyclient.ids)),
+        )
+        jobs = [[]]
+        nreads = 0
+        for sample in self.samples:
+            if nreads >= target:
+                jobs.append([])
+                nreads = 0
+            jobs[-1].append(sample)
+            nreads += sample.stats.reads_raw
+
+        # send groups of samples to the trimming engine, largest first
+        sizes = [sum(i.stats.reads_raw for i in samples) for samples in jobs]
+        order = np.argsort(sizes, kind="mergesort")[::-1]
+        jobs = [jobs[i] for i in order]
+        rawedits = self.run_scheduled(
+            [(trim_samples, (self.data, samples)) for samples in jobs],
+            [sizes[i] for i in order],
+        )
+
+        # collect results, report failures, store stats.
+        faildict = {}
+        for samples, rasync in zip(jobs, rawedits):
+            try:
+                results = rasync.get()
+            except Exception as inst:
+                results = {sample.name: inst for sample in samples}
+            for sname, res in results.items():
+                if isinstance(res, Exception):
+                    faildict[self.data.samples[sname]] = res
+                else:
+                    parse_trim_results(
+                        self.data, self.data.samples[sname], res)
+        self.report_failures(faildict)
+
+
+    def get_host_engines(self):
+        "group engine ids by hostname so that threaded jobs stay on a host"
+        hosts = self.ipyclient[:].apply_sync(socket.gethostname)
+        hostdict = {}
+        for host, eid in zip(hosts, self.ipyclient.ids):
+            hostdict.setdefault(host, []).append(eid)
+        return hostdict
+
+
+    def run_scheduled(self, jobs, sizes):
+        """
+        Runs jobs [(func, args), ...], sorted largest first by sizes (reads),
+        on all engines. Each job reserves as many engines on one host as it 
+        has threads (see schedule_threads), plus self.headroom engines for
+        cutadapt's compression subprocesses. The threads are passed to func
+        as an extra arg when maxthreads > 1, and pending jobs are started in
+        order as engines become free. Returns AsyncResults in the order of 
+        jobs. The makespan is predicted before the jobs start from the time
+        per read per thread measured by an earlier run (see load_trim_rate)
+        and reported with the actual one, which updates the stored rate.
+        """
+        hosts = self.get_host_engines()
+        hostsizes = [len(i) for i in hosts.values()]
+        threads, predicted = schedule_threads(
+            sizes, hostsizes, self.maxthreads, self.headroom)
+        engines = reserved_engines(threads, hostsizes, self.headroom)
+
+        # predicted makespan (in reads per thread) scaled by the stored
+        # time per read per thread.
+        ratekey = get_trim_rate_key(self.data)
+        rate = load_trim_rate(self.data.params.project_dir, ratekey)
+        self.data._print(
+            "scheduled {} jobs on {} engines (max {} threads per job): "
+            "predicted makespan {:.1f}s"
+            .format(
+                len(jobs), len(self.ipyclient.ids), max(threads + [1]),
+                predicted * rate)
+        )
+
+        start = time.time()
+        printstr = ("processing reads    ", "s2")
+
+        # start jobs on free engines and release engines of finished jobs
+        free = {host: list(eids) for host, eids in hosts.items()}
+        pending = list(range(len(jobs)))
+        running = {}
+        rasyncs = [None] * len(jobs)
+        elapsed = [0.] * len(jobs)
+        while 1:
+            for jidx in list(pending):
+                if not any(free.values()):
+                    break
+                for host in free:
+                    if len(free[host]) >= engines[jidx]:
+                        eids = free[host][:engines[jidx]]
+                        free[host] = free[host][engines[jidx]:]
+                        func, args = jobs[jidx]
+                        if self.maxthreads > 1:
+                            args = args + (threads[jidx],)
+                        rasyncs[jidx] = (
+                            self.ipyclient[eids[0]].apply_async(func, *args))
+                        running[jidx] = (host, eids, time.time())
+                        pending.remove(jidx)
+                        break
+
+            for jidx in list(running):
+                if rasyncs[jidx].ready():
+                    host, eids, jstart = running.pop(jidx)
+                    free[host].extend(eids)
+                    elapsed[jidx] = time.time() - jstart
+
+            finished = len(jobs) - len(pending) - len(running)
+            self.data._progressbar(len(jobs), finished, start, printstr)
+            if not (pending or running):
+                self.data._print("")
+                break
+            time.sleep(0.1)
+
+        # store the measured time per read per thread for the next run
+        actual = time.time() - start
+        self.data._print("actual makespan {:.1f}s".format(actual))
+        if sum(sizes):
+            save_trim_rate(
+                self.data.params.project_dir, 
+                ratekey, 
+                sum(i * j for i, j in zip(elapsed, threads)) / sum(sizes),
+            )
+        return rasyncs
+
+
+    def report_failures(self, faildict):
         if faildict:
             s2_fail_log = os.path.join(
                 self.data.dirs.edits,
@@ -358,14 +487,83 @@ def parse_pair_results(data, sample, res):
 
 
 # CALLED BY STEP
-def cutadaptit_single(data, sample):
+def cutadaptit_single(data, sample, nthreads=1):
     """ 
     Applies quality and adapter filters to reads using cutadapt. If the ipyrad
     filter param is set to 0 then it only filters to hard trim edges and uses
     mintrimlen. If filter=1, we add quality filters. If filter=2 we add
-    adapter filters. 
+    adapter filters. nthreads > 1 requires cutadapt >=1.18.
     """
     sname = sample.name
+    adapters = get_adapters_single(data, sample)
+    inputs = get_cutadapt_inputs(data, sample)
+
+    # get length trim parameter from new or older version of ipyrad params
+    trim5r1 = trim3r1 = []
+    trimlen = data.params.trim_reads
+
+    # trim 5' end
+    if trimlen[0]:
+        trim5r1 = ["-u", str(trimlen[0])]
+    if trimlen[1] < 0:
+        trim3r1 = ["-u", str(trimlen[1])]
+    if trimlen[1] > 0:
+        trim3r1 = ["--length", str(trimlen[1])]
+    # else:
+        # trimlen = data.paramsdict.get("edit_cutsites")
+        # trim5r1 = ["--cut", str(trimlen[0])]
+
+    # testing new 'trim_reads' setting
+    cmdf1 = ["cutadapt"]
+    if nthreads > 1:
+        cmdf1 += ["--cores", str(nthreads)]
+    if trim5r1:
+        cmdf1 += trim5r1
+    if trim3r1:
+        cmdf1 += trim3r1
+    cmdf1 += [
+        "--minimum-length", str(data.params.filter_min_trim_len),
+        "--max-n", str(data.params.max_low_qual_bases),
+        "--trim-n", 
+        "--output", os.path.join(
+            data.dirs.edits, sname + ".trimmed_R1_.fastq.gz"),
+        inputs[0],
+        ]
+
+    if int(data.params.filter_adapters):
+        # NEW: only quality trim the 3' end for SE data.
+        cmdf1.insert(1, "20")
+        cmdf1.insert(1, "-q")
+        cmdf1.insert(1, str(data.params.phred_Qscore_offset))
+        cmdf1.insert(1, "--quality-base")
+
+    # if filter_adapters==3 then p3_adapters_extra will already have extra
+    # poly adapters added to its list. 
+    if int(data.params.filter_adapters) > 1:
+
+        # enter the main cut and extra cuts (in reverse b/c inserting) so 
+        # that the main cut appears first in the command.
+        for adapter in adapters[::-1]:
+            cmdf1.insert(1, adapter)
+            cmdf1.insert(1, "-a")
+
+    # do modifications to read1 and write to tmp file
+    res1, returncode = run_cutadapt(sample, cmdf1, inputs)
+
+    # raise errors if found
+    if returncode:
+        raise IPyradError(" error in {}\n {}".format(" ".join(cmdf1), res1))
+
+    # return result string to be parsed outside of engine
+    return res1
+
+
+def get_adapters_single(data, sample):
+    """
+    Returns the 3' adapters to search for in single-end reads, the main
+    adapter first, followed by p3_adapters_extra. Used by both trimming 
+    engines.
+    """
     # if (GBS, ddRAD) we look for the second cut site + adapter. For SE
     # data we don't bother trying to remove the second barcode since it's not
     # as critical as with PE data.
@@ -405,9 +603,28 @@ def cutadaptit_single(data, sample):
                 fullcomp(data.params.restriction_overhang[1])[::-1], 
                 data.hackersonly.p3_adapter, 
             ])
+    return [adapter] + list(set(data.hackersonly.p3_adapters_extra))
 
-    # get length trim parameter from new or older version of ipyrad params
-    trim5r1 = trim3r1 = []
+
+# CALLED BY STEP
+# BEING MODIFIED FOR MULTIPLE BARCODES (i.e., merged samples. NOT PERFECT YET)
+def cutadaptit_pairs(data, sample, nthreads=1):
+    """
+    Applies trim & filters to pairs, including adapter detection. If we have
+    barcode information then we use it to trim reversecut+bcode+adapter from 
+    reverse read, if not then we have to apply a more general cut to make sure 
+    we remove the barcode, this uses wildcards and so will have more false 
+    positives that trim a little extra from the ends of reads. Should we add
+    a warning about this when filter_adapters=2 and no barcodes?
+    """
+    sname = sample.name
+
+    ## applied to read pairs
+    finput_r1, finput_r2 = get_cutadapt_inputs(data, sample)
+    adapters1, adapters2 = get_adapters_pairs(data, sample)
+
+    # parse trim_reads
+    trim5r1 = trim5r2 = trim3r1 = trim3r2 = []
     trimlen = data.params.trim_reads
 
     # trim 5' end
@@ -417,79 +634,176 @@ def cutadaptit_single(data, sample):
         trim3r1 = ["-u", str(trimlen[1])]
     if trimlen[1] > 0:
         trim3r1 = ["--length", str(trimlen[1])]
-    # else:
-        # trimlen = data.paramsdict.get("edit_cutsites")
-        # trim5r1 = ["--cut", str(trimlen[0])]
+
+    # legacy support for trimlen = 0,0 default
+    if len(trimlen) > 2:
+        if trimlen[2]:
+            trim5r2 = ["-U", str(trimlen[2])]
+
+    if len(trimlen) > 3:
+        if trimlen[3]:
+            if trimlen[3] < 0:
+                trim3r2 = ["-U", str(trimlen[3])]
+            if trimlen[3] > 0:            
+                trim3r2 = ["--length", str(trimlen[3])]
 
     # testing new 'trim_reads' setting
     cmdf1 = ["cutadapt"]
+    if nthreads > 1:
+        cmdf1 += ["--cores", str(nthreads)]
     if trim5r1:
         cmdf1 += trim5r1
     if trim3r1:
         cmdf1 += trim3r1
+    if trim5r2:
+        cmdf1 += trim5r2
+    if trim3r2:
+        cmdf1 += trim3r2
+
     cmdf1 += [
-        "--minimum-length", str(data.params.filter_min_trim_len),
+        "--trim-n",
         "--max-n", str(data.params.max_low_qual_bases),
-        "--trim-n", 
-        "--output", os.path.join(
+        "--minimum-length", str(data.params.filter_min_trim_len),
+        "-o", os.path.join(
             data.dirs.edits, sname + ".trimmed_R1_.fastq.gz"),
-        sample.files.concat[0][0],
+        "-p", os.path.join(
+            data.dirs.edits, sname + ".trimmed_R2_.fastq.gz"),
+        finput_r1,
+        finput_r2,
         ]
 
+    # additional args
+    if int(data.params.filter_adapters) < 2:
+        # add a dummy adapter to let cutadapt know we are not using legacy-mode
+        cmdf1.insert(1, "XXX")
+        cmdf1.insert(1, "-A")
+
     if int(data.params.filter_adapters):
-        # NEW: only quality trim the 3' end for SE data.
-        cmdf1.insert(1, "20")
+        cmdf1.insert(1, "20,20")
         cmdf1.insert(1, "-q")
         cmdf1.insert(1, str(data.params.phred_Qscore_offset))
         cmdf1.insert(1, "--quality-base")
 
-    # if filter_adapters==3 then p3_adapters_extra will already have extra
-    # poly adapters added to its list. 
     if int(data.params.filter_adapters) > 1:
-
-        # TODO: ------------
-        # first enter extra cuts (order of input is reversed) --------------------
-        for extracut in list(set(data.hackersonly.p3_adapters_extra))[::-1]:
-
-            cmdf1.insert(1, extracut)
+        # first enter extra cuts
+        for ecut1, ecut2 in zip(adapters1[1:], adapters2[1:]):
+            cmdf1.insert(1, ecut1)
             cmdf1.insert(1, "-a")
-        # then put the main cut so it appears first in command
-        cmdf1.insert(1, adapter)
-        cmdf1.insert(1, "-a")
+            cmdf1.insert(1, ecut2)
+            cmdf1.insert(1, "-A")
+        # then put the main cut first
+        cmdf1.insert(1, adapters1[0])
+        cmdf1.insert(1, '-a')        
+        cmdf1.insert(1, adapters2[0])
+        cmdf1.insert(1, '-A')         
 
     # do modifications to read1 and write to tmp file
-    proc1 = sps.Popen(cmdf1, stderr=sps.STDOUT, stdout=sps.PIPE, close_fds=True)
-    try:
-        res1 = proc1.communicate()[0]
-    except KeyboardInterrupt:
-        proc1.kill()
-        raise KeyboardInterrupt
-
-    # raise errors if found
-    if proc1.returncode:
-        raise IPyradError(" error in {}\n {}".format(" ".join(cmdf1), res1))
-
-    # return result string to be parsed outside of engine
+    res1, returncode = run_cutadapt(sample, cmdf1, [finput_r1, finput_r2])
+    if returncode:
+        raise IPyradError("error in cutadapt: {}".format(res1.decode()))
     return res1
 
 
-# CALLED BY STEP
-# BEING MODIFIED FOR MULTIPLE BARCODES (i.e., merged samples. NOT PERFECT YET)
-def cutadaptit_pairs(data, sample):
+
+def get_cutadapt_inputs(data, sample):
     """
-    Applies trim & filters to pairs, including adapter detection. If we have
-    barcode information then we use it to trim reversecut+bcode+adapter from 
-    reverse read, if not then we have to apply a more general cut to make sure 
-    we remove the barcode, this uses wildcards and so will have more false 
-    positives that trim a little extra from the ends of reads. Should we add
-    a warning about this when filter_adapters=2 and no barcodes?
+    Returns the R1 (and R2) inputs for cutadapt. If a sample has multiple 
+    fastq files they are streamed to cutadapt through named pipes (see 
+    run_cutadapt) instead of being concatenated into new files.
     """
-    sname = sample.name
+    nreads = 1 + ("pair" in data.params.datatype)
+    fastqs = sample.files.fastqs
+    if len(fastqs) == 1:
+        return list(fastqs[0][:nreads])
+
+    # pipes carry decompressed reads since cutadapt seeks in gzip inputs
+    pipes = []
+    for ridx in range(nreads):
+        pipe = os.path.join(
+            data.dirs.edits, 
+            "{}_R{}_concat.fastq".format(sample.name, ridx + 1))
+        if os.path.exists(pipe):
+            os.remove(pipe)
+        os.mkfifo(pipe)
+        pipes.append(pipe)
+    return pipes
+
+
+
+def run_cutadapt(sample, cmd, inputs):
+    """
+    Runs cutadapt and returns its report and returncode. If the sample has 
+    multiple fastq files the inputs are named pipes, which are fed with 
+    the (decompressed) files in turn once cutadapt opens them for reading.
+    Each pipe is opened in its own thread, so the order in which cutadapt
+    opens them does not matter.
+    """
+    proc = sps.Popen(cmd, stderr=sps.STDOUT, stdout=sps.PIPE, close_fds=True)
+    streamed = len(sample.files.fastqs) > 1
+    pipes = inputs if streamed else []
+    feeds = [None] * len(pipes)
+
+    def open_feed(ridx):
+        "opening to write blocks until a reader opens the pipe"
+        fdes = os.open(pipes[ridx], os.O_WRONLY)
+        try:
+            feeds[ridx] = sps.Popen(
+                ["gzip", "-cdf"] + [i[ridx] for i in sample.files.fastqs],
+                stdout=fdes, stderr=sps.PIPE, close_fds=True)
+        finally:
+            os.close(fdes)
+
+    threads = [
+        threading.Thread(target=open_feed, args=(i,)) 
+        for i in range(len(pipes))
+    ]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
 
-    ## applied to read pairs
-    finput_r1 = sample.files.concat[0][0]
-    finput_r2 = sample.files.concat[0][1]
+    try:
+        res = proc.communicate()[0]
+
+    except KeyboardInterrupt:
+        proc.kill()
+        proc.wait()
+        raise KeyboardInterrupt
 
+    finally:
+        # open pipes that cutadapt did not (e.g., it failed) to release the
+        # threads blocked on them, then wait for the threads.
+        readers = []
+        for pipe, thread in zip(pipes, threads):
+            if thread.is_alive():
+                readers.append(os.open(pipe, os.O_RDONLY | os.O_NONBLOCK))
+        for thread in threads:
+            thread.join()
+        for fdes in readers:
+            os.close(fdes)
+        if proc.returncode is None or proc.returncode < 0:
+            for feed_proc in feeds:
+                if feed_proc is not None:
+                    feed_proc.kill()
+        for pipe in pipes:
+            if os.path.exists(pipe):
+                os.remove(pipe)
+
+    # a missing input file would otherwise look like a short one
+    for feed_proc in feeds:
+        if feed_proc is None:
+            continue
+        err = feed_proc.communicate()[1]
+        if feed_proc.returncode and not proc.returncode:
+            raise IPyradError("error in gzip: {}".format(err.decode()))
+    return res, proc.returncode
+
+
+def get_adapters_pairs(data, sample):
+    """
+    Returns the adapters to search for in R1 and R2 of paired reads, the
+    main adapters first, followed by pairs of p3/p5_adapters_extra. Used by
+    both trimming engines.
+    """
     ## Get adapter sequences. This is very important. For the forward adapter
     ## we don't care all that much about getting the sequence just before the 
     ## Illumina adapter, b/c it will either be random (in RAD), or the reverse
@@ -562,65 +876,6 @@ def cutadaptit_pairs(data, sample):
         adapter1 = data.hackersonly.p3_adapter
         adapter2 = data.hackersonly.p5_adapter
 
-    # parse trim_reads
-    trim5r1 = trim5r2 = trim3r1 = trim3r2 = []
-    trimlen = data.params.trim_reads
-
-    # trim 5' end
-    if trimlen[0]:
-        trim5r1 = ["-u", str(trimlen[0])]
-    if trimlen[1] < 0:
-        trim3r1 = ["-u", str(trimlen[1])]
-    if trimlen[1] > 0:
-        trim3r1 = ["--length", str(trimlen[1])]
-
-    # legacy support for trimlen = 0,0 default
-    if len(trimlen) > 2:
-        if trimlen[2]:
-            trim5r2 = ["-U", str(trimlen[2])]
-
-    if len(trimlen) > 3:
-        if trimlen[3]:
-            if trimlen[3] < 0:
-                trim3r2 = ["-U", str(trimlen[3])]
-            if trimlen[3] > 0:            
-                trim3r2 = ["--length", str(trimlen[3])]
-
-    # testing new 'trim_reads' setting
-    cmdf1 = ["cutadapt"]
-    if trim5r1:
-        cmdf1 += trim5r1
-    if trim3r1:
-        cmdf1 += trim3r1
-    if trim5r2:
-        cmdf1 += trim5r2
-    if trim3r2:
-        cmdf1 += trim3r2
-
-    cmdf1 += [
-        "--trim-n",
-        "--max-n", str(data.params.max_low_qual_bases),
-        "--minimum-length", str(data.params.filter_min_trim_len),
-        "-o", os.path.join(
-            data.dirs.edits, sname + ".trimmed_R1_.fastq.gz"),
-        "-p", os.path.join(
-            data.dirs.edits, sname + ".trimmed_R2_.fastq.gz"),
-        finput_r1,
-        finput_r2,
-        ]
-
-    # additional args
-    if int(data.params.filter_adapters) < 2:
-        # add a dummy adapter to let cutadapt know we are not using legacy-mode
-        cmdf1.insert(1, "XXX")
-        cmdf1.insert(1, "-A")
-
-    if int(data.params.filter_adapters):
-        cmdf1.insert(1, "20,20")
-        cmdf1.insert(1, "-q")
-        cmdf1.insert(1, str(data.params.phred_Qscore_offset))
-        cmdf1.insert(1, "--quality-base")
-
     if int(data.params.filter_adapters) > 1:
         # if technical replicates then add other copies
         if isinstance(sample.barcode, list):
@@ -641,76 +896,656 @@ def cutadaptit_pairs(data, sample):
                     ])
                 )
 
-        # first enter extra cuts
-        zcut1 = list(set(data.hackersonly.p3_adapters_extra))[::-1]
-        zcut2 = list(set(data.hackersonly.p5_adapters_extra))[::-1]
-        for ecut1, ecut2 in zip(zcut1, zcut2):
-            cmdf1.insert(1, ecut1)
-            cmdf1.insert(1, "-a")
-            cmdf1.insert(1, ecut2)
-            cmdf1.insert(1, "-A")
-        # then put the main cut first
-        cmdf1.insert(1, adapter1)
-        cmdf1.insert(1, '-a')        
-        cmdf1.insert(1, adapter2)
-        cmdf1.insert(1, '-A')         
+    # extra cuts are used in pairs
+    zcut1 = list(set(data.hackersonly.p3_adapters_extra))[::-1]
+    zcut2 = list(set(data.hackersonly.p5_adapters_extra))[::-1]
+    extras = list(zip(zcut1, zcut2))
+    return (
+        [adapter1] + [i[0] for i in extras], 
+        [adapter2] + [i[1] for i in extras],
+    )
+
+
+def schedule_threads(sizes, hostsizes, maxthreads, headroom=0):
+    """
+    Returns the number of threads for each job, and the predicted makespan
+    of the schedule (see predict_makespan). Jobs larger than the average 
+    work per engine get one thread per share of it (rounded up or down) up
+    to maxthreads, whichever rounding predicts the shortest makespan, unless
+    single-threaded jobs do as well. Each job also reserves headroom 
+    engines that do not add threads.
+    """
+    maxthreads = max(1, min(maxthreads, max(hostsizes) - headroom))
+    share = max(1, sum(sizes)) / float(sum(hostsizes))
+    best = None
+    for rounding in (np.zeros_like, np.floor, np.ceil):
+        threads = np.clip(rounding(np.array(sizes) / share), 1, maxthreads)
+        threads = [int(i) for i in threads]
+        makespan = predict_makespan(sizes, threads, hostsizes, headroom)
+        if (best is None) or (makespan < best[1]):
+            best = (threads, makespan)
+    return best
+
+
+
+def get_trim_rate_key(data):
+    "trim rates differ by engine and by single or paired data"
+    return "{}-{}".format(
+        data.hackersonly.filter_adapters_mode,
+        "pair" if "pair" in data.params.datatype else "single",
+    )
+
+
+
+def load_trim_rate(project_dir, key):
+    """
+    Returns the seconds per read per thread measured by the last step 2 
+    run in the project dir for this key, else a fixed default rate.
+    """
+    try:
+        with open(os.path.join(project_dir, TRIM_RATES_CACHE), 'r') as inf:
+            return float(json.load(inf)[key])
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        mode, layout = key.split("-")
+        rate = TRIM_DEFAULT_RATES.get(mode, TRIM_DEFAULT_RATES["cutadapt"])
+        return rate * (2 if layout == "pair" else 1)
+
+
+
+def save_trim_rate(project_dir, key, rate):
+    "store a measured rate, renamed so the cache is never partly written"
+    cachefile = os.path.join(project_dir, TRIM_RATES_CACHE)
+    try:
+        with open(cachefile, 'r') as inf:
+            rates = json.load(inf)
+    except (IOError, OSError, ValueError):
+        rates = {}
+    rates[key] = rate
+    tmpfile = "{}.{}.tmp".format(cachefile, os.getpid())
+    with open(tmpfile, 'w') as out:
+        json.dump(rates, out)
+    os.replace(tmpfile, cachefile)
+
+
+
+def reserved_engines(threads, hostsizes, headroom):
+    "engines reserved by each job, at most the engines of the largest host"
+    return [min(i + headroom, max(hostsizes)) for i in threads]
+
+
+
+def predict_makespan(sizes, threads, hostsizes, headroom=0):
+    """
+    Simulates running jobs in order on hosts with hostsizes engines, in the
+    same way as Step2.run_scheduled, assuming the time of a job is its size
+    divided by its number of threads. Returns the time the last job ends.
+    """
+    engines = reserved_engines(threads, hostsizes, headroom)
+    free = list(hostsizes)
+    pending = list(range(len(sizes)))
+    events = []
+    now = 0.
+    while pending or events:
+        for jidx in list(pending):
+            if not any(free):
+                break
+            for hidx in range(len(free)):
+                if free[hidx] >= engines[jidx]:
+                    free[hidx] -= engines[jidx]
+                    heapq.heappush(events, (
+                        now + sizes[jidx] / float(threads[jidx]), 
+                        hidx, 
+                        engines[jidx]))
+                    pending.remove(jidx)
+                    break
+        now, hidx, nengines = heapq.heappop(events)
+        free[hidx] += nengines
+    return now
 
-    # do modifications to read1 and write to tmp file
-    proc1 = sps.Popen(cmdf1, stderr=sps.STDOUT, stdout=sps.PIPE, close_fds=True)
-    res1 = proc1.communicate()[0]
-    if proc1.returncode:
-        raise IPyradError("error in cutadapt: {}".format(res1.decode()))
-    return res1
 
 
 # CALLED BY STEP
-def concat_multiple_inputs(data, sample):
-    """ 
-    If multiple fastq files were appended into the list of fastqs for samples
-    then we merge them here before proceeding. 
-    """
-    # if more than one tuple in fastq list
-    if len(sample.files.fastqs) > 1:
-        # create a cat command to append them all (doesn't matter if they 
-        # are gzipped, cat still works). Grab index 0 of tuples for R1s.
-        cmd1 = ["cat"] + [i[0] for i in sample.files.fastqs]
-
-        isgzip = ".gz"
-        if not sample.files.fastqs[0][0].endswith(".gz"):
-            isgzip = ""
-
-        # write to new concat handle
-        conc1 = os.path.join(
-            data.dirs.edits, sample.name + "_R1_concat.fq{}".format(isgzip))
-        with open(conc1, 'w') as cout1:
-            proc1 = sps.Popen(
-                cmd1, stderr=sps.STDOUT, stdout=cout1, close_fds=True)
-            res1 = proc1.communicate()[0]
-        if proc1.returncode:
-            raise IPyradError("error in: {}, {}".format(cmd1, res1))
-
-        # Only set conc2 if R2 actually exists
-        conc2 = 0
-        if "pair" in data.params.datatype:
-            cmd2 = ["cat"] + [i[1] for i in sample.files.fastqs]
-            conc2 = os.path.join(
-                data.dirs.edits, sample.name + "_R2_concat.fq{}".format(isgzip))
-            with open(conc2, 'w') as cout2:
-                proc2 = sps.Popen(
-                    cmd2, stderr=sps.STDOUT, stdout=cout2, close_fds=True)
-                proc2.communicate()[0]
-            if proc2.returncode:
+def trim_samples(data, samples):
+    """
+    Built-in alternative to cutadapt (filter_adapters_mode='builtin'). 
+    Trims and filters the reads of one or more samples in this
+    process and returns {sname: counts}, or {sname: exception} for samples
+    that failed, so that one job can process many small samples.
+    """
+    # replicate adapters are added to the extras for each sample
+    extras = (
+        list(data.hackersonly.p3_adapters_extra),
+        list(data.hackersonly.p5_adapters_extra),
+    )
+    results = {}
+    for sample in samples:
+        data.hackersonly.p3_adapters_extra = list(extras[0])
+        data.hackersonly.p5_adapters_extra = list(extras[1])
+        try:
+            results[sample.name] = trim_sample(data, sample)
+        except Exception as inst:
+            results[sample.name] = inst
+    return results
+
+
+
+def trim_sample(data, sample):
+    """
+    Applies the same edits as the cutadapt command built in cutadaptit_single
+    or cutadaptit_pairs (-u/-U, --length, -q, -a/-A, --trim-n) followed by 
+    the --minimum-length and --max-n filters, to blocks of reads at a time.
+    Returns a dict of counts named as in stats_dfs.s2. If trim_reads_as_index
+    the trimmed reads are not written, only their coordinates and whether 
+    they passed, to a .trims file (see get_trim_dtype) for each input file.
+    Multiple input files of a sample are read in turn, not concatenated.
+    """
+    ispair = "pair" in data.params.datatype
+    filt = int(data.params.filter_adapters)
+    trimlen = list(data.params.trim_reads) + [0, 0, 0, 0]
+
+    # get adapters, encoded as IUPAC masks, and 5'/3' hard trims by read.
+    # Like cutadapt, --length applies to both reads, the last one given. 
+    if ispair:
+        adapters = get_adapters_pairs(data, sample)
+        length = max([0] + [i for i in trimlen[1:4:2] if i > 0][-1:])
+        hardtrims = [trimlen[:2] + [length], trimlen[2:4] + [length]]
+    else:
+        adapters = [get_adapters_single(data, sample)]
+        hardtrims = [trimlen[:2] + [max(0, trimlen[1])]]
+    if filt < 2:
+        adapters = [[] for i in adapters]
+    adapters = [encode_adapters(i) for i in adapters]
+
+    # the same options as cutadaptit_x: 3' qual trim SE, 5' and 3' for PE.
+    qcut5 = (20 if ispair else 0) if filt else 0
+    qcut3 = 20 if filt else 0
+
+    # output file handles
+    outputs = [
+        os.path.join(data.dirs.edits, sample.name + ".trimmed_R1_.fastq.gz"),
+        os.path.join(data.dirs.edits, sample.name + ".trimmed_R2_.fastq.gz"),
+    ][:1 + ispair]
+    if data.hackersonly.trim_reads_as_index:
+        # trimmed reads of an earlier run would be used by step 3
+        for handle in outputs:
+            if os.path.exists(handle):
+                os.remove(handle)
+        writers = []
+        dtype = get_trim_dtype(ispair)
+    else:
+        writers = [gzip.open(i, 'wb') for i in outputs]
+    readers = []
+
+    counts = {
+        "reads_raw": 0,
+        "trim_adapter_bp_read1": 0,
+        "trim_adapter_bp_read2": 0,
+        "trim_quality_bp_read1": 0,
+        "trim_quality_bp_read2": 0,
+        "reads_filtered_by_Ns": 0,
+        "reads_filtered_by_minlen": 0,
+        "reads_passed_filter": 0,
+    }
+    try:
+        for fidx, fastqs in enumerate(sample.files.fastqs):
+            inputs = list(fastqs[:1 + ispair])
+            readers = [
+                gzip.open(i, 'rb') if i.endswith(".gz") else open(i, 'rb')
+                for i in inputs
+            ]
+            if data.hackersonly.trim_reads_as_index:
+                writers.append(open(os.path.join(
+                    data.dirs.edits, "{}.{}.trims".format(sample.name, fidx)), 
+                    'wb'))
+
+            while 1:
+                blocks = [
+                    list(islice(i, TRIM_BLOCKSIZE * 4)) for i in readers]
+                if any(len(i) != len(blocks[0]) for i in blocks):
+                    raise IPyradError(
+                        "R1 and R2 files have different numbers of reads: "
+                        "{}".format(inputs))
+                if not blocks[0]:
+                    break
+                if len(blocks[0]) % 4:
+                    raise IPyradError(
+                        "truncated fastq file: {}".format(inputs[0]))
+
+                # trim each read, then filter both reads of a pair together
+                trimmed = []
+                for ridx, block in enumerate(blocks):
+                    if not block[-1].endswith(b"\n"):
+                        block[-1] += b"\n"
+                    buf = np.frombuffer(b"".join(block), dtype=np.uint8)
+                    ends = np.cumsum(
+                        np.fromiter(map(len, block), np.int64, len(block)))
+                    res = trim_block_numba(
+                        buf, ends, 
+                        hardtrims[ridx][0], 
+                        hardtrims[ridx][1], 
+                        hardtrims[ridx][2],
+                        qcut5, qcut3, data.params.phred_Qscore_offset,
+                        adapters[ridx][0], adapters[ridx][1],
+                    )
+                    if res[5] >= 0:
+                        raise IPyradError(
+                            "sequence and quality lengths differ in read {} "
+                            "of {}".format(
+                                counts["reads_raw"] + res[5] + 1, 
+                                inputs[ridx]))
+                    trimmed.append((buf, ends) + res[:5])
+
+                short = np.zeros(len(blocks[0]) // 4, dtype=np.bool_)
+                mostn = np.zeros(short.size, dtype=np.bool_)
+                for ridx, res in enumerate(trimmed):
+                    short |= (
+                        (res[3] - res[2]) < data.params.filter_min_trim_len)
+                    mostn |= res[6] > data.params.max_low_qual_bases
+                    key = "trim_adapter_bp_read{}".format(ridx + 1)
+                    counts[key] += int(res[4].sum())
+                    key = "trim_quality_bp_read{}".format(ridx + 1)
+                    counts[key] += int(res[5].sum())
+                mostn &= ~short
+                keep = ~(short | mostn)
+                counts["reads_raw"] += int(short.size)
+                counts["reads_filtered_by_minlen"] += int(short.sum())
+                counts["reads_filtered_by_Ns"] += int(mostn.sum())
+                counts["reads_passed_filter"] += int(keep.sum())
+
+                # write kept reads, or the trims of all reads
+                if data.hackersonly.trim_reads_as_index:
+                    if any(i[3].max(initial=0) > TRIM_MAX_LEN 
+                           for i in trimmed):
+                        raise IPyradError(
+                            "reads longer than {} bp cannot be trimmed as "
+                            "index".format(TRIM_MAX_LEN))
+                    trims = np.zeros(keep.size, dtype=dtype)
+                    for ridx, res in enumerate(trimmed):
+                        trims["start{}".format(ridx + 1)] = res[2]
+                        trims["stop{}".format(ridx + 1)] = res[3]
+                    trims["keep"] = keep
+                    writers[-1].write(trims.tobytes())
+                else:
+                    for ridx, res in enumerate(trimmed):
+                        writers[ridx].write(write_block_numba(
+                            res[0], res[1], res[2], res[3], keep).tobytes())
+
+            for handle in readers:
+                handle.close()
+    finally:
+        for handle in readers + writers:
+            handle.close()
+
+    if not ispair:
+        counts.pop("trim_adapter_bp_read2")
+        counts.pop("trim_quality_bp_read2")
+    return counts
+
+
+
+def get_trim_dtype(paired):
+    """
+    Returns the record type of .trims files: the start and stop of the kept
+    part of each read (R1 and R2) as uint16, and whether the read passed.
+    """
+    fields = [("start1", "<u2"), ("stop1", "<u2")]
+    if paired:
+        fields += [("start2", "<u2"), ("stop2", "<u2")]
+    return np.dtype(fields + [("keep", "u1")])
+
+
+
+def iter_trimmed_reads(edit, ridx):
+    """
+    Yields blocks of fastq bytes of the kept reads of R1 (ridx=0) or R2 
+    (ridx=1) of an edits tuple. If the tuple has a third element, a .trims
+    file from trim_reads_as_index, the reads are trimmed on the fly, else
+    the edited fastq is returned as is.
+    """
+    fastq = edit[ridx]
+    if fastq.endswith(".gz"):
+        reader = gzip.open(fastq, 'rb')
+    else:
+        reader = open(fastq, 'rb')
+
+    # edited fastq
+    if len(edit) < 3 or not edit[2]:
+        with reader:
+            while 1:
+                block = reader.read(TRIM_BLOCKSIZE * 1000)
+                if not block:
+                    break
+                yield block
+        return
+
+    # raw fastq with trims
+    dtype = get_trim_dtype(bool(edit[1]))
+    with reader, open(edit[2], 'rb') as trimsfile:
+        while 1:
+            block = list(islice(reader, TRIM_BLOCKSIZE * 4))
+            trims = np.frombuffer(
+                trimsfile.read(dtype.itemsize * (len(block) // 4)), dtype)
+            if not block:
+                break
+            if trims.size * 4 != len(block):
                 raise IPyradError(
-                    "Error concatenating fastq files. Make sure all " +
-                    "these files exist: {}\nError message: {}"
-                    .format(cmd2, proc2.returncode))
+                    "trims file {} does not match {}".format(edit[2], fastq))
+            if not block[-1].endswith(b"\n"):
+                block[-1] += b"\n"
+            buf = np.frombuffer(b"".join(block), dtype=np.uint8)
+            ends = np.cumsum(
+                np.fromiter(map(len, block), np.int64, len(block)))
+            yield write_block_numba(
+                buf, ends, 
+                trims["start{}".format(ridx + 1)].astype(np.int64), 
+                trims["stop{}".format(ridx + 1)].astype(np.int64),
+                trims["keep"].astype(np.bool_),
+            ).tobytes()
+
+
+
+def encode_adapters(adapters):
+    """
+    Returns a 2-d array of adapters encoded as IUPAC bitmasks, padded with 
+    zeros, and an array of their lengths.
+    """
+    adapters = [i.upper() for i in adapters if i]
+    maxlen = max([len(i) for i in adapters] + [1])
+    arr = np.zeros((len(adapters), maxlen), dtype=np.uint8)
+    for aidx, adapter in enumerate(adapters):
+        seq = np.frombuffer(adapter.encode(), dtype=np.uint8)
+        arr[aidx, :seq.size] = ADAPTER_LUT[seq]
+    return arr, np.array([len(i) for i in adapters], dtype=np.int64)
+
+
+
+def parse_trim_results(data, sample, counts):
+    """ store counts from the built-in trimming engine into sample data"""
+    for key, value in counts.items():
+        sample.stats_dfs.s2[key] = value
+
+    # save to stats summary
+    if sample.stats_dfs.s2.reads_passed_filter:
+        sample.stats.state = 2
+        sample.stats.reads_passed_filter = (
+            sample.stats_dfs.s2.reads_passed_filter)
+        edits = [
+            os.path.join(
+                data.dirs.edits, sample.name + ".trimmed_R1_.fastq.gz"), 0]
+        if "pair" in data.params.datatype:
+            edits[1] = os.path.join(
+                data.dirs.edits, sample.name + ".trimmed_R2_.fastq.gz")
+
+        sample.files.edits = [tuple(edits)]
+
+        # the untrimmed reads and their trims (trim_reads_as_index)
+        if data.hackersonly.trim_reads_as_index:
+            sample.files.edits = [
+                (fastqs[0], fastqs[1] if edits[1] else 0, os.path.join(
+                    data.dirs.edits, "{}.{}.trims".format(sample.name, fidx)))
+                for fidx, fastqs in enumerate(sample.files.fastqs)
+            ]
+    else:
+        print("{}No reads passed filtering in Sample: {}"
+              .format(data._spacer, sample.name))
+
+
+
+@njit
+def _quality_trim(buf, start, stop, cut5, cut3, offset):
+    """
+    Returns (start, stop) of the quality trimmed read by the BWA algorithm,
+    the same as cutadapt -q cut5,cut3 on the qualities in buf[start:stop].
+    """
+    qstart = start
+    qstop = stop
+    if cut5:
+        score = 0
+        best = 0
+        for pos in range(start, stop):
+            score += cut5 - (np.int64(buf[pos]) - offset)
+            if score < 0:
+                break
+            if score > best:
+                best = score
+                qstart = pos + 1
+    if cut3:
+        score = 0
+        best = 0
+        for pos in range(stop - 1, start - 1, -1):
+            score += cut3 - (np.int64(buf[pos]) - offset)
+            if score < 0:
+                break
+            if score > best:
+                best = score
+                qstop = pos
+    if qstart >= qstop:
+        return start, start
+    return qstart, qstop
+
+
+@njit
+def _find_adapter(buf, start, stop, adapters, alens):
+    """
+    Returns the position of the best 3' adapter match in buf[start:stop], 
+    or -1. As in cutadapt, adapters are aligned semi-globally with unit 
+    cost mismatches, insertions and deletions: an alignment starts at the 
+    first base of the adapter anywhere in the read, and ends at the last
+    base of the adapter or (partially, >= 3bp) at the 3' end of the read,
+    with up to 0.1 errors per aligned adapter base. Of these, the match 
+    with the best score (+1 match, -1 mismatch, -2 indel) is used, then 
+    the fewest errors, then the first found.
+    """
+    bestpos = -1
+    bestscore = 0
+    nbases = stop - start
+    if nbases < TRIM_MIN_OVERLAP:
+        return bestpos
+
+    # one column of the alignment: the cost, score and read start of the 
+    # alignment of each adapter prefix ending at this read position.
+    size = alens.max() + 1
+    cost = np.zeros(size, dtype=np.int64)
+    score = np.zeros(size, dtype=np.int64)
+    orig = np.zeros(size, dtype=np.int64)
+    for aidx in range(alens.shape[0]):
+        alen = alens[aidx]
+        apos = -1
+        ascore = 0
+        acost = 0
+        for idx in range(alen + 1):
+            cost[idx] = idx
+            score[idx] = -2 * idx
+            orig[idx] = start
+
+        for col in range(1, nbases + 1):
+            base = READ_LUT[buf[start + col - 1]]
+
+            # the diagonal (previous column, previous row) and a free start
+            dcost = cost[0]
+            dscore = score[0]
+            dorig = orig[0]
+            cost[0] = 0
+            score[0] = 0
+            orig[0] = start + col
+            for idx in range(1, alen + 1):
+                hit = (base & adapters[aidx, idx - 1]) != 0
+
+                # match or mismatch, then read base not in the adapter
+                # (insertion), then adapter base not in the read (deletion)
+                ncost = dcost + (0 if hit else 1)
+                if ncost <= cost[idx] + 1 and ncost <= cost[idx - 1] + 1:
+                    nscore = dscore + (1 if hit else -1)
+                    norig = dorig
+                elif cost[idx] <= cost[idx - 1]:
+                    ncost = cost[idx] + 1
+                    nscore = score[idx] - 2
+                    norig = orig[idx]
+                else:
+                    ncost = cost[idx - 1] + 1
+                    nscore = score[idx - 1] - 2
+                    norig = orig[idx - 1]
+
+                dcost = cost[idx]
+                dscore = score[idx]
+                dorig = orig[idx]
+                cost[idx] = ncost
+                score[idx] = nscore
+                orig[idx] = norig
+
+            # full adapter ending here, or any prefix at the 3' end
+            first = alen
+            if col == nbases:
+                first = TRIM_MIN_OVERLAP
+            for idx in range(first, alen + 1):
+                if cost[idx] > int(idx * TRIM_ERROR_RATE):
+                    continue
+                if orig[idx] >= stop:
+                    continue
+                if (score[idx] > ascore) or (
+                        score[idx] == ascore and cost[idx] < acost):
+                    ascore = score[idx]
+                    acost = cost[idx]
+                    apos = orig[idx]
+
+        if ascore > bestscore:
+            bestscore = ascore
+            bestpos = apos
+    return bestpos
+
+
+@njit
+def trim_block_numba(
+    buf, ends, cut5, cut3, length, qcut5, qcut3, offset, adapters, alens):
+    """
+    Trims a block of fastq lines joined in buf, where ends are the offsets
+    of the end of each line. Returns for each read the (start, stop) of the
+    kept part of the sequence relative to the start of the line, whether an
+    adapter was found, the number of quality-trimmed bases, the number of 
+    Ns that remain, and the index of the first read with sequence and 
+    quality of different lengths, or -1.
+    """
+    nreads = ends.shape[0] // 4
+    starts = np.zeros(nreads, dtype=np.int64)
+    stops = np.zeros(nreads, dtype=np.int64)
+    hits = np.zeros(nreads, dtype=np.bool_)
+    qtrims = np.zeros(nreads, dtype=np.int64)
+    nbases = np.zeros(nreads, dtype=np.int64)
+
+    for idx in range(nreads):
+        # sequence and quality lines w/o newlines (or \r\n)
+        sfirst = ends[idx * 4]
+        slast = ends[idx * 4 + 1] - 1
+        qfirst = ends[idx * 4 + 2]
+        qlast = ends[idx * 4 + 3] - 1
+        if slast > sfirst and buf[slast - 1] == 13:
+            slast -= 1
+        if qlast > qfirst and buf[qlast - 1] == 13:
+            qlast -= 1
+        if qlast - qfirst != slast - sfirst:
+            return starts, stops, hits, qtrims, nbases, idx
+
+        # -u/-U: hard trims; negative values trim the 3' end
+        start = 0
+        stop = slast - sfirst
+        if cut5 > 0:
+            start = min(cut5, stop)
+        elif cut5 < 0:
+            stop = max(stop + cut5, start)
+        if cut3 < 0:
+            stop = max(stop + cut3, start)
+
+        # -q: quality trims
+        if qcut5 or qcut3:
+            qstart, qstop = _quality_trim(
+                buf, qfirst + start, qfirst + stop, qcut5, qcut3, offset)
+            qtrims[idx] = (stop - start) - (qstop - qstart)
+            start = qstart - qfirst
+            stop = qstop - qfirst
+
+        # -a/-A: adapters
+        if alens.shape[0]:
+            pos = _find_adapter(
+                buf, sfirst + start, sfirst + stop, adapters, alens)
+            if pos >= 0:
+                hits[idx] = True
+                stop = pos - sfirst
+
+        # --length
+        if length > 0:
+            stop = min(stop, start + length)
+
+        # --trim-n
+        while start < stop and buf[sfirst + start] == 78:
+            start += 1
+        while stop > start and buf[sfirst + stop - 1] == 78:
+            stop -= 1
+        for pos in range(sfirst + start, sfirst + stop):
+            if buf[pos] == 78:
+                nbases[idx] += 1
+        starts[idx] = start
+        stops[idx] = stop
+    return starts, stops, hits, qtrims, nbases, -1
+
+
+@njit
+def write_block_numba(buf, ends, starts, stops, keep):
+    """
+    Returns the fastq bytes of the kept reads of a block trimmed by 
+    trim_block_numba, with the header and + lines copied unchanged.
+    """
+    size = 0
+    for idx in range(keep.shape[0]):
+        if keep[idx]:
+            first = 0 if not idx else ends[idx * 4 - 1]
+            size += ends[idx * 4] - first
+            size += ends[idx * 4 + 2] - ends[idx * 4 + 1]
+            size += 2 * (stops[idx] - starts[idx] + 1)
+    out = np.empty(size, dtype=np.uint8)
+
+    opos = 0
+    for idx in range(keep.shape[0]):
+        if not keep[idx]:
+            continue
+        first = 0 if not idx else ends[idx * 4 - 1]
+        for line in range(4):
+            lfirst = first if not line else ends[idx * 4 + line - 1]
+            llast = ends[idx * 4 + line]
+            if line % 2:
+                llast = lfirst + stops[idx]
+                lfirst = lfirst + starts[idx]
+            for pos in range(lfirst, llast):
+                out[opos] = buf[pos]
+                opos += 1
+            if line % 2:
+                out[opos] = 10
+                opos += 1
+    return out
 
-        # store new file handles
-        sample.files.concat = [(conc1, conc2)]
-    return sample.files.concat
 
 
 # GLOBALS
+TRIM_BLOCKSIZE = 50000
+TRIM_JOB_READS = 1000000
+TRIM_MAX_THREADS = 8
+TRIM_CUTADAPT_HEADROOM = 1
+TRIM_MAX_LEN = 65535
+TRIM_MIN_OVERLAP = 3
+TRIM_ERROR_RATE = 0.1
+
+# seconds per single-end read per thread used to predict the makespan of
+# step 2 until a run in the project dir has measured it.
+TRIM_RATES_CACHE = "s2_trim_rates.json"
+TRIM_DEFAULT_RATES = {"cutadapt": 2e-5, "builtin": 4e-6}
+
+# bases as bitmasks, read Ns match only adapter Ns.
+READ_LUT = np.zeros(256, dtype=np.uint8)
+ADAPTER_LUT = np.zeros(256, dtype=np.uint8)
+for _base, _mask in zip("ACGTN", (1, 2, 4, 8, 16)):
+    READ_LUT[ord(_base)] = READ_LUT[ord(_base.lower())] = _mask
+for _base, _mask in zip(
+    "ACGTRYSWKMBDHVN", (1, 2, 4, 8, 5, 10, 6, 9, 12, 3, 14, 13, 11, 7, 31)):
+    ADAPTER_LUT[ord(_base)] = _mask
 NO_BARS_GBS_WARNING = """\
     This is a just a warning: 
     You set 'filter_adapters' to 2 (stringent), however, b/c your data
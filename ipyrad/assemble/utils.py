@@ -14,7 +14,11 @@ except ImportError:
 
 import os
 import sys
+import json
+import fcntl
 import socket
+import hashlib
+from contextlib import contextmanager
 import pandas as pd
 import numpy as np
 import string
@@ -29,6 +33,9 @@ BADCHARS = (
     .replace(".", "") + " "
 )
 
+# bytes read at a time to get the checksum of a reference
+REF_CACHE_BLOCK = 2 ** 24
+
 
 class IPyradError(Exception):
     """
@@ -196,22 +203,101 @@ AMBIGS = {
 def chroms2ints(data, intkeys):
     """
     Parse .fai to get a dict with {chroms/scaffolds: ints}, or reversed.
+    The chroms are read from the reference cache bundle if there is one.
     """
-    fai = pd.read_csv(
-        data.params.reference_sequence + ".fai",
-        names=['scaffold', 'length', 'start', 'a', 'b'],
-        sep="\t",
-    )
-    # Allow CHROM to take integer values, here cast them to str
-    fai["scaffold"] = fai["scaffold"].astype(str)
-
-    faidict = {j: i for i, j in enumerate(fai.scaffold)}
+    bundle = get_ref_bundle(data)
+    chromsfile = os.path.join(bundle or "", "chroms.json")
+    if bundle and os.path.exists(chromsfile):
+        with open(chromsfile) as infile:
+            scaffolds = json.load(infile)["chroms"]
+    else:
+        fai = pd.read_csv(
+            data.params.reference_sequence + ".fai",
+            names=['scaffold', 'length', 'start', 'a', 'b'],
+            sep="\t",
+        )
+        # Allow CHROM to take integer values, here cast them to str
+        scaffolds = fai["scaffold"].astype(str)
+
+    faidict = {j: i for i, j in enumerate(scaffolds)}
     if intkeys:
         revdict = {j: i for i, j in faidict.items()}
         return revdict
     return faidict
 
 
+def get_ref_bundle(data, alt=False):
+    """
+    Returns the directory of the reference (or reference_as_filter if alt)
+    in the reference cache (hackersonly.reference_cache_dir), named by the
+    md5 checksum of the file so that any assembly using the same sequence 
+    shares it, or None if no cache dir is set. Checksums are remembered by
+    path, size and mtime in checksums.json so each file is read only once.
+    """
+    cachedir = data.hackersonly.reference_cache_dir
+    if not cachedir:
+        return None
+    if alt:
+        reference = data.params.reference_as_filter
+    else:
+        reference = data.params.reference_sequence
+    cachedir = os.path.realpath(os.path.expanduser(cachedir))
+    if not os.path.exists(cachedir):
+        os.makedirs(cachedir, exist_ok=True)
+
+    # look up or compute the checksum of this reference file
+    stat = os.stat(reference)
+    key = "{}\t{}\t{}".format(
+        os.path.realpath(reference), stat.st_size, stat.st_mtime_ns)
+    memo = os.path.join(cachedir, "checksums.json")
+    with ref_cache_lock(memo):
+        checksums = {}
+        if os.path.exists(memo):
+            with open(memo) as infile:
+                checksums = json.load(infile)
+        if key not in checksums:
+            md5 = hashlib.md5()
+            with open(reference, 'rb') as infile:
+                for block in iter(lambda: infile.read(REF_CACHE_BLOCK), b""):
+                    md5.update(block)
+            checksums[key] = md5.hexdigest()
+            with open(memo + ".tmp", 'w') as out:
+                json.dump(checksums, out, indent=0)
+            os.replace(memo + ".tmp", memo)
+
+    bundle = os.path.join(cachedir, checksums[key])
+    if not os.path.exists(bundle):
+        os.makedirs(bundle, exist_ok=True)
+    return bundle
+
+
+def build_ref_cached(bundle, name, build):
+    """
+    Calls build() to make the item 'name' (e.g., the bwa index) of a 
+    reference cache bundle unless it is already done. Concurrent runs wait
+    on a lock for the first to finish instead of building it again. Items
+    are marked done by an empty file {name}.done in the bundle.
+    """
+    done = os.path.join(bundle, name + ".done")
+    if os.path.exists(done):
+        return
+    with ref_cache_lock(os.path.join(bundle, name)):
+        if not os.path.exists(done):
+            build()
+            open(done, 'w').close()
+
+
+@contextmanager
+def ref_cache_lock(path):
+    "holds an exclusive lock on the file path.lock (see get_ref_bundle)"
+    with open(path + ".lock", 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
 
 
 def ambigcutters(seq):
@@ -39,6 +39,18 @@ class Hackers(object):
             ("query_cov", None),
             ("bwa_args", ""),
             ("demultiplex_on_i7_tags", False),
+            ("demultiplex_streaming", False),
+            ("index_raw_fastqs", False),
+            ("filter_adapters_mode", "cutadapt"),
+            ("trim_reads_as_index", False),
+            ("derep_mode", "vsearch"),
+            ("align_builtin_max_seqs", 0),
+            ("align_builtin_max_indels", 3),
+            ("align_builtin_validate", 0.0),
+            ("align_queue", False),
+            ("mapping_piped", False),
+            ("samtools_sort_memory", "768M"),
+            ("reference_cache_dir", ""),
             ("declone_PCR_duplicates", False),
             ("merge_technical_replicates", True),
             ("exclude_reference", True),
@@ -141,6 +153,100 @@ class Hackers(object):
     def demultiplex_on_i7_tags(self, value):
         self._data["demultiplex_on_i7_tags"] = bool(value)
 
+    @property
+    def demultiplex_streaming(self):
+        return self._data["demultiplex_streaming"]
+    @demultiplex_streaming.setter
+    def demultiplex_streaming(self, value):
+        self._data["demultiplex_streaming"] = bool(value)
+
+    @property
+    def index_raw_fastqs(self):
+        return self._data["index_raw_fastqs"]
+    @index_raw_fastqs.setter
+    def index_raw_fastqs(self, value):
+        self._data["index_raw_fastqs"] = bool(value)
+
+    @property
+    def filter_adapters_mode(self):
+        return self._data["filter_adapters_mode"]
+    @filter_adapters_mode.setter
+    def filter_adapters_mode(self, value):
+        value = str(value)
+        if value not in ("cutadapt", "builtin"):
+            raise IPyradError(
+                "filter_adapters_mode must be 'cutadapt' or 'builtin'")
+        self._data["filter_adapters_mode"] = value
+
+    @property
+    def trim_reads_as_index(self):
+        return self._data["trim_reads_as_index"]
+    @trim_reads_as_index.setter
+    def trim_reads_as_index(self, value):
+        self._data["trim_reads_as_index"] = bool(value)
+
+    @property
+    def derep_mode(self):
+        return self._data["derep_mode"]
+    @derep_mode.setter
+    def derep_mode(self, value):
+        value = str(value)
+        if value not in ("vsearch", "builtin"):
+            raise IPyradError("derep_mode must be 'vsearch' or 'builtin'")
+        self._data["derep_mode"] = value
+
+    @property
+    def align_builtin_max_seqs(self):
+        return self._data["align_builtin_max_seqs"]
+    @align_builtin_max_seqs.setter
+    def align_builtin_max_seqs(self, value):
+        self._data["align_builtin_max_seqs"] = int(value)
+
+    @property
+    def align_builtin_max_indels(self):
+        return self._data["align_builtin_max_indels"]
+    @align_builtin_max_indels.setter
+    def align_builtin_max_indels(self, value):
+        self._data["align_builtin_max_indels"] = int(value)
+
+    @property
+    def align_builtin_validate(self):
+        return self._data["align_builtin_validate"]
+    @align_builtin_validate.setter
+    def align_builtin_validate(self, value):
+        value = float(value)
+        if not 0 <= value <= 1:
+            raise IPyradError("align_builtin_validate must be from 0 to 1")
+        self._data["align_builtin_validate"] = value
+
+    @property
+    def align_queue(self):
+        return self._data["align_queue"]
+    @align_queue.setter
+    def align_queue(self, value):
+        self._data["align_queue"] = bool(value)
+
+    @property
+    def mapping_piped(self):
+        return self._data["mapping_piped"]
+    @mapping_piped.setter
+    def mapping_piped(self, value):
+        self._data["mapping_piped"] = bool(value)
+
+    @property
+    def samtools_sort_memory(self):
+        return self._data["samtools_sort_memory"]
+    @samtools_sort_memory.setter
+    def samtools_sort_memory(self, value):
+        self._data["samtools_sort_memory"] = str(value)
+
+    @property
+    def reference_cache_dir(self):
+        return self._data["reference_cache_dir"]
+    @reference_cache_dir.setter
+    def reference_cache_dir(self, value):
+        self._data["reference_cache_dir"] = str(value or "")
+
     @property
     def declone_PCR_duplicates(self):
         return self._data["declone_PCR_duplicates"]